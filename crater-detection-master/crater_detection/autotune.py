@@ -0,0 +1,330 @@
+"""
+Searches the detector's parameters for the fastest configuration that still finds a target share of the craters,
+scored against the ground truth of generated fields, or of labelled tiles (images with a truth CSV next to them,
+as written by `generate --num-fields`).
+
+Trials run in a pool of processes. Each job is every trial sharing its first two parameters (the threshold
+percentiles for the contour methods), and each worker keeps the intermediate results trials share:
+peak histograms, threshold masks, contours, Hough refinements and pyramids. Only what a trial changes is computed.
+A trial's time is the sum of its stages' times, each measured the one time it was computed,
+so stages read from the cache still count.
+"""
+import itertools
+import os
+import time
+from collections import OrderedDict
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from . import benchmark, evaluation, generator, image_io
+from .detector import CloseSize, crater_circles, find_crater_contours, threshold_masks
+from .detector import hough
+from .detector.thresholds import PeakHistogram, LowPercentile, HighPercentile
+from .util import logger, to_builtin
+
+METHODS = ("contour", "fused", "hough")
+
+# Defaults
+Method = "contour"
+TargetRecall = 0.3
+NumFields = evaluation.NumFields
+FieldSize = evaluation.FieldSize
+# Results of each stage a worker keeps, the least recently used are dropped past it
+CacheEntries = 64
+
+# Values tried for each parameter, the detector's defaults among them
+SEARCH_SPACES = {
+    "contour": OrderedDict([
+        ("low_percentile", [0.0005, LowPercentile, 0.002, 0.005, 0.01]),
+        ("high_percentile", [0.9, 0.93, HighPercentile, 0.97, 0.99]),
+        ("close_size", [6, 8, CloseSize, 12, 14]),
+    ]),
+    "fused": OrderedDict([
+        ("low_percentile", [LowPercentile, 0.002, 0.005]),
+        ("high_percentile", [HighPercentile, 0.97]),
+        ("close_size", [8, CloseSize, 12]),
+        ("hough_param1", [10, hough.Param1, 40]),
+        ("vote_fraction", [0.2, hough.VoteFraction, 0.35]),
+        ("confirmed_only", [False, True]),
+    ]),
+    "hough": OrderedDict([
+        ("hough_param1", [10, hough.Param1, 40]),
+        ("hough_param2", [50, hough.Param2, 90]),
+        ("min_dist", [hough.MinDist, 10]),
+    ]),
+}
+
+# (grayscale image, (N, 3) array of true [x, y, radius])
+Field = Tuple[np.ndarray, np.ndarray]
+
+
+def generated_fields(num_fields: int = NumFields,
+                     size: int = FieldSize,
+                     num_craters: int = generator.NCraters,
+                     sun_angle: float = generator.SunAngle,
+                     rand_seed: int = 1) -> List[Field]:
+    fields = []
+    for seed in generator.field_seeds(num_fields, rand_seed):
+        input_image, _, truth = generator.generate(num_craters=num_craters,
+                                                   width=size,
+                                                   height=size,
+                                                   sun_angle=sun_angle,
+                                                   rand_seed=int(seed),
+                                                   return_truth=True)
+        fields.append((cv.cvtColor(input_image, cv.COLOR_BGR2GRAY), evaluation.truth_circles(truth)))
+    return fields
+
+
+def labelled_fields(directory: str) -> List[Field]:
+    """
+    :param directory: of images, each with its ground truth as <name>.csv next to it (x, y and radius columns,
+        and outer_radius if there is one, which is what's scored against)
+    :return: the images that have a truth file
+    """
+    from .batch import find_images
+
+    fields = []
+    for path in find_images(directory):
+        truth_filename = os.path.splitext(path)[0] + '.csv'
+        if not os.path.isfile(truth_filename):
+            logger.debug("No ground truth for %s" % path)
+            continue
+        truth = generator.read_ground_truth(truth_filename)
+        if "outer_radius" in truth:
+            true_circles = evaluation.truth_circles(truth)
+        else:
+            true_circles = np.column_stack((truth["x"], truth["y"], truth["radius"]))
+        fields.append((image_io.read_image(path, gray=True), true_circles))
+
+    if len(fields) == 0:
+        raise ValueError("No images with a ground truth CSV next to them in: " + directory)
+    return fields
+
+
+def parse_values(text: str, search_space: Dict[str, List]) -> Tuple[str, List]:
+    """
+    :param text: name=value,value,... with the values typed as the parameter's defaults are
+    :param search_space: to check the name against
+    :return: (name, values)
+    """
+    name, _, values = text.partition('=')
+    name = name.strip().replace('-', '_')
+    if name not in search_space or not values:
+        raise ValueError("Parameters are given as name=v1,v2,... with a name from: " + ", ".join(search_space))
+
+    kind = type(search_space[name][0])
+    if kind == bool:
+        return name, [value.strip().lower() in ('1', 'true', 'yes') for value in values.split(',')]
+    return name, [kind(value) for value in values.split(',')]
+
+
+def iter_trials(search_space: Dict[str, List]):
+    """
+    :return: the parameters of each trial, every combination of the values
+    """
+    names = list(search_space.keys())
+    for values in itertools.product(*search_space.values()):
+        yield OrderedDict(zip(names, values))
+
+
+class StageCache:
+    """
+    Least recently used results of one stage, each kept with the seconds it took to compute.
+    """
+    def __init__(self, max_entries: int = CacheEntries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute: Callable[[], Any]) -> Tuple[Any, float]:
+        """
+        :return: the result for the key, computed if it isn't kept, and the seconds computing it took
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        start = time.perf_counter()
+        value = compute()
+        entry = (value, time.perf_counter() - start)
+        self.misses += 1
+        self.entries[key] = entry
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+
+def contour_circles(masks: Tuple[np.ndarray, np.ndarray], close_size: int) -> np.ndarray:
+    """
+    The rest of detect, from its threshold masks.
+    :return: (N, 3) array of the craters' enclosing circles
+    """
+    low_contours, high_contours, _, _, h_matches = find_crater_contours(*masks, close_size=close_size)
+    return crater_circles(high_contours, low_contours, h_matches)
+
+
+# Set in each worker by _init_worker
+_fields: List[Field] = None
+_caches: Dict[str, StageCache] = None
+
+
+def _init_worker(fields: List[Field], verbose: bool):
+    global _fields, _caches
+    logger.set_enabled(verbose)
+    _fields = fields
+    _caches = {name: StageCache() for name in ("histogram", "masks", "contours", "refine", "pyramid")}
+
+
+def run_contour(i: int, params: Dict) -> Tuple[np.ndarray, float, tuple]:
+    """
+    :return: the circles found in field i, the seconds it took, and the key of the contours
+    """
+    bw_img = _fields[i][0]
+    histogram, seconds = _caches["histogram"].get(i, lambda: PeakHistogram().add(bw_img))
+    low_val, high_val = (int(value) for value in histogram.thresholds(params["low_percentile"],
+                                                                     params["high_percentile"]))
+
+    masks, mask_seconds = _caches["masks"].get((i, low_val, high_val),
+                                               lambda: threshold_masks(bw_img, low_val, high_val))
+    key = (i, low_val, high_val, params["close_size"])
+    circles, contour_seconds = _caches["contours"].get(key, lambda: contour_circles(masks, params["close_size"]))
+    return circles, seconds + mask_seconds + contour_seconds, key
+
+
+def run_fused(i: int, params: Dict) -> Tuple[np.ndarray, float]:
+    circles, seconds, key = run_contour(i, params)
+    (refined, confirmed), refine_seconds = _caches["refine"].get(
+        key + (params["hough_param1"], params["vote_fraction"]),
+        lambda: hough.refine_circles(_fields[i][0], circles, params["hough_param1"], params["vote_fraction"]))
+    if params["confirmed_only"]:
+        refined = refined[confirmed]
+    return refined, seconds + refine_seconds
+
+
+def run_hough(i: int, params: Dict) -> Tuple[np.ndarray, float]:
+    """
+    hough.find_circles, with the blurred pyramid kept.
+    """
+    bw_img = _fields[i][0]
+    height, width = bw_img.shape
+    pyramid, seconds = _caches["pyramid"].get(i, lambda: hough.blurred_pyramid(bw_img, steps=3))
+
+    start = time.perf_counter()
+    # The pool already runs a trial per process, the levels don't need threads of their own
+    all_circles = hough.pyramid_circles(pyramid, height, width, workers=1, param1=params["hough_param1"],
+                                        param2=params["hough_param2"], min_dist=params["min_dist"])
+    circles = hough.dedup_circles(all_circles, hough.get_min_dup_dist(height, width))
+    return np.float64(circles), seconds + time.perf_counter() - start
+
+
+def run_trial(method: str, params: Dict, match_params: Dict) -> Dict:
+    """
+    :return: the trial's scores pooled over every field, and its mean seconds per field
+    """
+    counts = {"num_truth": 0, "num_detected": 0, "num_matched": 0}
+    seconds = 0.0
+    for i, (_, true_circles) in enumerate(_fields):
+        if method == "contour":
+            circles, field_seconds, _ = run_contour(i, params)
+        elif method == "fused":
+            circles, field_seconds = run_fused(i, params)
+        else:
+            circles, field_seconds = run_hough(i, params)
+        seconds += field_seconds
+        field_score = evaluation.score(true_circles, circles, **match_params)
+        for key in counts:
+            counts[key] += field_score[key]
+
+    precision = counts["num_matched"] / counts["num_detected"] if counts["num_detected"] > 0 else np.nan
+    recall = counts["num_matched"] / counts["num_truth"] if counts["num_truth"] > 0 else np.nan
+    total = precision + recall
+    trial = {
+        "params": dict(params),
+        "seconds": seconds / len(_fields),
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / total if total > 0 else 0.0,
+    }
+    trial.update(counts)
+    return trial
+
+
+def _trials_job(job) -> Tuple[List[Dict], Dict[str, List[int]]]:
+    method, trials, match_params = job
+    before = {name: (cache.hits, cache.misses) for name, cache in _caches.items()}
+    results = [run_trial(method, params, match_params) for params in trials]
+    cache_counts = {name: [cache.hits - before[name][0], cache.misses - before[name][1]]
+                    for name, cache in _caches.items()}
+    return results, cache_counts
+
+
+def best_trial(trials: List[Dict], target_recall: float) -> Tuple[Dict, bool]:
+    """
+    :return: the fastest trial with at least the target recall (the better F1 of equally fast ones),
+        else the one with the highest recall, and whether it meets the target
+    """
+    meeting = [trial for trial in trials if trial["recall"] >= target_recall]
+    if len(meeting) > 0:
+        return min(meeting, key=lambda trial: (trial["seconds"], -trial["f1"])), True
+    return max(trials, key=lambda trial: (trial["recall"], -trial["seconds"])), False
+
+
+def autotune(fields: List[Field],
+             method: str = Method,
+             target_recall: float = TargetRecall,
+             search_space: Dict[str, List] = None,
+             workers: int = None,
+             verbose: bool = False,
+             **match_params) -> Dict:
+    """
+    :param fields: (grayscale image, true circles) pairs, see generated_fields and labelled_fields
+    :param method: one of METHODS
+    :param target_recall: the share of the true craters the configuration must find
+    :param search_space: name => values, SEARCH_SPACES[method] if not given
+    :param workers: processes, defaults to the number of cores
+    :param verbose: logging in the workers
+    :param match_params: see evaluation.match_craters
+    :return: every trial (fastest first), the best one and whether it meets the target, and the cache use
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown method '%s', use one of: %s" % (method, ", ".join(METHODS)))
+    search_space = search_space or SEARCH_SPACES[method]
+    workers = workers or os.cpu_count() or 1
+
+    # Trials sharing the first two parameters share masks, so they go to one worker together
+    jobs = OrderedDict()
+    for params in iter_trials(search_space):
+        jobs.setdefault(tuple(params.values())[:2], []).append(params)
+    num_trials = sum(len(trials) for trials in jobs.values())
+    logger.info("Running %i trials of %s on %i fields with %i workers" % (num_trials, method, len(fields), workers))
+
+    trials = []
+    cache_counts = {}
+    with Pool(processes=workers, initializer=_init_worker, initargs=(fields, verbose)) as pool:
+        job_args = [(method, job_trials, match_params) for job_trials in jobs.values()]
+        for job_results, job_cache_counts in pool.imap_unordered(_trials_job, job_args):
+            trials.extend(job_results)
+            for name, (hits, misses) in job_cache_counts.items():
+                counts = cache_counts.setdefault(name, {"hits": 0, "misses": 0})
+                counts["hits"] += hits
+                counts["misses"] += misses
+            logger.debug("%i of %i trials done" % (len(trials), num_trials))
+
+    trials.sort(key=lambda trial: trial["seconds"])
+    best, meets_target = best_trial(trials, target_recall)
+    return to_builtin({
+        "environment": benchmark.environment(),
+        "method": method,
+        "target_recall": target_recall,
+        "num_fields": len(fields),
+        "search_space": search_space,
+        "best": best,
+        "meets_target": meets_target,
+        "cache": cache_counts,
+        "trials": trials,
+    })
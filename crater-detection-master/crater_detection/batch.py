@@ -0,0 +1,264 @@
+"""
+Batch detection over many images with a pool of worker processes
+"""
+import glob
+import json
+import os
+import time
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
+
+from . import cache, catalog, detector, image_io
+from .detector import tiling
+from .detector.thresholds import PeakHistogram
+from .profiling import NULL_PROFILER, StageProfiler
+from .util import logger, to_builtin
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+SUMMARY_FILENAME = 'summary.json'
+
+
+def find_images(pattern: str) -> List[str]:
+    """
+    :param pattern: a directory, a single file, or a glob pattern
+    :return: sorted image paths
+    """
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+    else:
+        paths = glob.glob(pattern)
+
+    return sorted(p for p in paths
+                  if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def input_root(paths: List[str]) -> str:
+    """
+    :return: the deepest directory holding every path, outputs mirror the paths' layout under it
+    """
+    if len(paths) == 0:
+        return ''
+    return os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+
+
+def output_subdir(path: str, root: str) -> str:
+    """
+    :return: the path's directory relative to the input root, '' for images directly in it
+    """
+    subdir = os.path.relpath(os.path.dirname(os.path.abspath(path)), root)
+    return '' if subdir == os.curdir else subdir
+
+
+# Set in each worker by _init_worker, images of the same size reuse its buffers
+_workspace: detector.DetectorWorkspace = None
+
+
+# Per process, so a cache's running size estimate is kept from image to image
+_caches: Dict[Tuple[str, int], cache.DetectionCache] = {}
+
+
+def open_cache(cache_dir: str, cache_size: int) -> cache.DetectionCache:
+    """
+    :return: this process' cache.DetectionCache of the directory
+    """
+    key = (cache_dir, cache_size)
+    if key not in _caches:
+        _caches[key] = cache.DetectionCache(cache_dir, max_bytes=cache_size)
+    return _caches[key]
+
+
+def _init_worker(verbose: bool):
+    global _workspace
+    logger.set_enabled(verbose)
+    _workspace = detector.DetectorWorkspace()
+
+
+def histogram_file(path: str, gray_decode: bool = False, decode_scale: int = 1) -> List[int]:
+    """
+    :return: counts of the image's thresholds.PeakHistogram
+    """
+    input_image = image_io.read_image(path, gray=gray_decode, scale=decode_scale)
+    return tiling.peak_histogram(input_image).to_list()
+
+
+def _histogram_job(job) -> List[int]:
+    return histogram_file(*job)
+
+
+def shared_thresholds(pool: Pool, paths: List[str], gray_decode: bool = False,
+                      decode_scale: int = 1) -> Tuple[int, int]:
+    """
+    One pass over every image, merging their peak histograms, so all images are thresholded alike.
+    """
+    histogram = PeakHistogram()
+    jobs = [(path, gray_decode, decode_scale) for path in paths]
+    for counts in pool.imap_unordered(_histogram_job, jobs):
+        histogram.merge(PeakHistogram(counts))
+    return histogram.thresholds()
+
+
+def detect_file(path: str, output_dir: str, tile_size: int = None, overlap: int = tiling.TileOverlap,
+                profile: bool = False, catalog_format: str = None, render: bool = True,
+                thresholds: Tuple[int, int] = None, cache_dir: str = None,
+                cache_size: int = cache.MaxBytes, gray_decode: bool = False, decode_scale: int = 1) -> Dict:
+    """
+    Detects craters in one image and writes its overlay and / or catalog to the output dir.
+    Runs in a worker process, so failures are returned rather than raised.
+    :param output_dir: the image's own output dir, made if missing
+    :param profile: whether to add the per stage profile to the result
+    :param catalog_format: one of catalog.CATALOG_FORMATS, no catalog if not given
+    :param render: whether to draw and save the overlay
+    :param thresholds: (low, high), computed from the image if not given
+    :param cache_dir: a cache.DetectionCache directory to reuse results from
+    :param cache_size: in bytes, see cache.DetectionCache
+    :param gray_decode: decode straight to grayscale, see image_io.read_image
+    :param decode_scale: decode at 1 / decode_scale of the size, craters are still reported at full size
+    :return: a result record for the summary
+    """
+    start = time.perf_counter()
+    _, image_filename = os.path.split(path)
+    result = {"input": path}
+    profiler = StageProfiler() if profile else NULL_PROFILER
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        out_filename = os.path.join(output_dir, f'output-{image_filename}')
+        detection_cache = cache_key = cached = None
+        if cache_dir is not None:
+            with profiler.stage("cache_lookup"):
+                detection_cache = open_cache(cache_dir, cache_size)
+                params = cache.detection_params(tile_size, overlap, thresholds,
+                                                gray_decode=gray_decode, decode_scale=decode_scale)
+                cache_key = detection_cache.key(cache.file_digest(path), params)
+                cached = detection_cache.get(cache_key, overlay=render)
+            result["cached"] = cached is not None
+
+        if cached is not None:
+            crater_field, cached_overlay = cached
+            if render:
+                with profiler.stage("write"):
+                    cache.write_overlay(cached_overlay, out_filename)
+        else:
+            with profiler.stage("read"):
+                input_image = image_io.read_image(path, gray=gray_decode, scale=decode_scale)
+            if tile_size is not None:
+                crater_field = tiling.detect_tiled(input_image, tile_size=tile_size, overlap=overlap,
+                                                   thresholds=thresholds, profiler=profiler)
+                if render:
+                    with profiler.stage("render"):
+                        output_image = tiling.draw_craters(input_image, crater_field)
+            else:
+                output_image, crater_field = detector.detect(input_image, thresholds=thresholds,
+                                                             profiler=profiler, render=render,
+                                                             workspace=_workspace)
+
+            if render:
+                with profiler.stage("write"):
+                    image_io.write_image(out_filename, output_image)
+
+            if decode_scale > 1:
+                crater_field = crater_field.scaled(decode_scale)
+
+            if detection_cache is not None:
+                with profiler.stage("cache_put"):
+                    detection_cache.put(cache_key, crater_field, out_filename if render else None)
+
+        if render:
+            result["output"] = out_filename
+
+        if catalog_format is not None:
+            image_name, _ = os.path.splitext(image_filename)
+            catalog_filename = os.path.join(output_dir, f'catalog-{image_name}.{catalog_format}')
+            with profiler.stage("write_catalog"):
+                catalog.write_catalog(crater_field, catalog_filename)
+            result["catalog"] = catalog_filename
+
+        result["stats"] = to_builtin(crater_field.stats())
+    except Exception as ex:
+        result["error"] = "%s: %s" % (type(ex).__name__, ex)
+
+    result["seconds"] = time.perf_counter() - start
+    if profile:
+        profiler.stop()
+        result["profile"] = profiler.to_dict()
+    return result
+
+
+def _detect_job(job) -> Dict:
+    return detect_file(*job)
+
+
+def detect_batch(paths: List[str],
+                 output_dir: str,
+                 workers: int = None,
+                 tile_size: int = None,
+                 overlap: int = tiling.TileOverlap,
+                 verbose: bool = False,
+                 profile: bool = False,
+                 catalog_format: str = None,
+                 render: bool = True,
+                 thresholds: Tuple[int, int] = None,
+                 share_thresholds: bool = False,
+                 cache_dir: str = None,
+                 cache_size: int = cache.MaxBytes,
+                 gray_decode: bool = False,
+                 decode_scale: int = 1) -> Dict:
+    """
+    Fans images out to a process pool, so interpreter startup and imports are paid once per worker.
+    :param paths: images to detect
+    :param output_dir: where the summary is written, and the overlays and catalogs under the same
+        subdirectories as their images relative to the input_root, so same-named images don't collide
+    :param workers: number of processes, defaults to the number of cores
+    :param tile_size: see tiling.detect_tiled
+    :param overlap: see tiling.detect_tiled
+    :param verbose: whether workers should log
+    :param profile: whether to record per stage profiles of each image
+    :param catalog_format: see detect_file
+    :param render: see detect_file
+    :param thresholds: (low, high) used for every image
+    :param share_thresholds: compute the thresholds once from all the images, if not given
+    :param cache_dir: see detect_file
+    :param cache_size: see detect_file
+    :param gray_decode: see detect_file
+    :param decode_scale: see detect_file
+    :return: the summary, also written to SUMMARY_FILENAME in the output dir
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+
+    results = []
+    start = time.perf_counter()
+    with Pool(processes=workers, initializer=_init_worker, initargs=(verbose,)) as pool:
+        if thresholds is None and share_thresholds:
+            thresholds = shared_thresholds(pool, paths, gray_decode, decode_scale)
+            logger.info("Shared thresholds:", thresholds)
+
+        root = input_root(paths)
+        jobs = [(path, os.path.join(output_dir, output_subdir(path, root)), tile_size, overlap, profile,
+                 catalog_format, render, thresholds, cache_dir, cache_size, gray_decode, decode_scale)
+                for path in paths]
+        for result in pool.imap_unordered(_detect_job, jobs):
+            results.append(result)
+            if "error" in result:
+                logger.error(result["input"], result["error"])
+            else:
+                logger.info("Done:", result["input"])
+    elapsed = time.perf_counter() - start
+    results.sort(key=lambda r: r["input"])
+
+    num_failed = sum(1 for r in results if "error" in r)
+    summary = {
+        "num_images": len(results),
+        "num_failed": num_failed,
+        "num_cached": sum(1 for r in results if r.get("cached")),
+        "workers": workers,
+        "thresholds": list(thresholds) if thresholds is not None else None,
+        "seconds": elapsed,
+        "images_per_second": len(results) / elapsed if elapsed > 0 else 0.0,
+        "images": results,
+    }
+
+    with open(os.path.join(output_dir, SUMMARY_FILENAME), 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+    return summary
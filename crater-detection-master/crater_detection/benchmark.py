@@ -0,0 +1,181 @@
+"""
+Benchmarks of the detection pipeline on generated crater fields.
+Results are written as JSON so runs from two commits can be compared.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Callable, Dict, List
+
+import cv2 as cv
+import numpy as np
+import scipy
+
+from . import __version__
+from . import detector, generator
+from .detector import hough
+from .models import CraterField
+from .util import logger
+
+# Defaults
+Sizes = [1024, 2048, 4096, 8192, 16384]
+# Craters per 1024 x 1024 px, scaled with the field area
+CraterDensities = [350, generator.NCraters]
+SunAngles = [0, 45]
+Repeat = 3
+# Hough over larger fields takes minutes per run, skip it by default
+HoughMaxSize = 2048
+
+STAGES = ["get_peak_values", "detect", "CraterField.stats", "hough.find_circles", "hough.dedup_circles"]
+
+
+def time_call(func: Callable, repeat: int = Repeat) -> Dict:
+    """
+    :return: best / mean / all wall times in seconds, and the result of the last call
+    """
+    runs = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+
+    return {
+        "best": min(runs),
+        "mean": float(np.mean(runs)),
+        "runs": runs,
+        "result": result,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> Dict:
+    return {
+        "version": __version__,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "opencv": cv.__version__,
+        "machine": platform.machine(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run_case(size: int, density: int, sun_angle: float,
+             repeat: int = Repeat, hough_max_size: int = HoughMaxSize, rand_seed: int = 1) -> Dict:
+    """
+    Times every stage on one generated field.
+    """
+    num_craters = int(density * (size / 1024) ** 2)
+    input_image, _ = generator.generate(num_craters=num_craters,
+                                        width=size,
+                                        height=size,
+                                        sun_angle=sun_angle,
+                                        rand_seed=rand_seed)
+    bw_img = cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+
+    timings = {
+        "get_peak_values": time_call(lambda: detector.get_peak_values(bw_img), repeat),
+        "detect": time_call(lambda: detector.detect(input_image), repeat),
+    }
+    _, crater_field = timings["detect"]["result"]
+    # Rebuilds the columns each run, as a caller of detect would
+    timings["CraterField.stats"] = time_call(
+        lambda: CraterField(crater_field.width, crater_field.height, crater_field.craters).stats(), repeat)
+
+    if size <= hough_max_size:
+        timings["hough.find_circles"] = time_call(lambda: hough.find_circles(bw_img), repeat)
+        all_circles = hough.find_all_circles(bw_img)
+        min_dist = hough.get_min_dup_dist(size, size)
+        timings["hough.dedup_circles"] = time_call(lambda: hough.dedup_circles(all_circles, min_dist), repeat)
+
+    for timing in timings.values():
+        del timing["result"]
+
+    return {
+        "size": size,
+        "num_craters": num_craters,
+        "sun_angle": sun_angle,
+        "num_detected": len(crater_field),
+        "timings": timings,
+    }
+
+
+def run_benchmarks(sizes: List[int] = None,
+                   densities: List[int] = None,
+                   sun_angles: List[float] = None,
+                   repeat: int = Repeat,
+                   hough_max_size: int = HoughMaxSize) -> Dict:
+    sizes = sizes or Sizes
+    densities = densities or CraterDensities
+    sun_angles = sun_angles if sun_angles is not None else SunAngles
+
+    cases = []
+    for size in sizes:
+        for density in densities:
+            for sun_angle in sun_angles:
+                logger.info("Benchmarking %i x %i, %i craters / Mpx, sun at %s degrees" %
+                            (size, size, density, sun_angle))
+                case = run_case(size, density, sun_angle, repeat=repeat, hough_max_size=hough_max_size)
+                for stage, timing in case["timings"].items():
+                    logger.debug("%s: %.4fs" % (stage, timing["best"]))
+                cases.append(case)
+
+    return {
+        "environment": environment(),
+        "repeat": repeat,
+        "cases": cases,
+    }
+
+
+def case_key(case: Dict) -> tuple:
+    return case["size"], case["num_craters"], case["sun_angle"]
+
+
+def compare(baseline: Dict, current: Dict) -> List[Dict]:
+    """
+    Matches cases between two benchmark results.
+    :return: per case and stage, the best times and current / baseline ratio (< 1 is faster)
+    """
+    baseline_cases = {case_key(case): case for case in baseline["cases"]}
+    rows = []
+    for case in current["cases"]:
+        base_case = baseline_cases.get(case_key(case))
+        if base_case is None:
+            continue
+        for stage in STAGES:
+            if stage not in case["timings"] or stage not in base_case["timings"]:
+                continue
+            base_time = base_case["timings"][stage]["best"]
+            cur_time = case["timings"][stage]["best"]
+            rows.append({
+                "size": case["size"],
+                "num_craters": case["num_craters"],
+                "sun_angle": case["sun_angle"],
+                "stage": stage,
+                "baseline": base_time,
+                "current": cur_time,
+                "ratio": cur_time / base_time if base_time > 0 else np.inf,
+            })
+    return rows
+
+
+def load_results(filename: str) -> Dict:
+    with open(filename) as results_file:
+        return json.load(results_file)
+
+
+def save_results(results: Dict, filename: str):
+    with open(filename, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
@@ -0,0 +1,280 @@
+"""
+On disk cache of detection results, keyed by the image's content, the detector parameters, the package version
+and the source of the modules that decode, detect and draw, so unchanged images aren't decoded or detected again,
+and entries made by other detection code are never served.
+
+Each entry is a directory named <image digest>-<parameters digest> holding the catalog (float64 npz),
+optionally the overlay, and a meta.json. An entry's modification time is its last use,
+the least recently used entries are evicted once the cache grows past its size limit.
+Each DetectionCache keeps a running estimate of the cache's size rather than listing every entry on each put,
+and evicts down to EvictFraction of the limit, so the entries are only listed again after that much more is put.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from . import __version__
+from . import catalog, image_io
+from .models import CraterField
+from .util import logger
+
+__all__ = ["DetectionCache", "file_digest", "file_signature", "detection_params", "write_overlay"]
+
+# Defaults
+MaxBytes = 1024 ** 3
+# Eviction frees the cache down to this fraction of its limit
+EvictFraction = 0.9
+
+CATALOG_FILENAME = 'catalog.npz'
+META_FILENAME = 'meta.json'
+OVERLAY_NAME = 'overlay'
+# Extensions of the same image format
+FORMAT_ALIASES = {'.jpeg': '.jpg', '.jpe': '.jpg', '.tiff': '.tif'}
+# Modules and packages, relative to this package, whose code changes the cached catalogs and overlays
+DETECTION_SOURCES = ('detector', 'models', 'image_io.py', 'raster.py', 'catalog.py', 'overlay.py')
+
+
+def file_digest(path: str, chunk_size: int = 1024 ** 2) -> str:
+    """
+    :return: SHA-256 of the file's bytes, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def code_digest() -> str:
+    """
+    :return: SHA-256 of the DETECTION_SOURCES' python files, read once per process
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    filenames = []
+    for source in DETECTION_SOURCES:
+        path = os.path.join(package_dir, source)
+        if os.path.isdir(path):
+            filenames.extend(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.py'))
+        else:
+            filenames.append(path)
+
+    digest = hashlib.sha256()
+    for filename in sorted(filenames):
+        digest.update(os.path.relpath(filename, package_dir).encode('utf-8'))
+        digest.update(file_digest(filename).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def file_signature(path: str) -> str:
+    """
+    Identifies a file without reading it, for rasters too large to hash: a rewrite changes its size or mtime.
+    :return: SHA-256 of the file's absolute path, size and modification time
+    """
+    stat = os.stat(path)
+    key = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def params_digest(params: Dict) -> str:
+    """
+    :param params: detector parameters, JSON serializable
+    :return: SHA-256 of the parameters, the package version and the detection code
+    """
+    key = json.dumps({"version": __version__, "code": code_digest(), "params": params}, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def detection_params(tile_size: int = None, overlap: int = None, thresholds: Tuple[int, int] = None,
+                     gray_decode: bool = False, decode_scale: int = 1, coarse_levels: int = None,
+                     simplify_epsilon: float = None, method: str = 'contour', confirmed_only: bool = False) -> Dict:
+    """
+    The detector arguments that change the craters found, part of the key.
+    """
+    return {
+        "tile_size": tile_size,
+        "tile_overlap": overlap if tile_size is not None else None,
+        "thresholds": list(thresholds) if thresholds is not None else None,
+        "gray_decode": gray_decode,
+        "decode_scale": decode_scale,
+        "coarse_levels": coarse_levels,
+        "simplify_epsilon": simplify_epsilon,
+        "method": method,
+        "confirmed_only": confirmed_only,
+    }
+
+
+def image_format(filename: str) -> str:
+    """
+    :return: the file's lowercase extension, the same for every extension of a format
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    return FORMAT_ALIASES.get(extension, extension)
+
+
+def write_overlay(cached_filename: str, out_filename: str):
+    """
+    Copies a cached overlay to out_filename, re-encoded if out_filename's extension is of another format.
+    """
+    if image_format(cached_filename) == image_format(out_filename):
+        shutil.copyfile(cached_filename, out_filename)
+    else:
+        image_io.write_image(out_filename, image_io.read_image(cached_filename))
+
+
+def dir_size(path: str) -> int:
+    size = 0
+    for name in os.listdir(path):
+        try:
+            size += os.path.getsize(os.path.join(path, name))
+        except OSError:
+            pass
+    return size
+
+
+class DetectionCache:
+    """
+    Safe to share between processes: entries are written to a temporary directory and renamed into place,
+    and entries removed by another process are skipped.
+    """
+    def __init__(self, directory: str, max_bytes: int = MaxBytes, evict_fraction: float = EvictFraction):
+        """
+        :param directory: created if it doesn't exist
+        :param max_bytes: a put taking the cache past this evicts it
+        :param evict_fraction: of max_bytes, what a put past it evicts down to
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evict_fraction = evict_fraction
+        # Bytes in the cache, measured on the first put and after each eviction, then added to by puts.
+        # Puts from other processes aren't counted until the next eviction measures the cache again
+        self._size_estimate = None
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, image_digest: str, params: Dict) -> str:
+        return "%s-%s" % (image_digest, params_digest(params))
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str, overlay: bool = False) -> Tuple[CraterField, str]:
+        """
+        :param key: from key()
+        :param overlay: whether the overlay is needed, an entry without one is then a miss
+        :return: the crater field and the cached overlay's filename (None if not stored), or None on a miss
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, META_FILENAME)) as meta_file:
+                meta = json.load(meta_file)
+            crater_field = catalog.read_catalog(os.path.join(entry_dir, CATALOG_FILENAME))
+            # Marks it as recently used
+            os.utime(entry_dir)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        overlay_filename = None
+        if meta.get("overlay") is not None:
+            overlay_filename = os.path.join(entry_dir, meta["overlay"])
+        if overlay and overlay_filename is None:
+            return None
+        return crater_field, overlay_filename
+
+    def put(self, key: str, crater_field: CraterField, overlay_filename: str = None):
+        """
+        :param key: from key()
+        :param crater_field:
+        :param overlay_filename: an overlay already written, copied into the entry
+        """
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            catalog.write_catalog(crater_field, os.path.join(tmp_dir, CATALOG_FILENAME), dtype=np.float64)
+
+            meta = {"version": __version__, "created": time.time(), "overlay": None}
+            if overlay_filename is not None:
+                meta["overlay"] = OVERLAY_NAME + os.path.splitext(overlay_filename)[1]
+                shutil.copyfile(overlay_filename, os.path.join(tmp_dir, meta["overlay"]))
+            with open(os.path.join(tmp_dir, META_FILENAME), 'w') as meta_file:
+                json.dump(meta, meta_file)
+            entry_bytes = dir_size(tmp_dir)
+
+            entry_dir = self._entry_dir(key)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process put the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            entry_bytes = 0
+
+        if self._size_estimate is None:
+            self._size_estimate = self.size()
+        else:
+            self._size_estimate += entry_bytes
+        if self._size_estimate > self.max_bytes:
+            self.evict(int(self.max_bytes * self.evict_fraction))
+
+    def entries(self) -> List[Dict]:
+        """
+        :return: key, size and last use of every entry, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            entry_dir = self._entry_dir(name)
+            if name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            try:
+                entries.append({"key": name, "bytes": dir_size(entry_dir), "last_used": os.path.getmtime(entry_dir)})
+            except OSError:
+                continue
+        entries.sort(key=lambda e: e["last_used"])
+        return entries
+
+    def size(self) -> int:
+        return sum(e["bytes"] for e in self.entries())
+
+    def evict(self, max_bytes: int = None) -> int:
+        """
+        Removes the least recently used entries until the cache fits.
+        :param max_bytes: defaults to the cache's limit
+        :return: number of entries removed
+        """
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        entries = self.entries()
+        total = sum(e["bytes"] for e in entries)
+        removed = 0
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(self._entry_dir(entry["key"]), ignore_errors=True)
+            total -= entry["bytes"]
+            removed += 1
+        self._size_estimate = total
+        if removed > 0:
+            logger.debug("Evicted %i cache entries" % removed)
+        return removed
+
+    def invalidate(self, image_digest: str) -> int:
+        """
+        Removes the entries of an image, under every set of parameters.
+        :return: number of entries removed
+        """
+        removed = 0
+        for entry in self.entries():
+            if entry["key"].startswith(image_digest + '-'):
+                shutil.rmtree(self._entry_dir(entry["key"]), ignore_errors=True)
+                removed += 1
+        self._size_estimate = None
+        return removed
+
+    def clear(self) -> int:
+        """
+        :return: number of entries removed
+        """
+        return self.evict(max_bytes=0)
@@ -0,0 +1,285 @@
+"""
+Crater catalogs: the per crater values of a CraterField, without contours or an overlay image.
+
+Formats, picked by extension:
+- .csv, one row per crater with a header
+- .jsonl, one JSON object per crater
+- .npz, float32 (by default) columns plus the field size
+- .sqlite, a craters table with a column per value, and a field table with the size
+
+Catalogs can be written all at once from a field, or streamed through a sink a chunk of craters at a time
+(e.g. per tile), which keeps only running stats in memory.
+"""
+import csv
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+from typing import Dict
+
+import numpy as np
+
+from .models import CraterField
+
+__all__ = ["write_catalog", "read_catalog", "open_sink", "CatalogSink", "RunningStats", "CATALOG_FORMATS"]
+
+CATALOG_FORMATS = ('csv', 'jsonl', 'npz', 'sqlite')
+
+
+def get_format(filename: str, fmt: str = None) -> str:
+    fmt = fmt or os.path.splitext(filename)[1].lstrip('.').lower()
+    if fmt not in CATALOG_FORMATS:
+        raise ValueError("Unknown catalog format '%s', use one of: %s" % (fmt, ", ".join(CATALOG_FORMATS)))
+    return fmt
+
+
+class RunningStats:
+    """
+    CraterField.stats, accumulated a chunk of craters at a time.
+    """
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.num_craters = 0
+        self.rad_sum = 0.0
+        self.min_rad = np.inf
+        self.max_rad = -np.inf
+        self.sun_angle_sum = 0.0
+        self.min_sun_angle = np.inf
+        self.max_sun_angle = -np.inf
+
+    def add(self, columns: Dict[str, np.ndarray]):
+        rads, angles = columns["radius"], columns["sun_angle"]
+        if len(rads) == 0:
+            return
+        self.num_craters += len(rads)
+        self.rad_sum += float(np.sum(rads))
+        self.min_rad = min(self.min_rad, float(np.min(rads)))
+        self.max_rad = max(self.max_rad, float(np.max(rads)))
+        self.sun_angle_sum += float(np.sum(angles))
+        self.min_sun_angle = min(self.min_sun_angle, float(np.min(angles)))
+        self.max_sun_angle = max(self.max_sun_angle, float(np.max(angles)))
+
+    def stats(self) -> Dict:
+        """
+        :return: the same keys as CraterField.stats
+        """
+        if self.num_craters == 0:
+            mean_rad = max_rad = min_rad = np.nan
+            mean_sun_angle = max_sun_angle = min_sun_angle = np.nan
+        else:
+            mean_rad, max_rad, min_rad = self.rad_sum / self.num_craters, self.max_rad, self.min_rad
+            mean_sun_angle = self.sun_angle_sum / self.num_craters
+            max_sun_angle, min_sun_angle = self.max_sun_angle, self.min_sun_angle
+
+        return {
+            "width": self.width,
+            "height": self.height,
+            "num_craters": self.num_craters,
+            "mean_rad": mean_rad,
+            "max_rad": max_rad,
+            "min_rad": min_rad,
+            "sun_angle": mean_sun_angle,
+            "min_sun_angle": min_sun_angle,
+            "max_sun_angle": max_sun_angle,
+            "min_sun_angle_degrees": np.rad2deg(min_sun_angle),
+            "max_sun_angle_degrees": np.rad2deg(max_sun_angle),
+            "sun_angle_degrees": np.rad2deg(mean_sun_angle),
+        }
+
+
+class CatalogSink:
+    """
+    Writes craters as they're found. Each format subclasses _write_columns, and _finish if it needs to.
+    """
+    def __init__(self, filename: str, width: int, height: int):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.running_stats = RunningStats(width, height)
+
+    def write(self, crater_field: CraterField):
+        """
+        :param crater_field: craters to add, in catalog coordinates, only their columns are used
+        """
+        self.write_columns(crater_field.columns)
+
+    def write_columns(self, columns: Dict[str, np.ndarray]):
+        """
+        :param columns: name => array for every name in CraterField.COLUMNS
+        """
+        columns = {name: np.asarray(columns[name], dtype=np.float64) for name in CraterField.COLUMNS}
+        self.running_stats.add(columns)
+        if len(columns["x"]) > 0:
+            self._write_columns(columns)
+
+    def stats(self) -> Dict:
+        return self.running_stats.stats()
+
+    def close(self):
+        self._finish()
+
+    def _write_columns(self, columns: Dict[str, np.ndarray]):
+        raise NotImplementedError
+
+    def _finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvSink(CatalogSink):
+    def __init__(self, filename: str, width: int, height: int):
+        super().__init__(filename, width, height)
+        self.file = open(filename, 'w')
+        self.file.write(",".join(CraterField.COLUMNS) + '\n')
+
+    def _write_columns(self, columns):
+        np.savetxt(self.file, np.column_stack([columns[name] for name in CraterField.COLUMNS]),
+                   fmt='%.9g', delimiter=',')
+
+    def _finish(self):
+        self.file.close()
+
+
+class JsonLinesSink(CatalogSink):
+    def __init__(self, filename: str, width: int, height: int):
+        super().__init__(filename, width, height)
+        self.file = open(filename, 'w')
+
+    def _write_columns(self, columns):
+        for row in zip(*(columns[name].tolist() for name in CraterField.COLUMNS)):
+            self.file.write(json.dumps(dict(zip(CraterField.COLUMNS, row))))
+            self.file.write('\n')
+
+    def _finish(self):
+        self.file.close()
+
+
+class NpzSink(CatalogSink):
+    """
+    Each column is appended to a file of its own, and the columns are copied into the npz when it's closed.
+    """
+    def __init__(self, filename: str, width: int, height: int, dtype=np.float32):
+        super().__init__(filename, width, height)
+        self.dtype = np.dtype(dtype)
+        self.spool_dir = tempfile.mkdtemp(prefix='catalog-', dir=os.path.dirname(os.path.abspath(filename)))
+        self.column_files = {name: open(os.path.join(self.spool_dir, name), 'wb') for name in CraterField.COLUMNS}
+
+    def _write_columns(self, columns):
+        for name, column_file in self.column_files.items():
+            column_file.write(columns[name].astype(self.dtype).tobytes())
+
+    def _finish(self):
+        for column_file in self.column_files.values():
+            column_file.close()
+        try:
+            with zipfile.ZipFile(self.filename, 'w', allowZip64=True) as npz:
+                for name, value in (("width", self.width), ("height", self.height)):
+                    with npz.open(name + '.npy', 'w') as entry:
+                        np.lib.format.write_array(entry, np.asarray(value))
+                for name in CraterField.COLUMNS:
+                    self._copy_column(npz, name)
+        finally:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def _copy_column(self, npz: zipfile.ZipFile, name: str):
+        path = os.path.join(self.spool_dir, name)
+        num = os.path.getsize(path) // self.dtype.itemsize
+        with npz.open(name + '.npy', 'w', force_zip64=True) as entry, open(path, 'rb') as column_file:
+            header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (num,)}
+            np.lib.format.write_array_header_1_0(entry, header)
+            shutil.copyfileobj(column_file, entry)
+
+
+class SqliteSink(CatalogSink):
+    def __init__(self, filename: str, width: int, height: int):
+        super().__init__(filename, width, height)
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE field (width INTEGER, height INTEGER)")
+        self.connection.execute("INSERT INTO field VALUES (?, ?)", (width, height))
+        self.connection.execute("CREATE TABLE craters (%s)" % ", ".join(n + " REAL" for n in CraterField.COLUMNS))
+
+    def _write_columns(self, columns):
+        rows = zip(*(columns[name].tolist() for name in CraterField.COLUMNS))
+        self.connection.executemany("INSERT INTO craters VALUES (%s)" % ", ".join("?" * len(CraterField.COLUMNS)),
+                                    rows)
+        # Each chunk is its own transaction, so the journal stays small
+        self.connection.commit()
+
+    def _finish(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def open_sink(filename: str, width: int, height: int, fmt: str = None, dtype=np.float32) -> CatalogSink:
+    """
+    :param filename:
+    :param width: of the field, in px
+    :param height: of the field, in px
+    :param fmt: one of CATALOG_FORMATS, from the extension if not given
+    :param dtype: of the npz columns
+    :return: a sink to write craters to, close it (or use it as a context manager) to finish the file
+    """
+    fmt = get_format(filename, fmt)
+    if fmt == 'csv':
+        return CsvSink(filename, width, height)
+    if fmt == 'jsonl':
+        return JsonLinesSink(filename, width, height)
+    if fmt == 'npz':
+        return NpzSink(filename, width, height, dtype=dtype)
+    return SqliteSink(filename, width, height)
+
+
+def write_catalog(crater_field: CraterField, filename: str, fmt: str = None, dtype=np.float32):
+    """
+    :param crater_field:
+    :param filename:
+    :param fmt: one of CATALOG_FORMATS, from the extension if not given
+    :param dtype: of the npz columns
+    """
+    with open_sink(filename, crater_field.width, crater_field.height, fmt=fmt, dtype=dtype) as sink:
+        sink.write(crater_field)
+
+
+def read_catalog(filename: str, fmt: str = None, width: int = None, height: int = None) -> CraterField:
+    """
+    :param filename:
+    :param fmt: one of CATALOG_FORMATS, from the extension if not given
+    :param width: field width for csv / jsonl, which don't store it
+    :param height: field height for csv / jsonl
+    :return: a field without Crater objects
+    """
+    fmt = get_format(filename, fmt)
+
+    if fmt == 'npz':
+        with np.load(filename) as catalog:
+            columns = {name: catalog[name] for name in CraterField.COLUMNS}
+            return CraterField(int(catalog["width"]), int(catalog["height"]), columns=columns)
+
+    if fmt == 'sqlite':
+        connection = sqlite3.connect(filename)
+        try:
+            width, height = connection.execute("SELECT width, height FROM field").fetchone()
+            rows = connection.execute("SELECT %s FROM craters" % ", ".join(CraterField.COLUMNS)).fetchall()
+        finally:
+            connection.close()
+        values = np.array(rows, dtype=np.float64).reshape(-1, len(CraterField.COLUMNS))
+        return CraterField(width, height, columns={name: values[:, i] for i, name in enumerate(CraterField.COLUMNS)})
+
+    with open(filename) as catalog_file:
+        if fmt == 'csv':
+            rows = list(csv.DictReader(catalog_file))
+        else:
+            rows = [json.loads(line) for line in catalog_file if line.strip()]
+
+    columns = {name: np.array([float(row[name]) for row in rows]) for name in CraterField.COLUMNS}
+    return CraterField(width, height, columns=columns)
@@ -3,27 +3,230 @@ The command line interface
 """
 import argparse
 import os
+import shutil
 import sys
-from scipy import misc
+import tempfile
+from collections import OrderedDict
 from . import __version__
-from . import detector, generator
+from . import image_io
+from .profiling import NULL_PROFILER, StageProfiler
 from .util import logger
 
+# The detection modules (and so OpenCV / scipy) are imported by the commands that use them,
+# so --help and --version don't wait on them
+
+MB = 1024 ** 2
+
+
+def open_mmap_input(args):
+    from . import raster
+
+    input_raster = raster.open_raster(args.input,
+                                      width=args.raw_width,
+                                      height=args.raw_height,
+                                      dtype=args.raw_dtype,
+                                      header_bytes=args.raw_header_bytes)
+    logger.info("Memory mapped %s of %s" % (input_raster.shape, input_raster.dtype))
+    return input_raster
+
+
+def run_mmap_detector(args, profiler=NULL_PROFILER):
+    from .detector import parallel, tiling
+
+    input_raster = open_mmap_input(args)
+    tile_size = args.tile_size if args.tile_size is not None else tiling.TileSize
+    if args.workers is not None:
+        crater_field = parallel.detect_parallel(input_raster, tile_size=tile_size, overlap=args.tile_overlap,
+                                                thresholds=args.thresholds, workers=args.workers,
+                                                verbose=args.debug, profiler=profiler)
+    else:
+        crater_field = tiling.detect_tiled(input_raster, tile_size=tile_size, overlap=args.tile_overlap,
+                                           thresholds=args.thresholds, profiler=profiler)
+
+    # The overlay is full size, so only render it when asked to
+    if args.output is not None and not args.no_overlay:
+        with profiler.stage("render"):
+            output_image = tiling.draw_craters(input_raster, crater_field)
+        with profiler.stage("write"):
+            image_io.write_image(args.output, output_image)
+        logger.info('Done! Saved to:', args.output, color='green')
+
+    return crater_field
+
+
+def run_streaming_detector(args, profiler=NULL_PROFILER):
+    """
+    Detects tile by tile, writing each tile's craters to the catalog as it finishes.
+    """
+    from . import catalog
+    from .detector import parallel, tiling
+
+    if args.catalog is None:
+        logger.error("--stream writes the craters to a --catalog, give one")
+        sys.exit(1)
+    if args.decode_scale > 1:
+        logger.error("--stream works at full size, it can't be used with --decode-scale")
+        sys.exit(1)
+
+    if args.mmap:
+        input_image = open_mmap_input(args)
+    else:
+        with profiler.stage("read"):
+            input_image = image_io.read_image(args.input, gray=args.gray_decode)
+    if not args.no_overlay:
+        logger.info("No overlay is drawn when streaming, the craters aren't kept")
+
+    height, width = input_image.shape[:2]
+    tile_size = args.tile_size if args.tile_size is not None else tiling.TileSize
+    with catalog.open_sink(args.catalog, width, height) as sink:
+        if args.workers is not None:
+            stats = parallel.stream_parallel(input_image, sink, tile_size=tile_size, overlap=args.tile_overlap,
+                                             thresholds=args.thresholds, workers=args.workers,
+                                             verbose=args.debug, profiler=profiler)
+        else:
+            stats = tiling.stream_tiled(input_image, sink, tile_size=tile_size, overlap=args.tile_overlap,
+                                        thresholds=args.thresholds, profiler=profiler)
+    logger.info('Saved catalog to:', args.catalog, color='green')
+    return stats
+
 
 def run_detector(args):
-    _, image_filename = os.path.split(args.input)
-    input_image = misc.imread(args.input)
-    output_image, crater_field = detector.detect(input_image)
+    from . import cache, detector, overlay
+    from .detector import fused, multiscale, parallel, tiling
+
+    profiler = StageProfiler() if args.profile is not None else NULL_PROFILER
 
+    whole_image = not (args.stream or args.mmap or args.tile_size is not None or args.coarse_levels is not None)
+    if args.method != 'contour' and not whole_image:
+        logger.error("--method %s detects in the whole image, it can't be used with --tile-size, --mmap, "
+                     "--stream or --coarse-levels" % args.method)
+        sys.exit(1)
+    if args.workers is not None and not (args.stream or args.mmap or args.tile_size is not None):
+        logger.error("-j/--workers splits the image into tiles, it needs --tile-size, --mmap or --stream")
+        sys.exit(1)
+
+    if args.stream:
+        log_stats(run_streaming_detector(args, profiler))
+        write_profile(args, profiler)
+        return
+
+    if args.mmap:
+        crater_field = run_mmap_detector(args, profiler)
+        write_crater_catalog(args, crater_field, profiler)
+        log_crater_stats(crater_field)
+        write_profile(args, profiler)
+        return
+
+    _, image_filename = os.path.split(args.input)
+    render = not args.no_overlay
     if args.output is not None:
         out_filename = args.output
     else:
         out_filename = f'output-{image_filename}'
 
-    misc.imsave(out_filename, output_image)
-    logger.info('Done! Saved to:', out_filename, color='green')
+    detection_cache = cache_key = cached = None
+    if args.cache is not None:
+        with profiler.stage("cache_lookup"):
+            detection_cache = cache.DetectionCache(args.cache, max_bytes=int(args.cache_size * MB))
+            params = cache.detection_params(args.tile_size, args.tile_overlap, args.thresholds,
+                                            gray_decode=args.gray_decode, decode_scale=args.decode_scale,
+                                            coarse_levels=args.coarse_levels, simplify_epsilon=args.simplify,
+                                            method=args.method, confirmed_only=args.confirmed_only)
+            cache_key = detection_cache.key(cache.file_digest(args.input), params)
+            cached = detection_cache.get(cache_key, overlay=render)
+
+    output_image = None
+    if cached is not None:
+        logger.info("Cache hit:", cache_key)
+        crater_field, cached_overlay = cached
+        if render:
+            with profiler.stage("write"):
+                cache.write_overlay(cached_overlay, out_filename)
+            logger.info('Done! Saved to:', out_filename, color='green')
+    else:
+        with profiler.stage("read"):
+            input_image = image_io.read_image(args.input, gray=args.gray_decode, scale=args.decode_scale)
+        if args.tile_size is not None and args.workers is not None:
+            crater_field = parallel.detect_parallel(input_image, tile_size=args.tile_size, overlap=args.tile_overlap,
+                                                    thresholds=args.thresholds, workers=args.workers,
+                                                    verbose=args.debug, profiler=profiler)
+            if render:
+                with profiler.stage("render"):
+                    output_image = tiling.draw_craters(input_image, crater_field)
+        elif args.tile_size is not None:
+            crater_field = tiling.detect_tiled(input_image, tile_size=args.tile_size, overlap=args.tile_overlap,
+                                               thresholds=args.thresholds, profiler=profiler)
+            if render:
+                with profiler.stage("render"):
+                    output_image = tiling.draw_craters(input_image, crater_field)
+        elif args.coarse_levels is not None:
+            crater_field = multiscale.detect_multiscale(input_image, levels=args.coarse_levels,
+                                                        thresholds=args.thresholds, profiler=profiler)
+            if render:
+                with profiler.stage("render"):
+                    output_image = tiling.draw_craters(input_image, crater_field)
+        elif args.method != 'contour':
+            crater_field = fused.detect_method(input_image, method=args.method, thresholds=args.thresholds,
+                                               profiler=profiler, confirmed_only=args.confirmed_only,
+                                               simplify_epsilon=args.simplify)
+            if render:
+                with profiler.stage("render"):
+                    output_image = overlay.render_circles(input_image, crater_field)
+        else:
+            output_image, crater_field = detector.detect(input_image, thresholds=args.thresholds,
+                                                         profiler=profiler, render=render,
+                                                         simplify_epsilon=args.simplify)
+
+        if render:
+            with profiler.stage("write"):
+                image_io.write_image(out_filename, output_image)
+            logger.info('Done! Saved to:', out_filename, color='green')
+
+        if args.decode_scale > 1:
+            # Back to the coordinates of the full image, the overlay stays at the decoded size
+            crater_field = crater_field.scaled(args.decode_scale)
+
+        if detection_cache is not None:
+            with profiler.stage("cache_put"):
+                detection_cache.put(cache_key, crater_field, out_filename if render else None)
+
+    write_crater_catalog(args, crater_field, profiler)
+    log_crater_stats(crater_field)
+    write_profile(args, profiler)
+
+    if args.display_output and render:
+        image_io.show_image(output_image if output_image is not None else image_io.read_image(out_filename))
+
+
+def write_crater_catalog(args, crater_field, profiler=NULL_PROFILER):
+    if args.catalog is None:
+        return
+
+    from . import catalog
+    with profiler.stage("write_catalog"):
+        catalog.write_catalog(crater_field, args.catalog)
+    logger.info('Saved catalog to:', args.catalog, color='green')
+
+
+def write_profile(args, profiler):
+    if args.profile is None:
+        return
+
+    profiler.stop()
+    profile_json = profiler.to_json(image=args.input)
+    if args.profile == '-':
+        print(profile_json)
+    else:
+        with open(args.profile, 'w') as profile_file:
+            profile_file.write(profile_json)
+        logger.info('Saved profile to:', args.profile)
+
+
+def log_crater_stats(crater_field):
+    log_stats(crater_field.stats())
+
 
-    stats = crater_field.stats()
+def log_stats(stats):
     logger.info("Crater stats:", color='green')
     logger.info("Width:", stats["width"])
     logger.info("Height:", stats["height"])
@@ -33,9 +236,6 @@ def run_detector(args):
     logger.info("Average Radius:", stats["mean_rad"])
     logger.info("Average Sun Angle (degrees):", stats["sun_angle_degrees"])
 
-    if args.display_output:
-        misc.imshow(output_image)
-
 
 def detector_error_handler(ex, args):
     if type(ex) == FileNotFoundError:
@@ -48,7 +248,177 @@ def detector_error_handler(ex, args):
         sys.exit(1)
 
 
+def run_batch_detector(args):
+    from . import batch
+
+    paths = batch.find_images(args.input)
+    if len(paths) == 0:
+        logger.error("No images found for:", args.input)
+        sys.exit(1)
+
+    output_dir = args.output if args.output is not None else 'outputs'
+    logger.info("Detecting %i images with %s workers" % (len(paths), args.workers or 'all'))
+    summary = batch.detect_batch(paths,
+                                 output_dir,
+                                 workers=args.workers,
+                                 tile_size=args.tile_size,
+                                 overlap=args.tile_overlap,
+                                 verbose=args.debug,
+                                 profile=args.profile,
+                                 catalog_format=args.catalog_format,
+                                 render=not args.no_overlay,
+                                 thresholds=args.thresholds,
+                                 share_thresholds=args.share_thresholds,
+                                 cache_dir=args.cache,
+                                 cache_size=int(args.cache_size * MB),
+                                 gray_decode=args.gray_decode,
+                                 decode_scale=args.decode_scale)
+
+    logger.info('Done! Saved to:', output_dir, color='green')
+    logger.info("Images:", summary["num_images"])
+    logger.info("Failed:", summary["num_failed"])
+    logger.info("Cached:", summary["num_cached"])
+    logger.info("Seconds:", summary["seconds"])
+    logger.info("Images per second:", summary["images_per_second"])
+
+    if summary["num_failed"] > 0:
+        sys.exit(1)
+
+
+def run_cache(args):
+    from . import cache
+
+    detection_cache = cache.DetectionCache(args.directory)
+    if args.clear:
+        logger.info("Removed %i entries" % detection_cache.clear(), color='green')
+    for path in args.invalidate or []:
+        removed = detection_cache.invalidate(cache.file_digest(path))
+        logger.info("Removed %i entries of %s" % (removed, path), color='green')
+    if args.max_size is not None:
+        removed = detection_cache.evict(int(args.max_size * MB))
+        logger.info("Evicted %i entries" % removed, color='green')
+
+    # Always shown, it's the point of asking
+    logger.set_enabled(True)
+    entries = detection_cache.entries()
+    logger.info("Cache:", args.directory)
+    logger.info("Entries:", len(entries))
+    logger.info("Size (MB): %.2f" % (sum(e["bytes"] for e in entries) / MB))
+
+
+def cache_error_handler(ex, args):
+    if type(ex) == FileNotFoundError:
+        logger.error("Can't read: " + ex.filename)
+        sys.exit(1)
+    logger.error('Error managing the cache:', args.directory)
+    sys.exit(1)
+
+
+def batch_error_handler(ex, args):
+    logger.error('Error in batch:' + args.input)
+    sys.exit(1)
+
+
+def run_server(args):
+    from . import serve
+
+    # stdout carries the responses
+    logger.set_stream(sys.stderr)
+    server = serve.DetectionServer(workers=args.workers, max_pending=args.max_pending, verbose=args.debug)
+    if args.http:
+        serve.serve_http(server, host=args.host, port=args.port)
+    else:
+        logger.info("Reading requests from stdin with %i workers" % server.workers)
+        serve.serve_stdio(server)
+
+
+def server_error_handler(ex, args):
+    if type(ex) == OSError:
+        logger.error("Can't serve on %s:%i: %s" % (args.host, args.port, ex))
+        sys.exit(1)
+    logger.error('Error serving.')
+    sys.exit(1)
+
+
+def run_overlay(args):
+    from . import cache, catalog, overlay
+
+    if args.output is None and args.preview is None and not args.serve:
+        raise ValueError("Give a tiles directory (-o), a --preview file, or --serve")
+
+    if args.mmap:
+        input_image = open_mmap_input(args)
+    else:
+        input_image = image_io.read_image(args.input)
+    height, width = input_image.shape[:2]
+    crater_field = catalog.read_catalog(args.catalog, width=width, height=height)
+    logger.info("Read %i craters from %s" % (len(crater_field), args.catalog))
+
+    if args.preview is not None:
+        image_io.write_image(args.preview, overlay.render_preview(input_image, crater_field, args.preview_size))
+        logger.info('Saved preview to:', args.preview, color='green')
+
+    if args.output is None and not args.serve:
+        return
+
+    # Served tiles without -o are only kept for as long as the server runs
+    tiles_dir = args.output if args.output is not None else tempfile.mkdtemp(prefix='crater-tiles-')
+    try:
+        pyramid = overlay.TilePyramid(input_image, crater_field, tiles_dir, tile_size=args.tile_size,
+                                      source_digest=cache.file_signature(args.input))
+        for zoom in range(min(args.levels, pyramid.max_zoom + 1)):
+            num_tiles = pyramid.render_zoom(zoom)
+            logger.info("Rendered zoom %i (%i tiles)" % (zoom, num_tiles))
+        if args.serve:
+            overlay.serve_tiles(pyramid, host=args.host, port=args.port)
+        else:
+            logger.info('Done! Tiles (zoom 0 to %i) in:' % pyramid.max_zoom, tiles_dir, color='green')
+    finally:
+        if args.output is None:
+            shutil.rmtree(tiles_dir, ignore_errors=True)
+
+
+def overlay_error_handler(ex, args):
+    if type(ex) == FileNotFoundError:
+        logger.error("Can't load file: " + ex.filename)
+        sys.exit(1)
+    if type(ex) == OSError and args.serve:
+        logger.error("Can't serve on %s:%i: %s" % (args.host, args.port, ex))
+        sys.exit(1)
+    if args.debug:
+        raise ex  # For Development
+    logger.error('Error rendering overlay: %s' % ex)
+    sys.exit(1)
+
+
+def run_dataset_generator(args):
+    from . import generator
+
+    output_dir = args.output if args.output is not None else 'craters'
+    fields = generator.generate_dataset(
+        output_dir,
+        args.num_fields,
+        rand_seed=args.rand_seed,
+        workers=args.workers,
+        num_craters=args.num_craters,
+        width=args.width,
+        height=args.height,
+        min_radius=args.min_rad,
+        max_radius=args.max_rad,
+        shadow_factor=args.shadow_factor,
+        alpha=args.alpha,
+        sun_angle=args.angle,
+    )
+    logger.info('Done! Saved %i fields to:' % len(fields), output_dir, color='green')
+
+
 def run_generator(args):
+    from . import generator
+
+    if args.num_fields is not None:
+        run_dataset_generator(args)
+        return
+
     output_image, stats = generator.generate(
         num_craters=args.num_craters,
         width=args.width,
@@ -62,14 +432,14 @@ def run_generator(args):
     )
 
     if args.display_output:
-        misc.imshow(output_image)
+        image_io.show_image(output_image)
 
     if args.output is not None:
         out_filename = args.output
     else:
         out_filename = 'craters.png'
 
-    misc.imsave(out_filename, output_image)
+    image_io.write_image(out_filename, output_image)
     logger.info('Done!', color='green')
 
     logger.info('Generated field stats:')
@@ -91,6 +461,154 @@ def generator_error_handler(ex, args):
     sys.exit(1)
 
 
+def run_benchmark(args):
+    from . import benchmark
+
+    results = benchmark.run_benchmarks(sizes=args.sizes,
+                                       densities=args.num_craters,
+                                       sun_angles=args.angles,
+                                       repeat=args.repeat,
+                                       hough_max_size=args.hough_max_size)
+
+    out_filename = args.output if args.output is not None else 'benchmark.json'
+    benchmark.save_results(results, out_filename)
+    logger.info('Done! Saved to:', out_filename, color='green')
+
+    if args.compare is not None:
+        # Always shown, it's the point of comparing
+        logger.set_enabled(True)
+        baseline = benchmark.load_results(args.compare)
+        logger.info("Compared to", args.compare, "(%s)" % baseline["environment"]["commit"], color='green')
+        for row in benchmark.compare(baseline, results):
+            color = 'green' if row["ratio"] <= 1 else 'red'
+            logger.info("%5i px %7i craters %5s deg  %-20s %9.4fs -> %9.4fs  x%.2f" %
+                        (row["size"], row["num_craters"], row["sun_angle"], row["stage"],
+                         row["baseline"], row["current"], row["ratio"]), color=color)
+
+
+def benchmark_error_handler(ex, args):
+    if type(ex) == FileNotFoundError:
+        logger.error("Can't load benchmark results: " + ex.filename)
+        sys.exit(1)
+    logger.error('Error running benchmarks.')
+    sys.exit(1)
+
+
+def run_evaluation(args):
+    from . import benchmark, evaluation
+
+    results = evaluation.evaluate(configs=args.configs,
+                                  num_fields=args.num_fields,
+                                  size=args.size,
+                                  num_craters=args.num_craters,
+                                  sun_angle=args.angle,
+                                  rand_seed=args.rand_seed,
+                                  repeat=args.repeat,
+                                  hough_max_size=args.hough_max_size,
+                                  max_center_error=args.max_center_error,
+                                  max_radius_error=args.max_radius_error)
+
+    out_filename = args.output if args.output is not None else 'evaluation.json'
+    benchmark.save_results(results, out_filename)
+    logger.info('Done! Saved to:', out_filename, color='green')
+
+    # Always shown, it's the point of evaluating
+    logger.set_enabled(True)
+    logger.info("%-22s %10s %10s %10s %8s" % ("config", "seconds", "precision", "recall", "f1"), color='green')
+    for row in results["summary"]:
+        logger.info("%-22s %10.4f %10.3f %10.3f %8.3f" %
+                    (row["config"], row["mean_seconds"], row["precision"], row["recall"], row["f1"]))
+
+
+def evaluation_error_handler(ex, args):
+    if type(ex) == ValueError:
+        logger.error(str(ex))
+        sys.exit(1)
+    logger.error('Error running the evaluation.')
+    sys.exit(1)
+
+
+def run_autotune(args):
+    from . import autotune, benchmark
+
+    search_space = autotune.SEARCH_SPACES[args.method].copy()
+    for text in args.params or []:
+        name, values = autotune.parse_values(text, search_space)
+        search_space[name] = values
+
+    if args.dataset is not None:
+        fields = autotune.labelled_fields(args.dataset)
+    else:
+        fields = autotune.generated_fields(num_fields=args.num_fields,
+                                           size=args.size,
+                                           num_craters=args.num_craters,
+                                           sun_angle=args.angle,
+                                           rand_seed=args.rand_seed)
+
+    results = autotune.autotune(fields,
+                                method=args.method,
+                                target_recall=args.target_recall,
+                                search_space=search_space,
+                                workers=args.workers,
+                                verbose=args.debug,
+                                max_center_error=args.max_center_error,
+                                max_radius_error=args.max_radius_error)
+
+    out_filename = args.output if args.output is not None else 'autotune.json'
+    benchmark.save_results(results, out_filename)
+    logger.info('Done! Saved to:', out_filename, color='green')
+
+    # Always shown, it's the point of tuning
+    logger.set_enabled(True)
+    best = results["best"]
+    if results["meets_target"]:
+        logger.info("Fastest configuration with a recall of at least %.3f:" % args.target_recall, color='green')
+    else:
+        logger.error("No configuration reaches a recall of %.3f, the highest recall is:" % args.target_recall)
+    for name, value in best["params"].items():
+        logger.info("%-16s %s" % (name, value))
+    logger.info("%.4fs per field, precision %.3f, recall %.3f, f1 %.3f" %
+                (best["seconds"], best["precision"], best["recall"], best["f1"]))
+
+
+def autotune_error_handler(ex, args):
+    if type(ex) == ValueError:
+        logger.error(str(ex))
+        sys.exit(1)
+    if args.debug:
+        raise ex  # For Development
+    logger.error('Error tuning the detector.')
+    sys.exit(1)
+
+
+def add_decode_args(parser):
+    parser.add_argument('--gray-decode',
+                        help="Decode straight to grayscale, skipping the color decode and conversion. "
+                             "Intensities differ slightly from the default color decode.",
+                        dest='gray_decode',
+                        action='store_true')
+    parser.set_defaults(gray_decode=False)
+    parser.add_argument('--decode-scale',
+                        help="Decode at 1 / N of the size, much faster for JPEGs, for previews. "
+                             "Craters are reported at full size, the overlay is at the decoded size.",
+                        choices=image_io.DECODE_SCALES,
+                        default=1,
+                        type=int)
+
+
+def add_raw_args(parser):
+    parser.add_argument('--raw-width', help="Width (px) of a raw input.", default=None, type=int)
+    parser.add_argument('--raw-height', help="Height (px) of a raw input.", default=None, type=int)
+    parser.add_argument('--raw-dtype',
+                        help="Sample type of a raw input, e.g. uint8 or >u2.",
+                        default='uint8',
+                        type=str)
+    parser.add_argument('--raw-header-bytes',
+                        help="Header bytes to skip in a raw input.",
+                        default=0,
+                        type=int)
+
+
 def add_common_args(parser):
     parser.add_argument('-v', '--verbose', help="Printouts?", dest='verbose', action='store_true')
     parser.set_defaults(verbose=False)
@@ -107,6 +625,461 @@ def add_common_args(parser):
                         default=None)
 
 
+def add_detect_args(parser):
+    from . import cache, catalog, raster
+    from .detector import fused, tiling
+
+    parser.add_argument('-i', '--input', help="The input image to detect.", type=str, required=True)
+    parser.add_argument('--tile-size',
+                        help="Detect in tiles of this size (px) to bound memory on large images.",
+                        default=None,
+                        type=int)
+    parser.add_argument('--tile-overlap',
+                        help="Overlap between tiles (px), should exceed the largest crater diameter.",
+                        default=tiling.TileOverlap,
+                        type=int)
+    parser.add_argument('-j', '--workers',
+                        help="Detect the tiles in this many processes sharing the image "
+                             "(needs --tile-size, --mmap or --stream).",
+                        default=None,
+                        type=int)
+    parser.add_argument('--coarse-levels',
+                        help="Detect coarse to fine: pick the regions with anything past the thresholds "
+                             "on an image halved this many times, then detect at full resolution only in them.",
+                        default=None,
+                        type=int)
+    parser.add_argument('--method',
+                        help="contour: paired bright / shadow contours. hough: Hough circles over the whole image "
+                             "(slow). fused: contours, confirmed and refined by Hough only around each crater.",
+                        choices=fused.METHODS,
+                        default=fused.Method,
+                        type=str)
+    parser.add_argument('--confirmed-only',
+                        help="With --method fused, drop the craters Hough doesn't confirm.",
+                        dest='confirmed_only',
+                        action='store_true')
+    parser.set_defaults(confirmed_only=fused.ConfirmedOnly)
+    parser.add_argument('--thresholds',
+                        help="Low and high intensity thresholds, found from the image's peaks if not given.",
+                        nargs=2,
+                        metavar=('LOW', 'HIGH'),
+                        default=None,
+                        type=int)
+    parser.add_argument('--simplify',
+                        help="Keep simplified crater contours, within this many px of the traced ones.",
+                        default=None,
+                        type=float)
+    parser.add_argument('--catalog',
+                        help="Write the craters to this file (" + ", ".join(catalog.CATALOG_FORMATS) + ").",
+                        default=None,
+                        type=str)
+    parser.add_argument('--cache',
+                        help="Directory of cached results, reused for images and parameters seen before.",
+                        default=None,
+                        type=str)
+    parser.add_argument('--cache-size',
+                        help="Largest size of the cache (MB), least recently used results are evicted past it.",
+                        default=cache.MaxBytes / MB,
+                        type=float)
+    parser.add_argument('--no-overlay',
+                        help="Don't draw or save the annotated image.",
+                        dest='no_overlay',
+                        action='store_true')
+    parser.set_defaults(no_overlay=False)
+    parser.add_argument('--profile',
+                        help="Record time and memory per stage as JSON, to this file or stdout.",
+                        nargs='?',
+                        const='-',
+                        default=None,
+                        type=str)
+    parser.add_argument('--mmap',
+                        help="Memory map the input (" + ", ".join(raster.RASTER_EXTENSIONS) + ") "
+                             "and detect in tiles without loading it whole.",
+                        dest='mmap',
+                        action='store_true')
+    parser.set_defaults(mmap=False)
+    parser.add_argument('--stream',
+                        help="Write each tile's craters to the --catalog as it finishes, so memory doesn't grow "
+                             "with the number of craters. Tiles are --tile-size or " + str(tiling.TileSize) + "px.",
+                        dest='stream',
+                        action='store_true')
+    parser.set_defaults(stream=False)
+    add_raw_args(parser)
+
+    add_decode_args(parser)
+    add_common_args(parser)
+
+
+def add_batch_args(parser):
+    from . import cache, catalog
+    from .detector import tiling
+
+    parser.add_argument('-i', '--input', help="A directory or glob of input images.", type=str, required=True)
+    parser.add_argument('-j', '--workers',
+                        help="Number of worker processes, defaults to the number of cores.",
+                        default=None,
+                        type=int)
+    parser.add_argument('--thresholds',
+                        help="Low and high intensity thresholds used for every image.",
+                        nargs=2,
+                        metavar=('LOW', 'HIGH'),
+                        default=None,
+                        type=int)
+    parser.add_argument('--share-thresholds',
+                        help="Find one set of thresholds from all the images (e.g. tiles of a mosaic).",
+                        dest='share_thresholds',
+                        action='store_true')
+    parser.set_defaults(share_thresholds=False)
+    parser.add_argument('--catalog-format',
+                        help="Also write each image's craters as a catalog in this format.",
+                        choices=catalog.CATALOG_FORMATS,
+                        default=None,
+                        type=str)
+    parser.add_argument('--cache',
+                        help="Directory of cached results, reused for images and parameters seen before.",
+                        default=None,
+                        type=str)
+    parser.add_argument('--cache-size',
+                        help="Largest size of the cache (MB), least recently used results are evicted past it.",
+                        default=cache.MaxBytes / MB,
+                        type=float)
+    parser.add_argument('--no-overlay',
+                        help="Don't draw or save the annotated images.",
+                        dest='no_overlay',
+                        action='store_true')
+    parser.set_defaults(no_overlay=False)
+    parser.add_argument('--profile',
+                        help="Record time and memory per stage of each image in the summary.",
+                        dest='profile',
+                        action='store_true')
+    parser.set_defaults(profile=False)
+    parser.add_argument('--tile-size',
+                        help="Detect in tiles of this size (px) to bound memory on large images.",
+                        default=None,
+                        type=int)
+    parser.add_argument('--tile-overlap',
+                        help="Overlap between tiles (px), should exceed the largest crater diameter.",
+                        default=tiling.TileOverlap,
+                        type=int)
+
+    add_decode_args(parser)
+    add_common_args(parser)
+
+
+def add_cache_args(parser):
+    parser.add_argument('directory',
+                        help="The cache directory, as passed to --cache.",
+                        type=str)
+    parser.add_argument('--invalidate',
+                        help="Remove the results of these images, under any parameters.",
+                        nargs='+',
+                        default=None,
+                        type=str)
+    parser.add_argument('--clear',
+                        help="Remove every result.",
+                        dest='clear',
+                        action='store_true')
+    parser.set_defaults(clear=False)
+    parser.add_argument('--max-size',
+                        help="Evict the least recently used results down to this size (MB).",
+                        default=None,
+                        type=float)
+
+    add_common_args(parser)
+
+
+def add_serve_args(parser):
+    from . import serve
+
+    parser.add_argument('--http',
+                        help="Serve POST /detect over HTTP instead of stdin / stdout.",
+                        dest='http',
+                        action='store_true')
+    parser.set_defaults(http=False)
+    parser.add_argument('--host',
+                        help="HTTP host.",
+                        default=serve.Host,
+                        type=str)
+    parser.add_argument('--port',
+                        help="HTTP port.",
+                        default=serve.Port,
+                        type=int)
+    parser.add_argument('-j', '--workers',
+                        help="Number of worker processes, defaults to the number of cores.",
+                        default=None,
+                        type=int)
+    parser.add_argument('--max-pending',
+                        help="Requests in flight at once, %i per worker by default." % serve.PendingPerWorker,
+                        default=None,
+                        type=int)
+
+    add_common_args(parser)
+
+
+def add_overlay_args(parser):
+    from . import catalog, overlay, raster
+
+    parser.add_argument('-i', '--input', help="The image the craters were detected in.", type=str, required=True)
+    parser.add_argument('--catalog',
+                        help="The craters to draw (" + ", ".join(catalog.CATALOG_FORMATS) + ").",
+                        type=str,
+                        required=True)
+    parser.add_argument('--preview',
+                        help="Write a downscaled overlay of the whole image to this file.",
+                        default=None,
+                        type=str)
+    parser.add_argument('--preview-size',
+                        help="Longest side (px) of the preview.",
+                        default=overlay.PreviewSize,
+                        type=int)
+    parser.add_argument('--tile-size',
+                        help="Tile size (px).",
+                        default=overlay.TileSize,
+                        type=int)
+    parser.add_argument('--levels',
+                        help="Render the tiles of the first N zoom levels up front, the rest when they're asked for.",
+                        default=0,
+                        type=int)
+    parser.add_argument('--serve',
+                        help="Serve GET /<zoom>/<x>/<y>.png, rendering tiles the first time they're asked for.",
+                        dest='serve',
+                        action='store_true')
+    parser.set_defaults(serve=False)
+    parser.add_argument('--host',
+                        help="HTTP host.",
+                        default=overlay.Host,
+                        type=str)
+    parser.add_argument('--port',
+                        help="HTTP port.",
+                        default=overlay.Port,
+                        type=int)
+    parser.add_argument('--mmap',
+                        help="Memory map the input (" + ", ".join(raster.RASTER_EXTENSIONS) + "), "
+                             "only the windows under the rendered tiles are read.",
+                        dest='mmap',
+                        action='store_true')
+    parser.set_defaults(mmap=False)
+    add_raw_args(parser)
+
+    add_common_args(parser)
+
+
+def add_generate_args(parser):
+    from . import generator
+
+    parser.add_argument('--width',
+                        help="Output width (px)",
+                        default=generator.FieldX,
+                        type=int)
+    parser.add_argument('--height',
+                        help="Output height (px)",
+                        default=generator.FieldY,
+                        type=int)
+    parser.add_argument('-n', '--num-craters',
+                        help="Number of craters to draw.",
+                        default=generator.NCraters,
+                        type=int)
+    parser.add_argument('--min-rad',
+                        help="Min radius of a crater (px).",
+                        default=generator.MinCrater,
+                        type=int)
+    parser.add_argument('--max-rad',
+                        help="Max radius of a crater (px).",
+                        default=generator.MaxCrater,
+                        type=int)
+    parser.add_argument('--shadow-factor',
+                        help="Shadow factor.",
+                        default=generator.CraterShadowFactor,
+                        type=int)
+    parser.add_argument('-ca', '--alpha',
+                        help="Crater Alpha.",
+                        default=generator.Alpha,
+                        type=int)
+    parser.add_argument('-rs', '--rand-seed',
+                        help="Random seed for the number generator.",
+                        default=None,
+                        type=int)
+    parser.add_argument('-a', '--angle',
+                        help="Angle of sun (degrees).",
+                        default=generator.SunAngle,
+                        type=int)
+    parser.add_argument('--num-fields',
+                        help="Generate this many fields into the output directory, in parallel.",
+                        default=None,
+                        type=int)
+    parser.add_argument('-j', '--workers',
+                        help="Number of worker processes for --num-fields, defaults to the number of cores.",
+                        default=None,
+                        type=int)
+
+    add_common_args(parser)
+
+
+def add_benchmark_args(parser):
+    from . import benchmark
+
+    parser.add_argument('--sizes',
+                        help="Field sizes (px).",
+                        nargs='+',
+                        default=benchmark.Sizes,
+                        type=int)
+    parser.add_argument('-n', '--num-craters',
+                        help="Craters per 1024 x 1024 px, scaled with the field size.",
+                        nargs='+',
+                        default=benchmark.CraterDensities,
+                        type=int)
+    parser.add_argument('-a', '--angles',
+                        help="Sun angles (degrees).",
+                        nargs='+',
+                        default=benchmark.SunAngles,
+                        type=int)
+    parser.add_argument('-r', '--repeat',
+                        help="Runs per stage, the best is reported.",
+                        default=benchmark.Repeat,
+                        type=int)
+    parser.add_argument('--hough-max-size',
+                        help="Largest field size (px) to run the Hough stages on.",
+                        default=benchmark.HoughMaxSize,
+                        type=int)
+    parser.add_argument('-c', '--compare',
+                        help="Results of an earlier run to compare against.",
+                        default=None,
+                        type=str)
+
+    add_common_args(parser)
+
+
+def add_evaluation_args(parser):
+    from . import evaluation, generator
+
+    parser.add_argument('--configs',
+                        help="Detector configurations, defaults to all of them.",
+                        nargs='+',
+                        choices=list(evaluation.CONFIGS.keys()),
+                        default=None,
+                        type=str)
+    parser.add_argument('--num-fields',
+                        help="Generated fields each configuration runs on.",
+                        default=evaluation.NumFields,
+                        type=int)
+    parser.add_argument('--size',
+                        help="Field size (px).",
+                        default=evaluation.FieldSize,
+                        type=int)
+    parser.add_argument('-n', '--num-craters',
+                        help="Craters per field.",
+                        default=generator.NCraters,
+                        type=int)
+    parser.add_argument('-a', '--angle',
+                        help="Sun angle (degrees).",
+                        default=generator.SunAngle,
+                        type=float)
+    parser.add_argument('-rs', '--rand-seed',
+                        help="Random seed for the fields.",
+                        default=1,
+                        type=int)
+    parser.add_argument('-r', '--repeat',
+                        help="Runs per field, the best is reported.",
+                        default=evaluation.Repeat,
+                        type=int)
+    parser.add_argument('--hough-max-size',
+                        help="Largest field size (px) to run the Hough configurations on.",
+                        default=evaluation.HoughMaxSize,
+                        type=int)
+    parser.add_argument('--max-center-error',
+                        help="Largest center offset of a match, as a fraction of the true radius.",
+                        default=evaluation.MaxCenterError,
+                        type=float)
+    parser.add_argument('--max-radius-error',
+                        help="Largest radius error of a match, as a fraction of the true radius.",
+                        default=evaluation.MaxRadiusError,
+                        type=float)
+
+    add_common_args(parser)
+
+
+def add_autotune_args(parser):
+    from . import autotune, evaluation, generator
+
+    parser.add_argument('--method',
+                        help="The detector to tune.",
+                        choices=autotune.METHODS,
+                        default=autotune.Method,
+                        type=str)
+    parser.add_argument('--target-recall',
+                        help="Share of the true craters the configuration has to find.",
+                        default=autotune.TargetRecall,
+                        type=float)
+    parser.add_argument('-p', '--param',
+                        help="Values to try for a parameter, replacing the defaults, e.g. close_size=8,10,12.",
+                        dest='params',
+                        action='append',
+                        metavar='NAME=V1,V2',
+                        default=None,
+                        type=str)
+    parser.add_argument('--dataset',
+                        help="Tune on the images of this directory, each with a truth CSV next to it, "
+                             "rather than generated fields.",
+                        default=None,
+                        type=str)
+    parser.add_argument('-j', '--workers',
+                        help="Number of worker processes, defaults to the number of cores.",
+                        default=None,
+                        type=int)
+    parser.add_argument('--num-fields',
+                        help="Generated fields each trial runs on.",
+                        default=autotune.NumFields,
+                        type=int)
+    parser.add_argument('--size',
+                        help="Field size (px).",
+                        default=autotune.FieldSize,
+                        type=int)
+    parser.add_argument('-n', '--num-craters',
+                        help="Craters per field.",
+                        default=generator.NCraters,
+                        type=int)
+    parser.add_argument('-a', '--angle',
+                        help="Sun angle (degrees).",
+                        default=generator.SunAngle,
+                        type=float)
+    parser.add_argument('-rs', '--rand-seed',
+                        help="Random seed for the fields.",
+                        default=1,
+                        type=int)
+    parser.add_argument('--max-center-error',
+                        help="Largest center offset of a match, as a fraction of the true radius.",
+                        default=evaluation.MaxCenterError,
+                        type=float)
+    parser.add_argument('--max-radius-error',
+                        help="Largest radius error of a match, as a fraction of the true radius.",
+                        default=evaluation.MaxRadiusError,
+                        type=float)
+
+    add_common_args(parser)
+
+
+SUBCOMMANDS = OrderedDict([
+    ('detect', ('To detect craters in an image.',
+                run_detector, detector_error_handler, add_detect_args)),
+    ('detect-batch', ('To detect craters in many images with a pool of processes.',
+                      run_batch_detector, batch_error_handler, add_batch_args)),
+    ('cache', ('To inspect, invalidate or clear a result cache.',
+               run_cache, cache_error_handler, add_cache_args)),
+    ('serve', ('To detect craters in images sent as JSON lines on stdin, or over HTTP, with warm worker processes.',
+               run_server, server_error_handler, add_serve_args)),
+    ('overlay', ('To draw a catalog over its image, as a downscaled preview or as map tiles rendered on demand.',
+                 run_overlay, overlay_error_handler, add_overlay_args)),
+    ('generate', ('To detect craters in an image.',
+                  run_generator, generator_error_handler, add_generate_args)),
+    ('benchmark', ('To time detection on generated fields.',
+                   run_benchmark, benchmark_error_handler, add_benchmark_args)),
+    ('evaluate', ('To score detector configurations against generated fields with known craters.',
+                  run_evaluation, evaluation_error_handler, add_evaluation_args)),
+    ('autotune', ('To search detector parameters for the fastest configuration that reaches a target recall.',
+                  run_autotune, autotune_error_handler, add_autotune_args)),
+])
+
+
 def main():
     """The exported main function
     :return:
@@ -119,56 +1092,14 @@ def main():
     # Sub parsers
     subparsers = parser.add_subparsers(help='Crater functions.')
 
-    detection_parser = subparsers.add_parser('detect', description='To detect craters in an image.')
-    detection_parser.set_defaults(cmd=run_detector)
-    detection_parser.set_defaults(error_handler=detector_error_handler)
-
-    detection_parser.add_argument('-i', '--input', help="The input image to detect.", type=str, required=True)
-
-    add_common_args(detection_parser)
-
-    generate_parser = subparsers.add_parser('generate', description='To detect craters in an image.')
-    generate_parser.set_defaults(cmd=run_generator)
-    generate_parser.set_defaults(error_handler=generator_error_handler)
-
-    generate_parser.add_argument('--width',
-                                 help="Output width (px)",
-                                 default=generator.FieldX,
-                                 type=int)
-    generate_parser.add_argument('--height',
-                                 help="Output height (px)",
-                                 default=generator.FieldY,
-                                 type=int)
-    generate_parser.add_argument('-n', '--num-craters',
-                                 help="Number of craters to draw.",
-                                 default=generator.NCraters,
-                                 type=int)
-    generate_parser.add_argument('--min-rad',
-                                 help="Min radius of a crater (px).",
-                                 default=generator.MinCrater,
-                                 type=int)
-    generate_parser.add_argument('--max-rad',
-                                 help="Max radius of a crater (px).",
-                                 default=generator.MaxCrater,
-                                 type=int)
-    generate_parser.add_argument('--shadow-factor',
-                                 help="Shadow factor.",
-                                 default=generator.CraterShadowFactor,
-                                 type=int)
-    generate_parser.add_argument('-ca', '--alpha',
-                                 help="Crater Alpha.",
-                                 default=generator.Alpha,
-                                 type=int)
-    generate_parser.add_argument('-rs', '--rand-seed',
-                                 help="Random seed for the number generator.",
-                                 default=None,
-                                 type=int)
-    generate_parser.add_argument('-a', '--angle',
-                                 help="Angle of sun (degrees).",
-                                 default=generator.SunAngle,
-                                 type=int)
-
-    add_common_args(generate_parser)
+    # Only the chosen command's arguments are added, as their defaults come from the detection modules
+    chosen = next((arg for arg in sys.argv[1:] if arg in SUBCOMMANDS), None)
+    for name, (description, cmd, error_handler, add_args) in SUBCOMMANDS.items():
+        sub_parser = subparsers.add_parser(name, description=description)
+        sub_parser.set_defaults(cmd=cmd)
+        sub_parser.set_defaults(error_handler=error_handler)
+        if name == chosen:
+            add_args(sub_parser)
 
     args = parser.parse_args()
 
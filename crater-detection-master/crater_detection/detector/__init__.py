@@ -1,99 +1,137 @@
 import numpy as np
 import cv2 as cv
+from functools import lru_cache
 from typing import Tuple, List, Any
-from scipy.spatial import distance
-from scipy.signal import argrelmax
+from scipy.spatial import cKDTree
 
+from ..profiling import NULL_PROFILER
+from .thresholds import PeakHistogram, LowPercentile, HighPercentile
+from .workspace import DetectorWorkspace
 from ..util import logger, angle_between_points
-from crater_detection.models import Crater, CraterField
+from crater_detection.models import ContourStore, Crater, CraterField
 
 OUTLINE_COLOR = (0, 255, 0)
 OUTLINE_THICKNESS = 3
 
-erode_kernel: np.ndarray = cv.getStructuringElement(cv.MORPH_ELLIPSE, (5, 5))
-dilate_kernel: np.ndarray = cv.getStructuringElement(cv.MORPH_ELLIPSE, (10, 10))
+# Defaults
+# Size (px) of the elliptical kernel the threshold masks are closed with
+CloseSize = 10
+ChainApprox = cv.CHAIN_APPROX_NONE
+# Max distance (px) of a simplified contour from the original, None keeps every point
+SimplifyEpsilon = None
 
 # Exports
-__all__ = ["detect"]
+__all__ = ["detect", "DetectorWorkspace"]
 
 
-def get_peak_values(img, low_percentile=0.001, high_percentile=0.95):
+@lru_cache(maxsize=None)
+def close_kernel(size: int) -> np.ndarray:
+    """
+    :return: elliptical structuring element of size x size px
     """
+    return cv.getStructuringElement(cv.MORPH_ELLIPSE, (size, size))
+
+
+erode_kernel: np.ndarray = cv.getStructuringElement(cv.MORPH_ELLIPSE, (5, 5))
+dilate_kernel: np.ndarray = close_kernel(CloseSize)
 
+
+def get_peak_values(img, low_percentile=LowPercentile, high_percentile=HighPercentile):
+    """
+    Thresholds from the intensities of the local maxima of the flattened image,
+    read off a histogram of the peaks rather than a sorted list of them.
+    :see: thresholds.PeakHistogram to share thresholds across tiles
     :param img:
     :param low_percentile: [0.001]
     :param high_percentile: [0.95]
     :return:
     """
-    flattened = img.flatten()
-    peaks = argrelmax(flattened)
-    peak_vals = list(map(lambda x: flattened[x], peaks))
-    sorted_peaks = sorted(peak_vals[0])
-    lower_bound = int(np.floor(len(sorted_peaks) * low_percentile))
-    upper_bound = int(np.floor(len(sorted_peaks) * high_percentile))
-    min_val = sorted_peaks[lower_bound]
-    max_val = sorted_peaks[upper_bound]
-    return int(min_val), int(max_val)
+    return PeakHistogram().add(img).thresholds(low_percentile, high_percentile)
 
 
 def clean_image(img: np.ndarray) -> np.ndarray:
     # http://opencv-python-tutroals.readthedocs.io/en/stable/py_tutorials/py_imgproc/py_morphological_ops/py_morphological_ops.html?highlight=structuring%20element
-    # Clean out points by "open"-ing
-    cv.erode(img, erode_kernel)
-    cv.dilate(img, dilate_kernel)
+    # Clean out points by "open"-ing, in place
+    cv.erode(img, erode_kernel, dst=img)
+    cv.dilate(img, dilate_kernel, dst=img)
     return img
 
 
-def close_image(img: np.ndarray) -> np.ndarray:
+def close_image(img: np.ndarray, dst: np.ndarray = None, kernel: np.ndarray = dilate_kernel) -> np.ndarray:
     # http://opencv-python-tutroals.readthedocs.io/en/stable/py_tutorials/py_imgproc/py_morphological_ops/py_morphological_ops.html?highlight=structuring%20element
     # Clean out points by "closing"-ing
-    return cv.morphologyEx(img, cv.MORPH_CLOSE, dilate_kernel)
+    return cv.morphologyEx(img, cv.MORPH_CLOSE, kernel, dst=dst)
 
 
-def get_contours(img: np.ndarray) -> Tuple[List, Any]:
-    contour_image, contours, hierarchy = cv.findContours(img,
-                                                         # Get a tree of hierarchies to calculate crater "children"
-                                                         cv.RETR_TREE,
-                                                         # Though more memory intensive,
-                                                         # no approx. is better for results
-                                                         cv.CHAIN_APPROX_NONE,
-                                                         )
+def get_contours(img: np.ndarray, chain_approx: int = ChainApprox) -> Tuple[List, Any]:
+    # OpenCV 3 returns the image first, OpenCV 4 only the contours and hierarchy
+    contours, hierarchy = cv.findContours(img,
+                                          # Get a tree of hierarchies to calculate crater "children"
+                                          cv.RETR_TREE,
+                                          # Though more memory intensive,
+                                          # no approx. is better for results
+                                          chain_approx,
+                                          )[-2:]
 
-    for i in range(len(contours)):
-        contours[i] = np.squeeze(contours[i], axis=1)
+    contours = [np.squeeze(c, axis=1) for c in contours]
     return contours, hierarchy
 
 
-def detect(input_image: np.ndarray) -> Tuple[np.ndarray, CraterField]:
-    """"
-    Tests:
-    - Threshold Pyramid (?), get light and dark points
-    - Gaussian Pyramid, apply contour detection and Hough Circle detection on each
+def simplify_contours(contours: List[np.ndarray], epsilon: float) -> List[np.ndarray]:
+    """
+    Douglas-Peucker simplification, every original point stays within epsilon of the simplified polygon.
+    :param contours: (N, 2) arrays
+    :param epsilon: in px
+    :return: (M, 2) arrays, M <= N
+    """
+    return [np.squeeze(cv.approxPolyDP(c, epsilon, True), axis=1) for c in contours]
 
-    Still to do:
-    - Build likely-hood based on combined results
-    - Build Hierarchy with combined results
+
+def get_enclosing_circles(contours: List[np.ndarray]) -> np.ndarray:
     """
-    # Make sure it's black and white
-    if len(input_image.shape) == 2:
-        # Already in grayscale
-        bw_img = input_image
-    else:
-        bw_img = cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+    Computes the minimum enclosing circle of every contour once.
+    :param contours:
+    :return: (N, 3) array of [x, y, radius] rows
+    """
+    circles = np.zeros(shape=(len(contours), 3), dtype=np.float64)
+    for i, c in enumerate(contours):
+        (x, y), rad = cv.minEnclosingCircle(c)
+        circles[i] = x, y, rad
+    return circles
 
-    # logger.info("Finding circles")
-    # circles = [] # find_circles(bw_img)
-    # logger.info("Found %i total circles" % len(circles))
 
-    min_val, max_val = get_peak_values(bw_img)
-    logger.debug("Lowest img value:", np.min(bw_img))
-    logger.debug("Highest img value:", np.max(bw_img))
+def pair_contours(high_circles: np.ndarray, low_circles: np.ndarray) -> np.ndarray:
+    """
+    For each high circle, find the index of the closest low circle in (x, y, radius) space.
+    Uses a KD-tree over the low circles so the whole match is a single query.
+    :see: https://stackoverflow.com/questions/5077318/given-two-large-sets-of-points-how-can-i-efficiently-find-pairs-that-are-near
+    :param high_circles: (H, 3) array from get_enclosing_circles
+    :param low_circles: (L, 3) array from get_enclosing_circles
+    :return: (H,) array of indices into low_circles, empty if either side is empty
+    """
+    if len(high_circles) == 0 or len(low_circles) == 0:
+        return np.zeros(shape=(0,), dtype=np.intp)
+
+    tree = cKDTree(low_circles)
+    _, l_matches = tree.query(high_circles, k=1)
+    return np.asarray(l_matches, dtype=np.intp)
+
 
+def threshold_masks(bw_img: np.ndarray, min_val: int, max_val: int,
+                    low_dst: np.ndarray = None, high_dst: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param bw_img: grayscale image
+    :param min_val: intensities up to it are dark
+    :param max_val: intensities from it are bright
+    :param low_dst: buffer for the dark mask
+    :param high_dst: buffer for the bright mask
+    :return: the dark and the bright masks
+    """
     low_thresh_image = cv.inRange(bw_img,
                                   0,
                                   min_val,
+                                  dst=low_dst,
                                   )
-    low_clean = close_image(low_thresh_image)
 
     # Get bright regions
     # high_thresh, high_thresh_image = cv.threshold(img, 254, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
@@ -102,82 +140,177 @@ def detect(input_image: np.ndarray) -> Tuple[np.ndarray, CraterField]:
     high_thresh_image = cv.inRange(bw_img,
                                    max_val,
                                    255,
+                                   dst=high_dst,
                                    )
-    high_clean = close_image(high_thresh_image)
+    return low_thresh_image, high_thresh_image
 
-    # Find contours in each
-    low_contours, low_heirarchy = get_contours(low_clean)
-    high_contours, high_heirarchy = get_contours(high_clean)
 
-    # Merge them
-    # thresh_image = cv.max(high_thresh_image, low_thresh_image)
-    # closed = close_image(thresh_image)
-    # clean_image(thresh_image)
+def find_crater_contours(low_mask: np.ndarray, high_mask: np.ndarray,
+                         close_size: int = CloseSize,
+                         chain_approx: int = ChainApprox,
+                         profiler=NULL_PROFILER,
+                         low_dst: np.ndarray = None,
+                         high_dst: np.ndarray = None) -> Tuple[List, List, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Closes the threshold masks, finds the contours in each and pairs every high contour with a low one.
+    :param low_mask: dark mask, from threshold_masks
+    :param high_mask: bright mask, from threshold_masks
+    :param close_size: px of the kernel the masks are closed with
+    :param chain_approx: cv.CHAIN_APPROX_* mode of the contours
+    :param profiler: records the close, find_contours and pairing stages
+    :param low_dst: buffer for the closed dark mask
+    :param high_dst: buffer for the closed bright mask
+    :return: the low and high contours, their enclosing circles,
+        and the index of the low contour paired with each high one
+    """
+    with profiler.stage("close"):
+        kernel = close_kernel(close_size)
+        low_clean = close_image(low_mask, dst=low_dst, kernel=kernel)
+        high_clean = close_image(high_mask, dst=high_dst, kernel=kernel)
+
+    # Find contours in each
+    with profiler.stage("find_contours"):
+        low_contours, low_heirarchy = get_contours(low_clean, chain_approx)
+        high_contours, high_heirarchy = get_contours(high_clean, chain_approx)
 
     # Pair high and low contours
-    # for each high contour, find the closest low contour by center
-    def mapper(c):
-        pos, rad = cv.minEnclosingCircle(c)
-        return c, np.uint(np.around(pos))
+    # for each high contour, find the closest low contour by enclosing circle
+    logger.debug("Matching high and low crater pairs")
+    with profiler.stage("pairing"):
+        high_circles = get_enclosing_circles(high_contours)
+        low_circles = get_enclosing_circles(low_contours)
+        h_matches = pair_contours(high_circles, low_circles)
 
-    high_with_pos = list(map(mapper, high_contours))
-    low_with_pos = list(map(mapper, low_contours))
+    return low_contours, high_contours, low_circles, high_circles, h_matches
 
-    def get_contour_params(c):
-        (x, y), rad = cv.minEnclosingCircle(c)
-        return x, y, rad
-
-    def distance_between_contours(cont, other):
-        # x, y, width, height = cv.boundingRect(c)
-        c_params = get_contour_params(cont)
-        o_params = get_contour_params(other)
-        return np.linalg.norm(np.array(c_params) - np.array(o_params))
-
-    # Find closest low
-    # Compute the distances from each high to each low
-    # Pair to the closest right now, we'll see about
-    # high x low => dist: real
-    # More efficient alg:
-    #   https://stackoverflow.com/questions/5077318/given-two-large-sets-of-points-how-can-i-efficiently-find-pairs-that-are-near
-    dists = np.zeros(shape=(len(high_contours), len(low_contours)))
-    h_matches = np.ndarray(shape=(len(high_contours),), dtype=np.uint)
-    l_matches = np.ndarray(shape=(len(low_contours),), dtype=np.uint)
-    craters = []
-    logger.debug("Matching high and low crater pairs")
-    for h_i, h in enumerate(high_contours):
-        for l_i, l in enumerate(low_contours):
-            dists[h_i][l_i] = distance_between_contours(h, l)
 
-        min_ind = dists[h_i].argmin()
-        # just assign them both for now
-        h_matches[h_i] = int(min_ind)
-        l_matches[min_ind] = h_i
-        full_contour = np.append(high_contours[h_i], low_contours[min_ind], axis=0)
-        craters.append(Crater(high_contours[h_i], low_contours[min_ind], full_contour))
+def crater_circles(high_contours: List[np.ndarray], low_contours: List[np.ndarray],
+                   h_matches: np.ndarray) -> np.ndarray:
+    """
+    The circles of the craters detect would find, without building them.
+    :param high_contours: from find_crater_contours
+    :param low_contours: from find_crater_contours
+    :param h_matches: from find_crater_contours
+    :return: (N, 3) array of each crater's enclosing circle, as Crater.min_enclosing_circle
+    """
+    circles = np.zeros(shape=(len(h_matches), 3), dtype=np.float64)
+    for h_i, l_i in enumerate(h_matches):
+        (x, y), rad = cv.minEnclosingCircle(np.concatenate((high_contours[h_i], low_contours[l_i])))
+        circles[h_i] = x, y, rad
+    return circles
+
+
+def detect(input_image: np.ndarray,
+           thresholds: Tuple[int, int] = None,
+           profiler=NULL_PROFILER,
+           render: bool = True,
+           chain_approx: int = ChainApprox,
+           simplify_epsilon: float = SimplifyEpsilon,
+           workspace: DetectorWorkspace = None,
+           close_size: int = CloseSize) -> Tuple[np.ndarray, CraterField]:
+    """"
+    :param input_image: grayscale or BGR image
+    :param thresholds: (low, high) intensity thresholds, computed from the image with get_peak_values if not given
+    :param profiler: a profiling.StageProfiler to record each stage in
+    :param render: whether to draw the annotated image, skip it when only the craters are needed
+    :param chain_approx: cv.CHAIN_APPROX_* mode of the contours
+    :param simplify_epsilon: simplify the stored contours to within this many px, the craters' circles and areas
+        then are within about as much of the exact ones (the pairing still uses the exact contours)
+    :param workspace: buffers to reuse rather than allocating new ones, when detecting many images in a row.
+        The annotated image is then the workspace's, and is overwritten by the next detect with it
+    :param close_size: px of the kernel the threshold masks are closed with
+    :return: the annotated image (None if not rendered) and the detected crater field
 
+    Tests:
+    - Threshold Pyramid (?), get light and dark points
+    - Gaussian Pyramid, apply contour detection and Hough Circle detection on each
 
-    # Draw all detected contours on the image
-    logger.info("Drawing craters")
-    color_image = cv.cvtColor(bw_img, cv.COLOR_GRAY2BGR)
+    Still to do:
+    - Build likely-hood based on combined results
+    - Build Hierarchy with combined results
+    """
+    height, width = input_image.shape[:2]
 
-    logger.info("Drawing contours")
-    cv.drawContours(color_image, low_contours, -1, (0, 0, 255), 2)
-    cv.drawContours(color_image, high_contours, -1, (255, 0, 0), 2)
-    # cv.drawContours(color_image, combinded, -1, (0, 255, 0), 2)
-    cv.drawContours(color_image, list(map(lambda c: c.full_contour, craters)), -1, (0, 255, 0), 2)
+    def buffer(name, channels=1):
+        if workspace is None:
+            return None
+        return workspace.buffer(name, (height, width) if channels == 1 else (height, width, channels))
 
-    # logger.info("Drawing circles")
-    # for circle in circles:
-    #     cv.circle(color_image, (circle[0], circle[1]), circle[2], (0, 255, 0), 2)
+    # Make sure it's black and white
+    with profiler.stage("grayscale"):
+        if len(input_image.shape) == 2:
+            # Already in grayscale
+            bw_img = input_image
+        else:
+            bw_img = cv.cvtColor(input_image, cv.COLOR_BGR2GRAY, dst=buffer("gray"))
 
-    logger.info("Drawing contour connections")
-    for h_i, l_i in enumerate(h_matches):
-        h, h_pos = high_with_pos[h_i]
-        l, l_pos = low_with_pos[int(l_i)]
-        cv.line(color_image, tuple(h_pos), tuple(l_pos), (0, 0, 0), 2)
+    # logger.info("Finding circles")
+    # circles = [] # find_circles(bw_img)
+    # logger.info("Found %i total circles" % len(circles))
+
+    with profiler.stage("thresholds"):
+        if thresholds is None:
+            min_val, max_val = get_peak_values(bw_img)
+        else:
+            min_val, max_val = thresholds
+    logger.debug("Lowest img value:", np.min(bw_img))
+    logger.debug("Highest img value:", np.max(bw_img))
+
+    with profiler.stage("in_range"):
+        low_thresh_image, high_thresh_image = threshold_masks(bw_img, min_val, max_val,
+                                                              low_dst=buffer("low_mask"),
+                                                              high_dst=buffer("high_mask"))
+
+    # Merge them
+    # thresh_image = cv.max(high_thresh_image, low_thresh_image)
+    # closed = close_image(thresh_image)
+    # clean_image(thresh_image)
+
+    low_contours, high_contours, low_circles, high_circles, h_matches = find_crater_contours(
+        low_thresh_image, high_thresh_image,
+        close_size=close_size,
+        chain_approx=chain_approx,
+        profiler=profiler,
+        low_dst=buffer("low_closed"),
+        high_dst=buffer("high_closed"))
+
+    with profiler.stage("store_contours"):
+        paired_high = [high_contours[h_i] for h_i in range(len(h_matches))]
+        paired_low = [low_contours[l_i] for l_i in h_matches]
+        if simplify_epsilon is not None:
+            paired_high = simplify_contours(paired_high, simplify_epsilon)
+            paired_low = simplify_contours(paired_low, simplify_epsilon)
+        # Each crater's high contour followed by its low one, so its full contour is one slice
+        paired_circles = np.column_stack((high_circles[:len(h_matches)], low_circles[h_matches])).reshape(-1, 3)
+        store = ContourStore.pack([c for pair in zip(paired_high, paired_low) for c in pair], circles=paired_circles)
+        craters = [Crater.from_store(store, 2 * h_i) for h_i in range(len(h_matches))]
 
     # Let's do some stats
-    height, width, _ = color_image.shape
-    crater_field = CraterField(width, height, craters)
+    with profiler.stage("crater_field"):
+        crater_field = CraterField(width, height, craters)
+
+    if not render:
+        return None, crater_field
+
+    # Draw all detected contours on the image
+    logger.info("Drawing craters")
+    with profiler.stage("drawing"):
+        color_image = cv.cvtColor(bw_img, cv.COLOR_GRAY2BGR, dst=buffer("color", channels=3))
+
+        logger.info("Drawing contours")
+        cv.drawContours(color_image, low_contours, -1, (0, 0, 255), 2)
+        cv.drawContours(color_image, high_contours, -1, (255, 0, 0), 2)
+        # cv.drawContours(color_image, combinded, -1, (0, 255, 0), 2)
+        cv.drawContours(color_image, list(map(lambda c: c.full_contour, craters)), -1, (0, 255, 0), 2)
+
+        # logger.info("Drawing circles")
+        # for circle in circles:
+        #     cv.circle(color_image, (circle[0], circle[1]), circle[2], (0, 255, 0), 2)
+
+        logger.info("Drawing contour connections")
+        high_pos = np.uint(np.around(high_circles[:, :2]))
+        low_pos = np.uint(np.around(low_circles[:, :2]))
+        for h_i, l_i in enumerate(h_matches):
+            cv.line(color_image, tuple(map(int, high_pos[h_i])), tuple(map(int, low_pos[l_i])), (0, 0, 0), 2)
 
     return color_image, crater_field
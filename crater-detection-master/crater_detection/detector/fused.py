@@ -0,0 +1,116 @@
+import numpy as np
+import cv2 as cv
+from typing import Tuple
+
+from ..profiling import NULL_PROFILER
+from ..util import logger
+from crater_detection.models import CraterField
+from . import detect, SimplifyEpsilon
+from . import hough
+
+METHODS = ("contour", "hough", "fused")
+
+# Defaults
+Method = "contour"
+# Drop the contour craters Hough doesn't confirm
+ConfirmedOnly = False
+
+
+def circle_field(circles: np.ndarray, width: int, height: int) -> CraterField:
+    """
+    :param circles: (N, 3) array of [x, y, radius]
+    :return: a field without Crater objects, the sun angle unknown (NaN) and the bright / shadow centers
+        at the crater's
+    """
+    circles = np.asarray(circles, dtype=np.float64).reshape(-1, 3)
+    x, y, rad = circles[:, 0], circles[:, 1], circles[:, 2]
+    columns = {
+        "x": x,
+        "y": y,
+        "radius": rad,
+        "area": np.pi * rad ** 2,
+        "sun_angle": np.full(shape=(len(circles),), fill_value=np.nan),
+        "high_x": x,
+        "high_y": y,
+        "low_x": x,
+        "low_y": y,
+    }
+    return CraterField(width, height, columns=columns)
+
+
+def detect_hough(input_image: np.ndarray, profiler=NULL_PROFILER) -> CraterField:
+    """
+    hough.find_circles over the whole image, much slower than the contours.
+    :param input_image: grayscale or BGR image
+    :param profiler: a profiling.StageProfiler
+    :return: the circles as a field, see circle_field
+    """
+    height, width = input_image.shape[:2]
+    with profiler.stage("grayscale"):
+        bw_img = input_image if len(input_image.shape) == 2 else cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+    with profiler.stage("hough"):
+        circles = hough.find_circles(bw_img)
+    return circle_field(circles, width, height)
+
+
+def detect_fused(input_image: np.ndarray,
+                 thresholds: Tuple[int, int] = None,
+                 profiler=NULL_PROFILER,
+                 confirmed_only: bool = ConfirmedOnly,
+                 simplify_epsilon: float = SimplifyEpsilon) -> CraterField:
+    """
+    Contour detection, then Hough only in a small region around each crater to confirm it and refine its circle.
+    :see: hough.refine_circles
+    :param input_image: grayscale or BGR image
+    :param thresholds: see detect
+    :param profiler: a profiling.StageProfiler
+    :param confirmed_only: drop the craters Hough doesn't confirm, which are mostly fragments and false positives
+    :param simplify_epsilon: see detect
+    :return: the field, confirmed craters with the Hough circle as x, y and radius and its area as area,
+        the rest (if kept) with their enclosing circle and contour area as detect found them
+    """
+    _, crater_field = detect(input_image, thresholds=thresholds, profiler=profiler, render=False,
+                             simplify_epsilon=simplify_epsilon)
+
+    with profiler.stage("grayscale"):
+        bw_img = input_image if len(input_image.shape) == 2 else cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+    with profiler.stage("hough_refine"):
+        circles, confirmed = hough.refine_circles(bw_img, np.column_stack((crater_field.x,
+                                                                           crater_field.y,
+                                                                           crater_field.radius)))
+    logger.info("Hough confirmed %i of %i craters" % (np.sum(confirmed), len(crater_field)))
+
+    columns = dict(crater_field.columns)
+    columns["x"], columns["y"], columns["radius"] = circles[:, 0], circles[:, 1], circles[:, 2]
+    columns["area"] = np.where(confirmed, np.pi * circles[:, 2] ** 2, crater_field.area)
+    fused_field = CraterField(crater_field.width, crater_field.height, crater_field.craters, columns)
+    if confirmed_only:
+        fused_field = fused_field.filter(confirmed)
+    return fused_field
+
+
+def detect_method(input_image: np.ndarray,
+                  method: str = Method,
+                  thresholds: Tuple[int, int] = None,
+                  profiler=NULL_PROFILER,
+                  confirmed_only: bool = ConfirmedOnly,
+                  simplify_epsilon: float = SimplifyEpsilon) -> CraterField:
+    """
+    :param input_image: grayscale or BGR image
+    :param method: one of METHODS
+    :param thresholds: see detect, not used by hough
+    :param profiler: a profiling.StageProfiler
+    :param confirmed_only: see detect_fused
+    :param simplify_epsilon: see detect, not used by hough
+    :return: the crater field
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown method '%s', use one of: %s" % (method, ", ".join(METHODS)))
+    if method == "hough":
+        return detect_hough(input_image, profiler=profiler)
+    if method == "fused":
+        return detect_fused(input_image, thresholds=thresholds, profiler=profiler, confirmed_only=confirmed_only,
+                            simplify_epsilon=simplify_epsilon)
+    _, crater_field = detect(input_image, thresholds=thresholds, profiler=profiler, render=False,
+                             simplify_epsilon=simplify_epsilon)
+    return crater_field
@@ -1,15 +1,41 @@
 import numpy as np
 import cv2 as cv
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from typing import Tuple, List, Any
-from scipy.spatial import distance
-from scipy.signal import argrelmax
-from matplotlib import pyplot as plt
+from scipy.spatial import cKDTree, distance
 
 from ..util import logger
-from crater_detection.models import Crater, CraterFieldStats, CraterField
+
+# Defaults
+# Canny's high threshold, in every Hough search
+Param1 = 20
+# Accumulator votes needed by find_circles
+Param2 = 70
+# Closest centers of two circles (px) found by find_circles
+MinDist = 5
+
+# Defaults, of refine_circles
+# Each region of interest is the candidate's circle grown by this factor, plus RoiPad px
+RoiScale = 1.05
+RoiPad = 3
+# Radii searched, as fractions of the candidate's (the enclosing circle takes in the shadow, the rim is inside it)
+MinRadiusFactor = 0.5
+MaxRadiusFactor = 1.05
+# A Hough circle confirms a candidate if its center is within this fraction of the candidate's radius
+MaxCenterShift = 0.5
+# Accumulator votes needed, as a fraction of the circumference
+VoteFraction = 0.25
+MinVotes = 6
+# Candidates smaller than this (px) aren't searched, larger ones are searched on a region scaled down to it
+MinRoiRadius = 3
+MaxRoiRadius = 32
+RoiBlurSigma = 1.0
 
 
 def image_info(img):
+    from matplotlib import pyplot as plt
+
     hist, bins = np.histogram(img.flatten(), 256, [0, 256])
     cdf = hist.cumsum()
     cdf_normalized = cdf * hist.max() / cdf.max()
@@ -20,106 +46,259 @@ def image_info(img):
     plt.show()
 
 
-def dedup_circles(circles: list, min_dist: float):
-    # Do not care about speed, just correctness
-    final_circles = []
+def candidate_pairs(points: np.ndarray, query_dists: np.ndarray) -> np.ndarray:
+    """
+    :param points: (N, D) array
+    :param query_dists: per point, how far to look from it
+    :return: (M, 2) array of [i, j], j within query_dists[i] of i (i itself excluded)
+    """
+    found = cKDTree(points).query_ball_point(points, query_dists, return_sorted=False)
+    counts = np.fromiter(map(len, found), dtype=np.intp, count=len(found))
+    first = np.repeat(np.arange(len(found), dtype=np.intp), counts)
+    second = np.fromiter(chain.from_iterable(found), dtype=np.intp, count=int(np.sum(counts)))
+    pairs = np.column_stack((first, second))
+    return pairs[first != second]
+
 
-    get_circle_center = lambda c: (c[0], c[1])
+def dedup_circles(circles, min_dist: float) -> np.ndarray:
+    """
+    Greedy merge of near duplicate circles, in input order: each circle that hasn't been merged yet
+    absorbs every other unmerged circle within the min distance, and they're replaced by their mean.
+    The min distance is scaled up with the radius of the pair.
+    Candidate pairs come from a KD-tree, each circle queried only as far as its own radius needs,
+    so one large circle doesn't widen every query and this stays about O(n log n).
+    :param circles: (N, 3) array or list of [x, y, radius]
+    :param min_dist: distance, in (x, y, radius) space, under which circles of radius 0 are duplicates
+    :return: (M, 3) uint16 array of merged circles
+    """
+    points = np.asarray(circles, dtype=np.float64).reshape(-1, 3)
+    num_circles = len(points)
     logger.debug("De-duplicating found craters with min_dist %f" % min_dist)
-    logger.debug("Before de-deuplication: %i" % len(circles))
-
-    def is_possible_dup(circle: Tuple[int, int, int], other: Tuple[int, int, int]):
-        """
-        Make the min distance lower depending on the size of the radius
-        :param circle:
-        :param other:
-        :return:
-        """
-        rad = circle[2]
-        other_rad = other[2]
-        scaled_min_dist = min_dist * (1.01 ** np.mean([rad, other_rad]))
-
-        # return distance.euclidean(get_circle_center(circle), get_circle_center(other)) < scaled_min_dist
-        return distance.euclidean(circle, other) < scaled_min_dist
-
-    for current_ind, circle in enumerate(circles):
-        dups = [(ind, other_circle) for ind, other_circle
-                in enumerate(circles[current_ind:])
-                # if current_ind != ind and distance.euclidean(circle, other_circle) < MIN_DIST
-                if current_ind != ind and is_possible_dup(circle, other_circle)
-                ]
-
-        # average them all
-        if len(dups) > 0:
-            circle = np.uint16(np.around(
-                np.mean(
-                    [circle] + [c for ind, c in dups],
-                    axis=0
-                )))
-
-        final_circles.append(circle)
-
-        # Remove them from list
-        for i, (dup_i, dup) in enumerate(dups):
-            # first is dup_i - 0
-            # next is dup_i - 1, as one got deleted
-            # n is dup_i - (n-1), as one got deleted
-            del circles[dup_i - i]
-
-    logger.debug("After de-deuplication:", len(circles))
+    logger.debug("Before de-deuplication: %i" % num_circles)
+
+    if num_circles == 0:
+        return np.zeros(shape=(0, 3), dtype=np.uint16)
+
+    # Make the min distance lower depending on the size of the radius.
+    # A pair's threshold is at most the one of its larger circle, so each pair is found
+    # by querying from its larger circle (the later one for equal radii)
+    pairs = candidate_pairs(points, min_dist * (1.01 ** points[:, 2]))
+    first, second = pairs[:, 0], pairs[:, 1]
+    rads = points[:, 2]
+    pairs = pairs[(rads[second] < rads[first]) | ((rads[second] == rads[first]) & (second < first))]
+    if len(pairs) > 0:
+        first, second = pairs[:, 0], pairs[:, 1]
+        dists = np.linalg.norm(points[first] - points[second], axis=1)
+        scaled_min_dist = min_dist * (1.01 ** ((points[first, 2] + points[second, 2]) / 2))
+        pairs = pairs[dists < scaled_min_dist]
+
+    # Neighbours of each circle, as CSR style index arrays
+    both_ways = np.concatenate((pairs, pairs[:, ::-1]))
+    both_ways = both_ways[np.lexsort((both_ways[:, 1], both_ways[:, 0]))]
+    neighbours = both_ways[:, 1]
+    neighbour_ptr = np.searchsorted(both_ways[:, 0], np.arange(num_circles + 1))
+
+    labels = np.full(shape=(num_circles,), fill_value=-1, dtype=np.intp)
+    num_clusters = 0
+    for i in range(num_circles):
+        if labels[i] != -1:
+            continue
+        dups = neighbours[neighbour_ptr[i]:neighbour_ptr[i + 1]]
+        dups = dups[labels[dups] == -1]
+        labels[i] = num_clusters
+        labels[dups] = num_clusters
+        num_clusters += 1
+
+    # average them all
+    sums = np.zeros(shape=(num_clusters, 3), dtype=np.float64)
+    np.add.at(sums, labels, points)
+    counts = np.bincount(labels, minlength=num_clusters)
+    final_circles = np.uint16(np.around(sums / counts[:, np.newaxis]))
+
+    logger.debug("After de-deuplication:", len(final_circles))
     return final_circles
 
 
-def find_circles(img: np.ndarray):
+def find_level_circles(scaled_img: np.ndarray, src_height: int, src_width: int,
+                       param1: float = Param1, param2: float = Param2, min_dist: float = MinDist) -> np.ndarray:
+    """
+    Runs Hough on one pyramid level.
+    :param scaled_img: the level
+    :param src_height: height of the full scale image
+    :param src_width: width of the full scale image
+    :param param1: Canny's high threshold
+    :param param2: accumulator votes needed
+    :param min_dist: closest centers of two circles, in px of the level
+    :return: (N, 3) array of [x, y, radius] at full scale
+    """
+    scale_height, scale_width = scaled_img.shape
+    # Mark a ratio so we can remap the detected craters to the full scale image
+    height_ratio: float = scale_height / src_height
+    width_ratio: float = scale_width / src_width
+    wh_avg = (src_height + src_width) / 2
+
+    circles = cv.HoughCircles(scaled_img,
+                              cv.HOUGH_GRADIENT,
+                              # cv.HOUGH_MULTI_SCALE, # Might be good when implemented
+                              1,  # dp
+                              # 20,
+                              min_dist,  # min distance
+                              # param1=200,
+                              # param2=100,
+                              param1=param1,  # passed to Canny
+                              param2=param2,  # Accumulator thresh
+                              minRadius=0,
+                              maxRadius=int(wh_avg / 4),
+                              )
+
+    if circles is None:
+        logger.debug("No circles found at scale %i x %i" % (scale_width, scale_height))
+        return np.zeros(shape=(0, 3), dtype=np.float64)
+
+    circles = circles[0]
+    logger.debug("Num circles", len(circles), "at scale %i x %i" % (scale_width, scale_height))
+    # now in format [ [x, y, radius] ... ]
+    # scale them to match the original input dimens
+    return circles / np.array([
+        width_ratio,
+        height_ratio,
+        (width_ratio + height_ratio) / 2,
+    ])
+
+
+def blurred_pyramid(img: np.ndarray, steps=3, max_up_levels: int = None) -> List[np.ndarray]:
+    """
+    The levels Hough runs on: the image blurred, then its gaussian pyramid.
+    :param img: grayscale image
+    :param steps: pyramid steps, see create_gaussian_pyramid
+    :param max_up_levels: cap on the up-sampled levels, which are 4x the area per level, 0 skips them
+    """
     blurred_image: np.ndarray = cv.GaussianBlur(img, (9, 9), sigmaX=2, sigmaY=2)
+    return create_gaussian_pyramid(blurred_image, steps=steps, max_up_levels=max_up_levels)
+
+
+def pyramid_circles(gauss_pyr: List[np.ndarray], src_height: int, src_width: int, workers: int = None,
+                    param1: float = Param1, param2: float = Param2, min_dist: float = MinDist) -> np.ndarray:
+    """
+    Hough circles on each level of a pyramid, each level in its own thread. OpenCV releases the GIL,
+    so the levels run concurrently.
+    :param gauss_pyr: from blurred_pyramid
+    :param src_height: height of the full scale image
+    :param src_width: width of the full scale image
+    :param workers: threads, defaults to one per level, 1 runs the levels in this thread
+    :param param1: see find_level_circles
+    :param param2: see find_level_circles
+    :param min_dist: see find_level_circles
+    :return: (N, 3) uint16 array of [x, y, radius] from every level, with duplicates
+    """
+    def level_circles(level):
+        return find_level_circles(level, src_height, src_width, param1, param2, min_dist)
+
+    logger.info("Detecting circles in %i pyramid levels" % len(gauss_pyr))
+    if workers == 1:
+        circles = [level_circles(level) for level in gauss_pyr]
+    else:
+        with ThreadPoolExecutor(max_workers=workers or len(gauss_pyr)) as executor:
+            circles = list(executor.map(level_circles, gauss_pyr))
+
+    return np.uint16(np.around(np.concatenate(circles)))
+
+
+def find_all_circles(img: np.ndarray, steps=3, max_up_levels: int = None, workers: int = None,
+                     param1: float = Param1, param2: float = Param2, min_dist: float = MinDist) -> np.ndarray:
+    """
+    Hough circles over a gaussian pyramid of the image, see blurred_pyramid and pyramid_circles.
+    :param img: grayscale image
+    :return: (N, 3) uint16 array of [x, y, radius] from every level, with duplicates
+    """
+    src_height, src_width = img.shape
+    gauss_pyr = blurred_pyramid(img, steps=steps, max_up_levels=max_up_levels)
+    return pyramid_circles(gauss_pyr, src_height, src_width, workers=workers,
+                           param1=param1, param2=param2, min_dist=min_dist)
+
+
+def get_min_dup_dist(height: int, width: int) -> float:
+    return (height + width) / 2 / 500
+
+
+def find_circles(img: np.ndarray, steps=3, max_up_levels: int = None, workers: int = None,
+                 param1: float = Param1, param2: float = Param2, min_dist: float = MinDist) -> np.ndarray:
+    """
+    find_all_circles, then de-duplicated across levels.
+    :return: (N, 3) uint16 array of [x, y, radius]
+    """
     src_height, src_width = img.shape
-    gauss_pyr = create_gaussian_pyramid(blurred_image, steps=3)
-    min_dup_dist = (src_height + src_width) / 2 / 500
-
-    all_circles = []
-
-    for i, scaled_img in enumerate(gauss_pyr):
-        scale_height, scale_width = scaled_img.shape
-        logger.info(
-            "Detecting circles in image %i of %i at scale %i x %i" % (i + 1, len(gauss_pyr), scale_width, scale_height))
-        # Mark a ratio so we can remap the detected craters to the full scale image
-        height_ratio: float = scale_height / src_height
-        width_ratio: float = scale_width / src_width
-        wh_ratio = height_ratio / width_ratio
-        wh_avg = (src_height + src_width) / 2
-
-        circles = cv.HoughCircles(scaled_img,
-                                  cv.HOUGH_GRADIENT,
-                                  # cv.HOUGH_MULTI_SCALE, # Might be good when implemented
-                                  1,  # dp
-                                  # 20,
-                                  5,  # min distance
-                                  # param1=200,
-                                  # param2=100,
-                                  param1=20,  # passed to Canny
-                                  param2=70,  # Accumulator thresh
-                                  minRadius=0,
-                                  maxRadius=int(wh_avg / 4),
-                                  )
-
-        if circles is not None:
-            circles = circles[0]
-            logger.debug("Num circles", len(circles))
-            # now in format [ [y, x, radius] ... ]
-            # scale them to match the original input dimens
-            scaled_circles = circles / np.array([
-                height_ratio,
-                width_ratio,
-                wh_ratio
-            ])
-            # round em out
-            scaled_circles = np.uint16(np.around(scaled_circles))
-            all_circles.extend(scaled_circles)
-
-        else:
-            logger.debug("No circles found")
-
-    return dedup_circles(all_circles, min_dup_dist)
+    all_circles = find_all_circles(img, steps=steps, max_up_levels=max_up_levels, workers=workers,
+                                   param1=param1, param2=param2, min_dist=min_dist)
+    return dedup_circles(all_circles, get_min_dup_dist(src_height, src_width))
+
+
+def refine_circle(bw_img: np.ndarray, x: float, y: float, rad: float,
+                  param1: float = Param1, vote_fraction: float = VoteFraction) -> np.ndarray:
+    """
+    Runs Hough in a small region around one candidate, for radii close to its own.
+    :param param1: Canny's high threshold
+    :param vote_fraction: accumulator votes needed, as a fraction of the circumference
+    :return: [x, y, radius] of the strongest circle centered near the candidate, None if there isn't one
+    """
+    height, width = bw_img.shape
+    scale = max(1.0, rad / MaxRoiRadius)
+    half = int(np.ceil(rad * RoiScale + RoiPad * scale))
+    x0, y0 = max(int(x) - half, 0), max(int(y) - half, 0)
+    x1, y1 = min(int(x) + half + 1, width), min(int(y) + half + 1, height)
+
+    roi = bw_img[y0:y1, x0:x1]
+    if scale > 1:
+        roi = cv.resize(roi, (max(int(round((x1 - x0) / scale)), 1), max(int(round((y1 - y0) / scale)), 1)),
+                        interpolation=cv.INTER_AREA)
+    roi = cv.GaussianBlur(roi, (5, 5), sigmaX=RoiBlurSigma, sigmaY=RoiBlurSigma)
+
+    roi_rad = rad / scale
+    circles = cv.HoughCircles(roi,
+                              cv.HOUGH_GRADIENT,
+                              1,  # dp
+                              max(roi_rad, 1),  # min distance, only the strongest circle is wanted
+                              param1=param1,  # passed to Canny
+                              param2=max(MinVotes, vote_fraction * 2 * np.pi * roi_rad),  # Accumulator thresh
+                              minRadius=max(int(roi_rad * MinRadiusFactor), 1),
+                              maxRadius=int(np.ceil(roi_rad * MaxRadiusFactor)),
+                              )
+    if circles is None:
+        return None
+
+    # Strongest first
+    for c_x, c_y, c_rad in circles[0]:
+        c_x, c_y, c_rad = c_x * scale + x0, c_y * scale + y0, c_rad * scale
+        if np.hypot(c_x - x, c_y - y) <= MaxCenterShift * rad:
+            return np.array([c_x, c_y, c_rad])
+    return None
+
+
+def refine_circles(bw_img: np.ndarray, circles: np.ndarray,
+                   param1: float = Param1, vote_fraction: float = VoteFraction) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Confirms candidate circles (e.g. the contour detector's) with Hough, only searched around each of them,
+    which costs a small fraction of find_circles on the whole image.
+    Confirmed candidates take the Hough circle, which sits on the crater's rim.
+    :param bw_img: grayscale image
+    :param circles: (N, 3) array of [x, y, radius] candidates
+    :param param1: see refine_circle
+    :param vote_fraction: see refine_circle
+    :return: (N, 3) array of the refined circles, unconfirmed ones as they were,
+        and an (N,) boolean array of which were confirmed
+    """
+    refined = np.array(circles, dtype=np.float64).reshape(-1, 3)
+    confirmed = np.zeros(shape=(len(refined),), dtype=bool)
+    for i, (x, y, rad) in enumerate(refined):
+        if rad < MinRoiRadius:
+            continue
+        circle = refine_circle(bw_img, x, y, rad, param1, vote_fraction)
+        if circle is not None:
+            refined[i] = circle
+            confirmed[i] = True
+
+    logger.debug("Hough confirmed %i of %i candidates" % (np.sum(confirmed), len(refined)))
+    return refined, confirmed
 
 
 def closest_circle(contour_pos, circles):
@@ -139,25 +318,28 @@ def closest_circle(contour_pos, circles):
     return current_nearest
 
 
-def create_gaussian_pyramid(img: np.ndarray, steps=4) -> List[np.ndarray]:
+def create_gaussian_pyramid(img: np.ndarray, steps=4, max_up_levels: int = None) -> List[np.ndarray]:
     """
     :see: http://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials/py_imgproc/py_pyramids/py_pyramids.html
-    :param img:
-    :param steps:
-    :return:
+    :param img: used as is for the middle level, not copied
+    :param steps: half are down-sampled levels, half up-sampled
+    :param max_up_levels: cap on the number of up-sampled levels
+    :return: levels from smallest to largest
     """
-    cur_img = img.copy()
+    num_levels = int(steps / 2)
+    num_up_levels = num_levels if max_up_levels is None else min(num_levels, max_up_levels)
+    cur_img = img
     pyr = []
 
-    for i in range(int(steps / 2)):
+    for i in range(num_levels):
         cur_img = cv.pyrDown(cur_img)
         pyr.append(cur_img)
 
     pyr.reverse()
-    cur_img = img.copy()
-    pyr.append(img.copy())
+    cur_img = img
+    pyr.append(img)
 
-    for i in range(int(steps / 2)):
+    for i in range(num_up_levels):
         cur_img = cv.pyrUp(cur_img)
         pyr.append(cur_img)
 
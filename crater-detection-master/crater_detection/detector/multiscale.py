@@ -0,0 +1,162 @@
+import numpy as np
+import cv2 as cv
+from typing import List, Tuple
+
+from ..profiling import NULL_PROFILER
+from ..util import logger
+from crater_detection.models import Crater, CraterField, pack_craters
+from . import CloseSize, DetectorWorkspace, detect, get_peak_values
+from .tiling import offset_crater
+
+# Defaults
+Levels = 2
+# Regions of interest closer than this (px) are detected together, in fewer and larger boxes
+GroupGap = 32
+# What a detect costs besides its px, in px, about 0.6 ms
+RegionCost = 256 * 256
+# Past this share of a plain detect's work (the boxes' px, and RegionCost for each box),
+# the whole image is detected at once
+MaxWork = 0.5
+
+
+def extremes_level(bw_img: np.ndarray, thresholds: Tuple[int, int], factor: int) -> np.ndarray:
+    """
+    The coarse level of a min / max pyramid: each px stands for a factor x factor block of the image,
+    and is set if any px of the block is past the thresholds. Unlike on a Gaussian level,
+    the darkest and brightest px of small craters aren't blurred away.
+    :param bw_img: grayscale, full resolution
+    :param thresholds: (low, high)
+    :param factor: block edge in px
+    :return: (ceil(height / factor), ceil(width / factor)) uint8 mask
+    """
+    min_val, max_val = thresholds
+    block = np.ones(shape=(factor, factor), dtype=np.uint8)
+    # Anchored at the block's top left px, partial blocks at the edges only see the image's px
+    block_min = cv.erode(bw_img, block, anchor=(0, 0))[::factor, ::factor]
+    block_max = cv.dilate(bw_img, block, anchor=(0, 0))[::factor, ::factor]
+    return cv.inRange(block_min, 0, min_val) | cv.inRange(block_max, max_val, 255)
+
+
+def regions_of_interest(extremes: np.ndarray, factor: int, close_size: int = CloseSize) -> np.ndarray:
+    """
+    The candidate blocks, grown by as far as the full resolution closing reaches,
+    so every contour found in them is the one a plain detect finds.
+    :param extremes: from extremes_level
+    :param factor: full resolution px per coarse px
+    :param close_size: the full resolution closing joins px up to this far (px) apart
+    :return: uint8 mask, the size of extremes
+    """
+    reach = int(np.ceil(close_size / factor)) + 1
+    return cv.dilate(extremes, cv.getStructuringElement(cv.MORPH_ELLIPSE, (2 * reach + 1, 2 * reach + 1)))
+
+
+def group_regions(rois: np.ndarray, factor: int, group_gap: int = GroupGap) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param rois: coarse mask from regions_of_interest
+    :param factor: full resolution px per coarse px
+    :param group_gap: regions closer than this (full resolution px) are detected together
+    :return: each coarse px's group label (0 outside the groups),
+        and the (N, 4) coarse boxes [col, row, num_cols, num_rows] of the groups labelled 1 to N
+    """
+    groups = rois
+    gap = int(np.ceil(group_gap / factor / 2))
+    if gap > 0:
+        groups = cv.dilate(rois, cv.getStructuringElement(cv.MORPH_RECT, (2 * gap + 1, 2 * gap + 1)))
+    _, labels, stats, _ = cv.connectedComponentsWithStats(groups, connectivity=8)
+    # Label 0 is the background
+    return labels, stats[1:, :4]
+
+
+def region_work(boxes: np.ndarray, factor: int, width: int, height: int) -> float:
+    """
+    :param boxes: from group_regions
+    :return: the share of a plain detect's work detecting the boxes takes, see MaxWork
+    """
+    box_px = np.sum(boxes[:, 2].astype(np.int64) * boxes[:, 3]) * factor ** 2
+    return (box_px + len(boxes) * RegionCost) / (width * height)
+
+
+def detect_regions(bw_img: np.ndarray, rois: np.ndarray, labels: np.ndarray, boxes: np.ndarray, factor: int,
+                   thresholds: Tuple[int, int], profiler=NULL_PROFILER) -> List[Crater]:
+    """
+    Runs detect on the box of each group of regions of interest, the px of the box outside them
+    are set between the thresholds so they're never part of a contour.
+    :param rois: coarse mask from regions_of_interest
+    :param labels: from group_regions
+    :param boxes: from group_regions
+    :return: the craters, in image coordinates
+    """
+    height, width = bw_img.shape[:2]
+    neutral = (int(thresholds[0]) + int(thresholds[1])) // 2
+
+    craters = []
+    # Groups differ in size, the buffers grow to the largest one
+    workspace = DetectorWorkspace()
+    for label, (col, row, num_cols, num_rows) in enumerate(boxes, 1):
+        x0, y0 = col * factor, row * factor
+        x1, y1 = min((col + num_cols) * factor, width), min((row + num_rows) * factor, height)
+
+        # Boxes can overlap, only the group's own regions are detected in its box
+        inside = ((labels[row:row + num_rows, col:col + num_cols] == label) &
+                  (rois[row:row + num_rows, col:col + num_cols] > 0)).astype(np.uint8)
+        inside = cv.resize(inside, (num_cols * factor, num_rows * factor),
+                           interpolation=cv.INTER_NEAREST)[:y1 - y0, :x1 - x0]
+        region = bw_img[y0:y1, x0:x1].copy()
+        region[inside == 0] = neutral
+
+        _, field = detect(region, thresholds=thresholds, profiler=profiler, render=False, workspace=workspace)
+        craters.extend(offset_crater(crater, x0, y0) for crater in field.craters)
+    return craters
+
+
+def detect_multiscale(input_image: np.ndarray,
+                      levels: int = Levels,
+                      thresholds: Tuple[int, int] = None,
+                      max_work: float = MaxWork,
+                      group_gap: int = GroupGap,
+                      profiler=NULL_PROFILER) -> CraterField:
+    """
+    Coarse to fine: candidates are picked on a min / max pyramid level 4 ** levels times smaller, each of its px
+    a block of the image with px past the thresholds. Full resolution detection then only runs in the regions
+    of interest around them, a crater's bright and shadow sides meet at their tips so it's in a single region,
+    whatever its size. The px between the regions, where there's nothing to find, aren't closed or searched
+    for contours. When the regions would take more than max_work of a plain detect, as on dense fields,
+    the image is detected whole. Either way the craters are those of a plain detect, but for contours
+    of different regions it would have paired.
+    :param input_image: grayscale or BGR image
+    :param levels: pyramid levels down to the coarse one, each halves the size
+    :param thresholds: (low, high), computed from the full image if not given
+    :param max_work: see MaxWork
+    :param group_gap: see group_regions
+    :param profiler: a profiling.StageProfiler
+    :return: the crater field at full resolution
+    """
+    if levels < 1:
+        raise ValueError("Coarse to fine detection needs at least 1 level, got %i" % levels)
+
+    with profiler.stage("grayscale"):
+        if len(input_image.shape) == 2:
+            bw_img = input_image
+        else:
+            bw_img = cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+    height, width = bw_img.shape[:2]
+
+    with profiler.stage("thresholds"):
+        if thresholds is None:
+            thresholds = get_peak_values(bw_img)
+
+    factor = 2 ** levels
+    with profiler.stage("regions"):
+        rois = regions_of_interest(extremes_level(bw_img, thresholds, factor), factor)
+        labels, boxes = group_regions(rois, factor, group_gap)
+        work = region_work(boxes, factor, width, height)
+    logger.debug("%i groups of regions of interest, %.1f%% of a plain detect's work" % (len(boxes), 100 * work))
+
+    if work > max_work:
+        _, crater_field = detect(bw_img, thresholds=thresholds, profiler=profiler, render=False)
+        return crater_field
+
+    craters = detect_regions(bw_img, rois, labels, boxes, factor, thresholds, profiler=profiler)
+    with profiler.stage("crater_field"):
+        crater_field = CraterField(width, height, pack_craters(craters))
+    return crater_field
@@ -0,0 +1,236 @@
+"""
+Tiled detection over a pool of worker processes, without pickling images or craters.
+
+The image is placed once in a file backed memory map (in /dev/shm when there is one) as uint8 grayscale,
+which every worker maps read only, so tiles are read straight from shared pages.
+Workers are sent only window coordinates and send back one float array of the CraterField columns per tile,
+so the result is a field of columns without Crater objects or contours.
+"""
+import mmap
+import os
+import tempfile
+from multiprocessing import Pool
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+import cv2 as cv
+
+from ..profiling import NULL_PROFILER
+from ..raster import Raster
+from ..util import logger
+from crater_detection.models import CraterField
+from . import DetectorWorkspace, detect, get_peak_values
+from .tiling import TileSize, TileOverlap, Window, iter_windows, touches_window_edge, estimate_thresholds
+
+__all__ = ["detect_parallel", "stream_parallel", "iter_parallel", "MappedImage"]
+
+# Defaults
+# Windows sent to a worker at a time
+TilesPerJob = 1
+
+# Where the image is spooled for the workers, if it exists
+SHARED_MEMORY_DIR = '/dev/shm'
+
+# Columns shifted by a window's origin, the rest don't depend on it
+X_COLUMNS = ("x", "high_x", "low_x")
+Y_COLUMNS = ("y", "high_y", "low_y")
+
+
+class MappedImage:
+    """
+    A uint8 grayscale image in a file, described by what's needed to map it again, so it pickles in a few bytes.
+    """
+    def __init__(self, filename: str, shape: Tuple[int, int], offset: int = 0):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.offset = offset
+
+    def open(self) -> np.memmap:
+        return np.memmap(self.filename, dtype=np.uint8, mode='r', offset=self.offset, shape=self.shape)
+
+    @classmethod
+    def of(cls, data) -> 'MappedImage':
+        """
+        :return: the description of an image that's already a mapped uint8 grayscale file, else None
+        """
+        if not isinstance(data, np.memmap) or not isinstance(data.base, mmap.mmap):
+            # Not mapped, or a view into a mapping at an unknown offset
+            return None
+        if data.dtype != np.uint8 or len(data.shape) != 2 or not data.flags['C_CONTIGUOUS']:
+            return None
+        return cls(data.filename, data.shape, data.offset)
+
+
+def spool_image(input_image, directory: str, band_rows: int = TileSize) -> MappedImage:
+    """
+    Writes an image to a file as uint8 grayscale, one band of rows at a time.
+    :param input_image: grayscale or BGR image, or a raster.Raster
+    :param directory: where the file goes, it's removed with the directory
+    :param band_rows: rows converted at a time
+    :return: its description
+    """
+    height, width = input_image.shape[:2]
+    filename = os.path.join(directory, 'image.u8')
+    spool = np.memmap(filename, dtype=np.uint8, mode='w+', shape=(height, width))
+    for y0 in range(0, height, band_rows):
+        band = input_image[y0:y0 + band_rows]
+        if len(band.shape) != 2:
+            band = cv.cvtColor(band, cv.COLOR_BGR2GRAY)
+        spool[y0:y0 + band_rows] = band
+    spool.flush()
+    del spool
+    return MappedImage(filename, (height, width))
+
+
+# Set in each worker by _init_worker
+_image: np.memmap = None
+_thresholds: Tuple[int, int] = None
+_workspace: DetectorWorkspace = None
+
+
+def _init_worker(image: MappedImage, thresholds: Tuple[int, int], verbose: bool):
+    global _image, _thresholds, _workspace
+    logger.set_enabled(verbose)
+    _image = image.open()
+    _thresholds = thresholds
+    _workspace = DetectorWorkspace()
+
+
+def detect_window(image: np.ndarray, core: Window, window: Window, thresholds: Tuple[int, int],
+                  workspace: DetectorWorkspace = None) -> Tuple[np.ndarray, int]:
+    """
+    :param image: the whole grayscale image
+    :param core: the part of the window whose craters are kept
+    :param window: the part of the image to detect in
+    :param thresholds: (low, high)
+    :param workspace: buffers reused from window to window
+    :return: (N, len(CraterField.COLUMNS)) array of the craters centered in the core, in image coordinates,
+        and how many of them run into a window edge
+    """
+    height, width = image.shape
+    y0, y1, x0, x1 = window
+    _, tile_field = detect(image[y0:y1, x0:x1], thresholds=thresholds, render=False, workspace=workspace)
+
+    core_y0, core_y1, core_x0, core_x1 = core
+    x, y = tile_field.x + x0, tile_field.y + y0
+    owned = np.flatnonzero((x >= core_x0) & (x < core_x1) & (y >= core_y0) & (y < core_y1))
+    num_cut = sum(1 for i in owned if touches_window_edge(tile_field.craters[i], window, height, width))
+
+    columns = []
+    for name in CraterField.COLUMNS:
+        values = tile_field.columns[name][owned]
+        if name in X_COLUMNS:
+            values = values + x0
+        elif name in Y_COLUMNS:
+            values = values + y0
+        columns.append(values)
+    return np.column_stack(columns), num_cut
+
+
+def _detect_job(windows) -> Tuple[np.ndarray, int]:
+    results = [detect_window(_image, core, window, _thresholds, _workspace) for core, window in windows]
+    return np.concatenate([rows for rows, _ in results]), sum(num_cut for _, num_cut in results)
+
+
+def iter_parallel(input_image,
+                  tile_size: int = TileSize,
+                  overlap: int = TileOverlap,
+                  thresholds: Tuple[int, int] = None,
+                  workers: int = None,
+                  tiles_per_job: int = TilesPerJob,
+                  verbose: bool = False,
+                  profiler=NULL_PROFILER) -> Iterator[np.ndarray]:
+    """
+    tiling.iter_tiles, with the windows spread over a pool of processes.
+    :param input_image: grayscale or BGR image, or a raster.Raster. A memory mapped uint8 grayscale
+        raster is shared as is, anything else is spooled to a shared file first.
+    :param tile_size: core tile edge in px
+    :param overlap: px each window extends past its core
+    :param thresholds: (low, high) shared by every tile, computed once for the whole image if not given
+    :param workers: number of processes, defaults to the number of cores
+    :param tiles_per_job: windows sent to a worker at a time
+    :param verbose: whether workers should log
+    :param profiler: a profiling.StageProfiler, only the stages of this process are recorded
+    :return: per job, in window order, an (N, len(CraterField.COLUMNS)) array of the craters its windows own
+    """
+    height, width = input_image.shape[:2]
+    workers = workers or os.cpu_count() or 1
+    spool_dir = SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None
+
+    with tempfile.TemporaryDirectory(prefix='crater-detection-', dir=spool_dir) as directory:
+        with profiler.stage("share_image"):
+            image = MappedImage.of(input_image.data if isinstance(input_image, Raster) else input_image)
+            if image is None:
+                image = spool_image(input_image, directory, band_rows=tile_size)
+        logger.debug("Sharing %s with %i workers" % (image.filename, workers))
+
+        with profiler.stage("tile_thresholds"):
+            if thresholds is None:
+                shared = image.open()
+                # As detect_tiled does, so the craters match
+                if isinstance(input_image, np.ndarray) and not isinstance(input_image, np.memmap):
+                    thresholds = get_peak_values(np.asarray(shared))
+                else:
+                    thresholds = estimate_thresholds(shared, band_rows=tile_size)
+                del shared
+        logger.debug("Tile thresholds:", thresholds)
+
+        windows = list(iter_windows(height, width, tile_size, overlap))
+        jobs = [windows[i:i + tiles_per_job] for i in range(0, len(windows), tiles_per_job)]
+        num_cut = 0
+        with Pool(processes=workers, initializer=_init_worker, initargs=(image, thresholds, verbose)) as pool:
+            for i, (rows, job_cut) in enumerate(pool.imap(_detect_job, jobs)):
+                logger.debug("Detected tile job %i of %i" % (i + 1, len(jobs)))
+                num_cut += job_cut
+                yield rows
+
+    if num_cut > 0:
+        logger.info("%i craters were cut by a tile edge, consider a larger overlap" % num_cut)
+
+
+def detect_parallel(input_image,
+                    tile_size: int = TileSize,
+                    overlap: int = TileOverlap,
+                    thresholds: Tuple[int, int] = None,
+                    workers: int = None,
+                    tiles_per_job: int = TilesPerJob,
+                    verbose: bool = False,
+                    profiler=NULL_PROFILER) -> CraterField:
+    """
+    tiling.detect_tiled, with the windows spread over a pool of processes.
+    The craters are the same, in the same order, but only as columns (their enclosing circles can differ
+    in the last float32 digits, as they're found in window rather than image coordinates).
+    :see: iter_parallel for the parameters
+    :return: the crater field in global coordinates, without Crater objects
+    """
+    height, width = input_image.shape[:2]
+    results = list(iter_parallel(input_image, tile_size, overlap, thresholds, workers, tiles_per_job, verbose,
+                                 profiler))
+
+    with profiler.stage("crater_field"):
+        rows = np.concatenate(results) if len(results) > 0 else np.zeros(shape=(0, len(CraterField.COLUMNS)))
+        columns = {name: rows[:, i] for i, name in enumerate(CraterField.COLUMNS)}
+        crater_field = CraterField(width, height, columns=columns)
+    return crater_field
+
+
+def stream_parallel(input_image,
+                    sink,
+                    tile_size: int = TileSize,
+                    overlap: int = TileOverlap,
+                    thresholds: Tuple[int, int] = None,
+                    workers: int = None,
+                    tiles_per_job: int = TilesPerJob,
+                    verbose: bool = False,
+                    profiler=NULL_PROFILER) -> Dict:
+    """
+    detect_parallel, writing each job's craters to a catalog sink as it finishes rather than keeping them.
+    :param sink: a catalog.CatalogSink, left open
+    :see: iter_parallel for the other parameters
+    :return: the stats of all the craters, as CraterField.stats
+    """
+    for rows in iter_parallel(input_image, tile_size, overlap, thresholds, workers, tiles_per_job, verbose,
+                              profiler):
+        with profiler.stage("write_catalog"):
+            sink.write_columns({name: rows[:, i] for i, name in enumerate(CraterField.COLUMNS)})
+    return sink.stats()
@@ -0,0 +1,73 @@
+import numpy as np
+from typing import Tuple
+
+# Defaults
+LowPercentile = 0.001
+HighPercentile = 0.95
+NumBins = 256
+
+
+def local_maxima(values: np.ndarray) -> np.ndarray:
+    """
+    scipy.signal.argrelmax of a 1D array (order 1, ends excluded), without importing scipy.signal.
+    :return: indices of the values larger than both neighbours
+    """
+    middle = values[1:-1]
+    return np.flatnonzero((middle > values[:-2]) & (middle > values[2:])) + 1
+
+
+class PeakHistogram:
+    """
+    Counts of the intensities of local maxima (peaks) in the flattened image, one bin per intensity.
+    Reading a percentile off the cumulative counts gives the same value as sorting every peak,
+    and histograms of separate tiles can be added up to get thresholds for the whole mosaic.
+    """
+    def __init__(self, counts: np.ndarray = None):
+        if counts is None:
+            counts = np.zeros(shape=(NumBins,), dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    def add(self, img: np.ndarray) -> 'PeakHistogram':
+        """
+        Counts the peaks of a grayscale integer image (or tile, or band of rows).
+        :return: self
+        """
+        flattened = np.ravel(img)
+        peak_vals = flattened[local_maxima(flattened)]
+        self.merge(PeakHistogram(np.bincount(peak_vals, minlength=NumBins)))
+        return self
+
+    def merge(self, other: 'PeakHistogram') -> 'PeakHistogram':
+        """
+        :return: self, with the other's counts added
+        """
+        if len(other.counts) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(other.counts) - len(self.counts)), mode='constant')
+        self.counts[:len(other.counts)] += other.counts
+        return self
+
+    def __add__(self, other: 'PeakHistogram') -> 'PeakHistogram':
+        return PeakHistogram(self.counts.copy()).merge(other)
+
+    def num_peaks(self) -> int:
+        return int(np.sum(self.counts))
+
+    def value_at(self, percentile: float) -> int:
+        """
+        :return: the value at floor(num_peaks * percentile) of the sorted peaks
+        """
+        cumulative = np.cumsum(self.counts)
+        if cumulative[-1] == 0:
+            raise ValueError("No peaks to take a percentile of")
+        # sorted_peaks[i] is the first value whose cumulative count passes i
+        index = int(np.floor(cumulative[-1] * percentile))
+        return int(np.searchsorted(cumulative, index, side='right'))
+
+    def thresholds(self, low_percentile=LowPercentile, high_percentile=HighPercentile) -> Tuple[int, int]:
+        """
+        :return: (low, high) intensity thresholds
+        """
+        return self.value_at(low_percentile), self.value_at(high_percentile)
+
+    def to_list(self) -> list:
+        return self.counts.tolist()
@@ -0,0 +1,252 @@
+import numpy as np
+import cv2 as cv
+from typing import Dict, Iterator, List, Tuple
+
+from ..profiling import NULL_PROFILER
+from ..util import logger
+from crater_detection.models import Crater, CraterField, pack_craters
+from . import DetectorWorkspace, detect, get_peak_values
+from .thresholds import PeakHistogram, LowPercentile, HighPercentile
+
+# Defaults
+TileSize = 1024
+TileOverlap = 128
+
+# (y_start, y_end, x_start, x_end)
+Window = Tuple[int, int, int, int]
+
+
+def iter_windows(height: int, width: int, tile_size: int = TileSize, overlap: int = TileOverlap) \
+        -> Iterator[Tuple[Window, Window]]:
+    """
+    Cuts an image into a grid of non-overlapping "core" tiles, each grown by the overlap on every side.
+    Every pixel belongs to exactly one core, which is what lets us assign seam craters to a single tile.
+    :param height: in px
+    :param width: in px
+    :param tile_size: core tile edge in px
+    :param overlap: px added around each core, clipped to the image
+    :return: (core, window) pairs
+    """
+    if tile_size <= 0:
+        raise ValueError("Tile size must be positive, got %i" % tile_size)
+    if overlap < 0:
+        raise ValueError("Tile overlap can't be negative, got %i" % overlap)
+
+    for y0 in range(0, height, tile_size):
+        y1 = min(y0 + tile_size, height)
+        for x0 in range(0, width, tile_size):
+            x1 = min(x0 + tile_size, width)
+            core = (y0, y1, x0, x1)
+            window = (max(y0 - overlap, 0), min(y1 + overlap, height),
+                      max(x0 - overlap, 0), min(x1 + overlap, width))
+            yield core, window
+
+
+def offset_crater(crater: Crater, x_offset: int, y_offset: int) -> Crater:
+    """
+    Moves a crater found in a window back into global image coordinates.
+    :param crater:
+    :param x_offset: in px
+    :param y_offset: in px
+    :return: a new crater
+    """
+    offset = np.array([x_offset, y_offset], dtype=crater.full_contour.dtype)
+
+    def offset_circle(circle):
+        (x, y), rad = circle
+        return (x + x_offset, y + y_offset), rad
+
+    return Crater(crater.high_contour + offset,
+                  crater.low_contour + offset,
+                  crater.full_contour + offset,
+                  high_circle=offset_circle(crater.high_enclosing_circle()),
+                  low_circle=offset_circle(crater.low_enclosing_circle()))
+
+
+def touches_window_edge(crater: Crater, window: Window, height: int, width: int) -> bool:
+    """
+    Whether a crater (in window coordinates) runs into a window edge that is not also an image edge,
+    meaning it was probably cut off and the overlap is too small for it.
+    """
+    y0, y1, x0, x1 = window
+    x, y, w, h = crater.bounding_rect()
+    return (x <= 0 < x0) or (y <= 0 < y0) or \
+           (x + w >= x1 - x0 and x1 < width) or \
+           (y + h >= y1 - y0 and y1 < height)
+
+
+def estimate_thresholds(input_image, band_rows: int = TileSize,
+                        low_percentile=LowPercentile, high_percentile=HighPercentile) -> Tuple[int, int]:
+    """
+    get_peak_values, one band of rows at a time, for images that shouldn't be loaded whole.
+    :param input_image: grayscale or BGR uint8 image, or a raster.Raster
+    :param band_rows: rows read at a time
+    :param low_percentile: [0.001]
+    :param high_percentile: [0.95]
+    :return: (low, high) thresholds
+    """
+    return peak_histogram(input_image, band_rows).thresholds(low_percentile, high_percentile)
+
+
+def peak_histogram(input_image, band_rows: int = TileSize) -> PeakHistogram:
+    """
+    :param input_image: grayscale or BGR uint8 image, or a raster.Raster
+    :param band_rows: rows read at a time
+    :return: the peak histogram of the whole image, built band by band
+    """
+    histogram = PeakHistogram()
+    for y0 in range(0, input_image.shape[0], band_rows):
+        band = input_image[y0:y0 + band_rows]
+        if len(band.shape) != 2:
+            band = cv.cvtColor(band, cv.COLOR_BGR2GRAY)
+        histogram.add(band)
+    return histogram
+
+
+def tile_thresholds(input_image, tile_size: int = TileSize) -> Tuple[int, int]:
+    """
+    :return: the (low, high) thresholds of the whole image, from all of it when it's in memory,
+        else with a streaming pass
+    """
+    in_memory = isinstance(input_image, np.ndarray) and not isinstance(input_image, np.memmap)
+    if not in_memory:
+        return estimate_thresholds(input_image, band_rows=tile_size)
+    if len(input_image.shape) == 2:
+        bw_img = input_image
+    else:
+        bw_img = cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+    return get_peak_values(bw_img)
+
+
+def iter_tiles(input_image,
+               tile_size: int = TileSize,
+               overlap: int = TileOverlap,
+               thresholds: Tuple[int, int] = None,
+               profiler=NULL_PROFILER) -> Iterator[List[Crater]]:
+    """
+    Runs detection window by window so working memory is bounded by the window size.
+    Craters are kept by the tile whose core contains their center, so a crater crossing a seam
+    is reported once.
+    :param input_image: see detect_tiled
+    :param tile_size: core tile edge in px
+    :param overlap: px each window extends past its core
+    :param thresholds: (low, high), computed once for the whole image if not given
+    :param profiler: a profiling.StageProfiler, stages are summed over the tiles
+    :return: per tile, the craters it owns in global coordinates
+    """
+    height, width = input_image.shape[:2]
+
+    with profiler.stage("tile_thresholds"):
+        if thresholds is None:
+            thresholds = tile_thresholds(input_image, tile_size)
+    logger.debug("Tile thresholds:", thresholds)
+
+    num_cut = 0
+    windows = list(iter_windows(height, width, tile_size, overlap))
+    # Every window is at most this big, so the buffers are allocated once
+    workspace = DetectorWorkspace((min(tile_size + 2 * overlap, height), min(tile_size + 2 * overlap, width)))
+    for i, (core, window) in enumerate(windows):
+        y0, y1, x0, x1 = window
+        logger.debug("Detecting tile %i of %i at %s" % (i + 1, len(windows), window))
+        with profiler.stage("read_tile"):
+            tile_image = input_image[y0:y1, x0:x1]
+        _, tile_field = detect(tile_image, thresholds=thresholds, profiler=profiler, render=False,
+                               workspace=workspace)
+
+        core_y0, core_y1, core_x0, core_x1 = core
+        craters: List[Crater] = []
+        with profiler.stage("merge_tiles"):
+            for crater in tile_field.craters:
+                (x, y), _ = crater.min_enclosing_circle()
+                x += x0
+                y += y0
+                if not (core_x0 <= x < core_x1 and core_y0 <= y < core_y1):
+                    # Owned by a neighbouring tile
+                    continue
+                if touches_window_edge(crater, window, height, width):
+                    num_cut += 1
+                craters.append(offset_crater(crater, x0, y0))
+        yield craters
+
+    if num_cut > 0:
+        logger.info("%i craters were cut by a tile edge, consider a larger overlap" % num_cut)
+
+
+def detect_tiled(input_image: np.ndarray,
+                 tile_size: int = TileSize,
+                 overlap: int = TileOverlap,
+                 thresholds: Tuple[int, int] = None,
+                 profiler=NULL_PROFILER) -> CraterField:
+    """
+    Results match a single-pass run as long as the overlap is larger than
+    the biggest crater diameter plus the closing kernel.
+    :see: iter_tiles
+    :param input_image: grayscale or BGR image, or a raster.Raster which is only read window by window
+    :param tile_size: core tile edge in px
+    :param overlap: px each window extends past its core
+    :param thresholds: (low, high) intensity thresholds shared by every tile,
+        computed once for the whole image if not given
+    :param profiler: a profiling.StageProfiler, stages are summed over the tiles
+    :return: the crater field in global coordinates
+    """
+    height, width = input_image.shape[:2]
+    craters: List[Crater] = []
+    for tile_craters in iter_tiles(input_image, tile_size, overlap, thresholds, profiler):
+        craters.extend(tile_craters)
+
+    with profiler.stage("crater_field"):
+        crater_field = CraterField(width, height, pack_craters(craters))
+    return crater_field
+
+
+def stream_tiled(input_image,
+                 sink,
+                 tile_size: int = TileSize,
+                 overlap: int = TileOverlap,
+                 thresholds: Tuple[int, int] = None,
+                 profiler=NULL_PROFILER) -> Dict:
+    """
+    detect_tiled, writing each tile's craters to a catalog sink as it finishes rather than keeping them,
+    so memory doesn't grow with the number of craters.
+    :param input_image: see detect_tiled
+    :param sink: a catalog.CatalogSink, left open
+    :param tile_size: see detect_tiled
+    :param overlap: see detect_tiled
+    :param thresholds: see detect_tiled
+    :param profiler: see detect_tiled
+    :return: the stats of all the craters, as CraterField.stats
+    """
+    height, width = input_image.shape[:2]
+    for tile_craters in iter_tiles(input_image, tile_size, overlap, thresholds, profiler):
+        with profiler.stage("write_catalog"):
+            sink.write(CraterField(width, height, tile_craters))
+    return sink.stats()
+
+
+def draw_craters(input_image: np.ndarray, crater_field: CraterField) -> np.ndarray:
+    """
+    Renders an overlay of a crater field, as detect does for a single pass.
+    :param input_image: grayscale or BGR image the field was detected in, read whole
+    :param crater_field: fields without Crater objects are drawn as circles
+    :return: BGR image
+    """
+    input_image = input_image[:]
+    if len(input_image.shape) == 2:
+        color_image = cv.cvtColor(input_image, cv.COLOR_GRAY2BGR)
+    else:
+        color_image = cv.cvtColor(cv.cvtColor(input_image, cv.COLOR_BGR2GRAY), cv.COLOR_GRAY2BGR)
+
+    craters = crater_field.craters
+    if len(craters) == 0:
+        for x, y, rad in np.column_stack((crater_field.x, crater_field.y, crater_field.radius)):
+            cv.circle(color_image, (int(round(x)), int(round(y))), int(round(rad)), (0, 255, 0), 2)
+    cv.drawContours(color_image, [c.low_contour for c in craters], -1, (0, 0, 255), 2)
+    cv.drawContours(color_image, [c.high_contour for c in craters], -1, (255, 0, 0), 2)
+    cv.drawContours(color_image, [c.full_contour for c in craters], -1, (0, 255, 0), 2)
+
+    high_pos = np.int64(np.around(np.column_stack((crater_field.high_x, crater_field.high_y))))
+    low_pos = np.int64(np.around(np.column_stack((crater_field.low_x, crater_field.low_y))))
+    for h_pos, l_pos in zip(high_pos, low_pos):
+        cv.line(color_image, tuple(map(int, h_pos)), tuple(map(int, l_pos)), (0, 0, 0), 2)
+
+    return color_image
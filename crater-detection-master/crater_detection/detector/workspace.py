@@ -0,0 +1,45 @@
+from typing import Dict, Tuple
+import numpy as np
+
+
+class DetectorWorkspace:
+    """
+    The full size buffers of detect (grayscale image, threshold masks, closed masks and overlay),
+    kept from call to call so detecting one same-sized tile after another doesn't allocate them again.
+    OpenCV writes into them through dst=.
+    Each buffer grows to the largest image it has been used for, smaller images use the front of it,
+    so tiles cut short at the image's edges reuse it too.
+    A workspace is only for one detect at a time, use one per thread or process.
+    """
+    def __init__(self, shape: Tuple[int, ...] = None, render: bool = False):
+        """
+        :param shape: (height, width) to allocate for up front, buffers are allocated on first use if not given
+        :param render: whether to allocate the overlay buffer up front too
+        """
+        self._buffers: Dict[str, np.ndarray] = {}
+        # Number of times a buffer was (re)allocated, stays put once warm
+        self.num_allocations = 0
+        if shape is not None:
+            height, width = shape[:2]
+            for name in ("gray", "low_mask", "high_mask", "low_closed", "high_closed"):
+                self.buffer(name, (height, width))
+            if render:
+                self.buffer("color", (height, width, 3))
+
+    def buffer(self, name: str, shape: Tuple[int, ...]) -> np.ndarray:
+        """
+        :param name: of the buffer
+        :param shape: of the uint8 array needed
+        :return: a C contiguous view of the buffer, with whatever the last use left in it
+        """
+        size = int(np.prod(shape))
+        flat = self._buffers.get(name)
+        if flat is None or flat.size < size:
+            flat = np.empty(shape=(size,), dtype=np.uint8)
+            self._buffers[name] = flat
+            self.num_allocations += 1
+        return flat[:size].reshape(shape)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(flat.nbytes for flat in self._buffers.values())
@@ -0,0 +1,247 @@
+"""
+Scores detector configurations against the ground truth of generated crater fields,
+so a faster setting can be weighed against what it costs in precision / recall.
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+import cv2 as cv
+import numpy as np
+from scipy.spatial import cKDTree
+
+from . import benchmark, detector, generator
+from .detector import fused, hough, multiscale, tiling
+from .util import logger
+
+# Defaults
+FieldSize = 1024
+NumFields = 3
+# A match's center must be within this fraction of the true (outer) radius
+MaxCenterError = 0.5
+# and its radius within this fraction of the true one
+MaxRadiusError = 0.5
+Repeat = 1
+HoughMaxSize = benchmark.HoughMaxSize
+
+# (N, 3) array of [x, y, radius] rows, from a BGR image
+Detector = Callable[[np.ndarray], np.ndarray]
+
+
+def field_circles(crater_field) -> np.ndarray:
+    return np.column_stack((crater_field.x, crater_field.y, crater_field.radius))
+
+
+def detect_contours(input_image: np.ndarray, chain_approx: int = detector.ChainApprox) -> np.ndarray:
+    _, crater_field = detector.detect(input_image, render=False, chain_approx=chain_approx)
+    return field_circles(crater_field)
+
+
+def detect_downsampled(input_image: np.ndarray, levels: int = 1) -> np.ndarray:
+    """
+    Detects on an image halved `levels` times, scaled back to full resolution.
+    """
+    for _ in range(levels):
+        input_image = cv.pyrDown(input_image)
+    return detect_contours(input_image) * (2 ** levels)
+
+
+def detect_tiles(input_image: np.ndarray, tile_size: int = 512) -> np.ndarray:
+    return field_circles(tiling.detect_tiled(input_image, tile_size=tile_size))
+
+
+def detect_coarse_to_fine(input_image: np.ndarray, levels: int = multiscale.Levels) -> np.ndarray:
+    return field_circles(multiscale.detect_multiscale(input_image, levels=levels))
+
+
+def detect_fused(input_image: np.ndarray, confirmed_only: bool = False) -> np.ndarray:
+    return field_circles(fused.detect_fused(input_image, confirmed_only=confirmed_only))
+
+
+def detect_hough(input_image: np.ndarray, steps: int = 3, max_up_levels: int = None) -> np.ndarray:
+    bw_img = cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+    return np.float64(hough.find_circles(bw_img, steps=steps, max_up_levels=max_up_levels))
+
+
+CONFIGS = OrderedDict([
+    ("contour", detect_contours),
+    ("contour-chain-simple", lambda img: detect_contours(img, chain_approx=cv.CHAIN_APPROX_SIMPLE)),
+    ("contour-half-res", lambda img: detect_downsampled(img, levels=1)),
+    ("contour-tiled", detect_tiles),
+    ("contour-coarse-to-fine", detect_coarse_to_fine),
+    ("fused", detect_fused),
+    ("fused-confirmed-only", lambda img: detect_fused(img, confirmed_only=True)),
+    ("hough", detect_hough),
+    ("hough-no-upsampling", lambda img: detect_hough(img, max_up_levels=0)),
+])
+
+
+def match_craters(truth: np.ndarray, detected: np.ndarray,
+                  max_center_error: float = MaxCenterError,
+                  max_radius_error: float = MaxRadiusError) -> np.ndarray:
+    """
+    One to one matching of detections to true craters, closest centers first.
+    :param truth: (N, 3) array of [x, y, radius]
+    :param detected: (M, 3) array of [x, y, radius]
+    :param max_center_error: fraction of the true radius
+    :param max_radius_error: fraction of the true radius
+    :return: (K, 2) array of [truth index, detected index] pairs
+    """
+    if len(truth) == 0 or len(detected) == 0:
+        return np.zeros(shape=(0, 2), dtype=np.intp)
+
+    truth_tree = cKDTree(truth[:, :2])
+    detected_tree = cKDTree(detected[:, :2])
+    candidates = truth_tree.query_ball_tree(detected_tree, r=max_center_error * np.max(truth[:, 2]))
+
+    pairs = []
+    for t_i, d_indices in enumerate(candidates):
+        if len(d_indices) == 0:
+            continue
+        d_indices = np.asarray(d_indices, dtype=np.intp)
+        t_x, t_y, t_rad = truth[t_i]
+        dists = np.hypot(detected[d_indices, 0] - t_x, detected[d_indices, 1] - t_y)
+        keep = (dists <= max_center_error * t_rad) & \
+               (np.abs(detected[d_indices, 2] - t_rad) <= max_radius_error * t_rad)
+        pairs.extend(zip(dists[keep], [t_i] * int(np.sum(keep)), d_indices[keep]))
+
+    pairs.sort()
+    matches = []
+    truth_used = set()
+    detected_used = set()
+    for _, t_i, d_i in pairs:
+        if t_i in truth_used or d_i in detected_used:
+            continue
+        truth_used.add(t_i)
+        detected_used.add(d_i)
+        matches.append((t_i, d_i))
+
+    return np.array(matches, dtype=np.intp).reshape(-1, 2)
+
+
+def score(truth: np.ndarray, detected: np.ndarray, **match_params) -> Dict:
+    """
+    :param truth: (N, 3) array of [x, y, radius]
+    :param detected: (M, 3) array of [x, y, radius]
+    :param match_params: see match_craters
+    :return: counts, precision, recall, F1 and the mean errors of the matches
+    """
+    matches = match_craters(truth, detected, **match_params)
+    num_matched = len(matches)
+    precision = num_matched / len(detected) if len(detected) > 0 else np.nan
+    recall = num_matched / len(truth) if len(truth) > 0 else np.nan
+    f1 = 2 * precision * recall / (precision + recall) if num_matched > 0 else 0.0
+
+    center_error = radius_error = np.nan
+    if num_matched > 0:
+        matched_truth = truth[matches[:, 0]]
+        matched = detected[matches[:, 1]]
+        center_error = float(np.mean(np.hypot(*(matched[:, :2] - matched_truth[:, :2]).T)))
+        radius_error = float(np.mean(np.abs(matched[:, 2] - matched_truth[:, 2])))
+
+    return {
+        "num_truth": len(truth),
+        "num_detected": len(detected),
+        "num_matched": num_matched,
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "mean_center_error": center_error,
+        "mean_radius_error": radius_error,
+    }
+
+
+def truth_circles(truth: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    Detectors enclose the light and shadow crescents, so they're scored against the outer radius.
+    """
+    return np.column_stack((truth["x"], truth["y"], truth["outer_radius"]))
+
+
+def summarize(cases: List[Dict]) -> List[Dict]:
+    """
+    Pools the counts over every field of each configuration.
+    """
+    summary = OrderedDict()
+    for case in cases:
+        row = summary.setdefault(case["config"], {
+            "config": case["config"],
+            "num_fields": 0,
+            "seconds": 0.0,
+            "num_truth": 0,
+            "num_detected": 0,
+            "num_matched": 0,
+        })
+        row["num_fields"] += 1
+        row["seconds"] += case["seconds"]
+        for key in ("num_truth", "num_detected", "num_matched"):
+            row[key] += case["score"][key]
+
+    for row in summary.values():
+        row["mean_seconds"] = row["seconds"] / row["num_fields"]
+        row["precision"] = row["num_matched"] / row["num_detected"] if row["num_detected"] > 0 else np.nan
+        row["recall"] = row["num_matched"] / row["num_truth"] if row["num_truth"] > 0 else np.nan
+        total = row["precision"] + row["recall"]
+        row["f1"] = 2 * row["precision"] * row["recall"] / total if total > 0 else 0.0
+    return list(summary.values())
+
+
+def evaluate(configs: List[str] = None,
+             num_fields: int = NumFields,
+             size: int = FieldSize,
+             num_craters: int = generator.NCraters,
+             sun_angle: float = generator.SunAngle,
+             rand_seed: int = 1,
+             repeat: int = Repeat,
+             hough_max_size: int = HoughMaxSize,
+             **match_params) -> Dict:
+    """
+    Runs every configuration over the same generated fields.
+    :param configs: names from CONFIGS, defaults to all of them
+    :param num_fields: fields generated per run
+    :param size: field edge in px
+    :param num_craters: per field
+    :param sun_angle: in degrees
+    :param rand_seed: seeds the per field seeds
+    :param repeat: runs per field, the best time is reported
+    :param hough_max_size: largest field size to run the Hough configurations on
+    :param match_params: see match_craters
+    :return: per field cases and a per configuration summary
+    """
+    configs = configs or list(CONFIGS.keys())
+    for name in configs:
+        if name not in CONFIGS:
+            raise ValueError("Unknown configuration '%s', choose from: %s" % (name, ", ".join(CONFIGS)))
+    if size > hough_max_size:
+        configs = [name for name in configs if not name.startswith("hough")]
+
+    cases = []
+    for seed in generator.field_seeds(num_fields, rand_seed):
+        input_image, _, truth = generator.generate(num_craters=num_craters,
+                                                   width=size,
+                                                   height=size,
+                                                   sun_angle=sun_angle,
+                                                   rand_seed=int(seed),
+                                                   return_truth=True)
+        true_circles = truth_circles(truth)
+
+        for name in configs:
+            timing = benchmark.time_call(lambda: CONFIGS[name](input_image), repeat)
+            case_score = score(true_circles, timing["result"], **match_params)
+            logger.debug("%s on field %i: %.4fs, precision %.3f, recall %.3f" %
+                         (name, seed, timing["best"], case_score["precision"], case_score["recall"]))
+            cases.append({
+                "config": name,
+                "seed": int(seed),
+                "seconds": timing["best"],
+                "score": case_score,
+            })
+
+    return {
+        "environment": benchmark.environment(),
+        "size": size,
+        "num_craters": num_craters,
+        "sun_angle": sun_angle,
+        "repeat": repeat,
+        "cases": cases,
+        "summary": summarize(cases),
+    }
@@ -1,8 +1,14 @@
+import json
+import os
+from multiprocessing import Pool
+from typing import Tuple, Dict, List
+
 import cv2 as cv
 import numpy as np
-from typing import Tuple, Dict
 
-__all__ = ["generate"]
+from ..util import logger, to_builtin
+
+__all__ = ["generate", "generate_dataset", "sample_craters", "ground_truth"]
 
 # Defaults
 SunAngle = 0
@@ -21,6 +27,81 @@ LIGHT_COLOR = (255, 255, 255)
 BG_COLOR = (100, 100, 100)
 
 
+def sample_craters(rng: np.random.Generator,
+                   num_craters: int = NCraters,
+                   width: int = FieldX,
+                   height: int = FieldY,
+                   min_radius: float = MinCrater,
+                   max_radius: float = MaxCrater,
+                   shadow_factor: float = CraterShadowFactor,
+                   alpha: float = Alpha,
+                   sun_angle: float = SunAngle) -> Dict[str, np.ndarray]:
+    """
+    Draws every crater of a field at once, sizes follow a power law with exponent alpha.
+    :param rng: a local random generator, so fields don't share the global state
+    :return: arrays of the crater centers, radii, and light / shadow circle centers
+    """
+    crater_x = rng.integers(0, width, size=num_craters)
+    crater_y = rng.integers(0, height, size=num_craters)
+    uni = rng.uniform(0, 1, size=num_craters)
+
+    angle_rad = np.deg2rad(sun_angle)
+    crater_a = min_radius ** (alpha + 1)
+    crater_b = max_radius ** (alpha + 1) - crater_a
+
+    crater_real = (crater_a + (crater_b * uni)) ** (1 / (1 + alpha))
+    crater_size = np.floor(crater_real)
+
+    # draw light -> gray -> dark
+    shadow_dist = np.round(crater_size / shadow_factor)
+    crater_offset_x = np.cos(angle_rad) * shadow_dist
+    crater_offset_y = np.sin(angle_rad) * shadow_dist
+    crater_radius = np.round(crater_size - (crater_size / shadow_factor / 2)).astype(int)
+
+    return {
+        "x": crater_x,
+        "y": crater_y,
+        "radius": crater_radius,
+        # int() truncation, as cv.circle needs ints
+        "light_x": (crater_x - crater_offset_x).astype(int),
+        "light_y": (crater_y - crater_offset_y).astype(int),
+        "shadow_x": (crater_x + crater_offset_x).astype(int),
+        "shadow_y": (crater_y + crater_offset_y).astype(int),
+    }
+
+
+def ground_truth(craters: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    The table of craters as drawn, in drawing order (later craters may cover earlier ones).
+    :param craters: from sample_craters
+    :return: arrays of the crater centers, drawn radii, and outer radii,
+        which take in the light and shadow circles, as a detector's enclosing circle would
+    """
+    shadow_dist = np.hypot(craters["shadow_x"] - craters["x"], craters["shadow_y"] - craters["y"])
+    return {
+        "x": craters["x"].astype(np.float64),
+        "y": craters["y"].astype(np.float64),
+        "radius": craters["radius"].astype(np.float64),
+        "outer_radius": craters["radius"] + shadow_dist,
+    }
+
+
+def write_ground_truth(truth: Dict[str, np.ndarray], filename: str):
+    """
+    Writes the table as CSV, one crater per row.
+    """
+    names = list(truth.keys())
+    np.savetxt(filename, np.column_stack([truth[name] for name in names]),
+               fmt='%.9g', delimiter=',', header=','.join(names), comments='')
+
+
+def read_ground_truth(filename: str) -> Dict[str, np.ndarray]:
+    with open(filename) as truth_file:
+        names = truth_file.readline().strip().split(',')
+    table = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2)
+    return {name: table[:, i] for i, name in enumerate(names)}
+
+
 def generate(num_craters: int = NCraters,
              width: int=FieldX,
              height: int=FieldY,
@@ -29,7 +110,8 @@ def generate(num_craters: int = NCraters,
              shadow_factor: float=CraterShadowFactor,
              alpha: float=Alpha,
              rand_seed = None,
-             sun_angle: float=SunAngle) -> Tuple[np.ndarray, Dict]:
+             sun_angle: float=SunAngle,
+             return_truth: bool = False) -> Tuple:
     """
     :param num_craters:
     :param width: in px
@@ -38,38 +120,31 @@ def generate(num_craters: int = NCraters,
     :param max_radius: in px
     :param shadow_factor:
     :param alpha:
+    :param rand_seed: seeds a random generator local to this field
     :param sun_angle: in degrees
-    :return:
+    :param return_truth: also return the ground truth table, see ground_truth
+    :return: the image and its stats, then the ground truth if asked for
     """
-    if rand_seed is not None:
-        np.random.seed(rand_seed)
+    rng = np.random.default_rng(rand_seed)
+    craters = sample_craters(rng,
+                             num_craters=num_craters,
+                             width=width,
+                             height=height,
+                             min_radius=min_radius,
+                             max_radius=max_radius,
+                             shadow_factor=shadow_factor,
+                             alpha=alpha,
+                             sun_angle=sun_angle)
 
     output_img = np.full([height, width, 3], BG_COLOR, dtype=np.uint8)
-    output_radii = []
-
-    angle_rad = np.deg2rad(sun_angle)
-    crater_a = min_radius ** (Alpha + 1)
-    crater_b = max_radius ** (Alpha + 1) - crater_a
 
+    # Craters overlap, so they still have to be drawn in order
     for i in range(num_craters):
-        crater_x = np.random.randint(0, width)
-        crater_y = np.random.randint(0, height)
-
-        uni = np.random.uniform(0, 1)
-
-        crater_real = (crater_a + (crater_b * uni)) ** (1 / (1 + alpha))
-        crater_size = np.floor(crater_real)
-
-        # draw light -> gray -> dark
-        crater_offset_x = np.cos(angle_rad) * int(np.round(crater_size / shadow_factor))
-        crater_offset_y = np.sin(angle_rad) * int(np.round(crater_size / shadow_factor))
-        crater_radius = int(np.round(crater_size - (crater_size / shadow_factor / 2)))
-
-        output_radii.append(crater_radius)
+        crater_radius = int(craters["radius"][i])
 
         # Light
         cv.circle(output_img,
-                  (int(crater_x - crater_offset_x), int(crater_y - crater_offset_y)),
+                  (int(craters["light_x"][i]), int(craters["light_y"][i])),
                   crater_radius,
                   LIGHT_COLOR,
                   cv.FILLED,
@@ -78,7 +153,7 @@ def generate(num_craters: int = NCraters,
 
         # Shadow
         cv.circle(output_img,
-                  (int(crater_x + crater_offset_x), int(crater_y + crater_offset_y)),
+                  (int(craters["shadow_x"][i]), int(craters["shadow_y"][i])),
                   crater_radius,
                   SHADOW_COLOR,
                   cv.FILLED,
@@ -87,14 +162,14 @@ def generate(num_craters: int = NCraters,
 
         # Background in the middle
         cv.circle(output_img,
-                  (crater_x, crater_y),
+                  (int(craters["x"][i]), int(craters["y"][i])),
                   crater_radius,
                   BG_COLOR,
                   cv.FILLED,
                   cv.LINE_AA,  # line type
                   )
 
-    raddi_arr = np.array(output_radii)
+    raddi_arr = craters["radius"]
     stats = {
         "min_rad": np.min(raddi_arr),
         "max_rad": np.max(raddi_arr),
@@ -107,4 +182,57 @@ def generate(num_craters: int = NCraters,
         "alpha": alpha,
     }
 
+    if return_truth:
+        return output_img, stats, ground_truth(craters)
     return output_img, stats
+
+
+def field_seeds(num_fields: int, rand_seed=None) -> np.ndarray:
+    """
+    :return: one seed per field, all derived from rand_seed so a dataset can be regenerated
+    """
+    return np.random.default_rng(rand_seed).integers(0, 2 ** 31 - 1, size=num_fields)
+
+
+def _generate_job(job) -> Dict:
+    out_filename, seed, params = job
+    output_image, stats, truth = generate(rand_seed=int(seed), return_truth=True, **params)
+    cv.imwrite(out_filename, output_image)
+    truth_filename = os.path.splitext(out_filename)[0] + '.csv'
+    write_ground_truth(truth, truth_filename)
+    stats = to_builtin(stats)
+    stats["seed"] = int(seed)
+    stats["file"] = out_filename
+    stats["truth_file"] = truth_filename
+    return stats
+
+
+def generate_dataset(output_dir: str,
+                     num_fields: int,
+                     rand_seed=None,
+                     workers: int = None,
+                     **params) -> List[Dict]:
+    """
+    Generates fields in parallel, each written to the output dir with its own reproducible seed.
+    :param output_dir:
+    :param num_fields:
+    :param rand_seed: seeds the per field seeds
+    :param workers: number of processes, defaults to the number of cores
+    :param params: passed to generate
+    :return: the stats of each field, also written to fields.json in the output dir.
+        Each field's ground truth is written next to its image as CSV.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+
+    jobs = [(os.path.join(output_dir, 'field-%05i.png' % i), seed, params)
+            for i, seed in enumerate(field_seeds(num_fields, rand_seed))]
+
+    with Pool(processes=workers) as pool:
+        fields = pool.map(_generate_job, jobs, chunksize=max(1, num_fields // (workers * 4)))
+    logger.info("Generated %i fields with %i workers" % (len(fields), workers))
+
+    with open(os.path.join(output_dir, 'fields.json'), 'w') as fields_file:
+        json.dump(fields, fields_file, indent=2)
+
+    return fields
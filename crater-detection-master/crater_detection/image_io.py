@@ -0,0 +1,95 @@
+"""
+Reading and writing images, through OpenCV imported on first use.
+
+Detection only needs intensities, so images can be decoded straight to grayscale,
+and JPEGs can be decoded at 1/2, 1/4 or 1/8 scale, which libjpeg does without decoding the full image.
+Color images are returned as RGB and written from RGB, as scipy.misc.imread / imsave did.
+"""
+import errno
+import os
+
+__all__ = ["read_image", "decode_image", "write_image", "show_image", "DECODE_SCALES"]
+
+DECODE_SCALES = (1, 2, 4, 8)
+
+
+def _read_flags(cv, gray: bool, scale: int) -> int:
+    if scale not in DECODE_SCALES:
+        raise ValueError("Decode scale must be one of %s, got %s" % (DECODE_SCALES, scale))
+    if gray:
+        return {
+            1: cv.IMREAD_GRAYSCALE,
+            2: cv.IMREAD_REDUCED_GRAYSCALE_2,
+            4: cv.IMREAD_REDUCED_GRAYSCALE_4,
+            8: cv.IMREAD_REDUCED_GRAYSCALE_8,
+        }[scale]
+    return {
+        1: cv.IMREAD_COLOR,
+        2: cv.IMREAD_REDUCED_COLOR_2,
+        4: cv.IMREAD_REDUCED_COLOR_4,
+        8: cv.IMREAD_REDUCED_COLOR_8,
+    }[scale]
+
+
+def read_image(filename: str, gray: bool = False, scale: int = 1):
+    """
+    :param filename:
+    :param gray: decode straight to a single channel
+    :param scale: one of DECODE_SCALES, the image is decoded at 1 / scale of its size
+        (in the decoder for JPEGs, resized after decoding for other formats)
+    :return: uint8 grayscale or RGB image
+    """
+    import cv2 as cv
+
+    image = cv.imread(filename, _read_flags(cv, gray, scale))
+    if image is None:
+        if not os.path.isfile(filename):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+        raise ValueError("Can't decode image: " + filename)
+    if not gray:
+        image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
+    return image
+
+
+def decode_image(buffer: bytes, gray: bool = False, scale: int = 1):
+    """
+    read_image, from the bytes of an image file.
+    """
+    import cv2 as cv
+    import numpy as np
+
+    image = cv.imdecode(np.frombuffer(buffer, dtype=np.uint8), _read_flags(cv, gray, scale))
+    if image is None:
+        raise ValueError("Can't decode the image bytes")
+    if not gray:
+        image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
+    return image
+
+
+def write_image(filename: str, image):
+    """
+    :param filename: the format is picked by the extension
+    :param image: grayscale or RGB
+    """
+    import cv2 as cv
+
+    if len(image.shape) == 3 and image.shape[2] == 3:
+        image = cv.cvtColor(image, cv.COLOR_RGB2BGR)
+    if not cv.imwrite(filename, image):
+        raise ValueError("Can't write image: " + filename)
+
+
+def show_image(image, title: str = "crater_detection"):
+    """
+    Shows the image in a window until a key is pressed.
+    :param image: grayscale or RGB
+    :param title: of the window
+    """
+    import cv2 as cv
+
+    if len(image.shape) == 3 and image.shape[2] == 3:
+        image = cv.cvtColor(image, cv.COLOR_RGB2BGR)
+    cv.namedWindow(title, cv.WINDOW_NORMAL)
+    cv.imshow(title, image)
+    cv.waitKey(0)
+    cv.destroyWindow(title)
@@ -0,0 +1,78 @@
+from typing import List
+import numpy as np
+
+INT16_MAX = np.iinfo(np.int16).max
+
+
+class ContourStore:
+    """
+    Many contours packed into one (P, 2) array of points, contour i being points[offsets[i]:offsets[i + 1]],
+    instead of an array (and its header) per contour.
+    Points are int16 when every coordinate fits, OpenCV gets them as int32.
+    The enclosing circle of each contour can be kept alongside, as one row per contour.
+    """
+    __slots__ = ("points", "offsets", "circles")
+
+    def __init__(self, points: np.ndarray, offsets: np.ndarray, circles: np.ndarray = None):
+        """
+        :param points: (P, 2) array of [x, y]
+        :param offsets: (N + 1,) start of each contour, then P
+        :param circles: (N, 3) array of [x, y, radius], the enclosing circle of each contour
+        """
+        self.points = points
+        self.offsets = offsets
+        self.circles = circles
+
+    @classmethod
+    def pack(cls, contours: List[np.ndarray], dtype=None, circles: np.ndarray = None) -> 'ContourStore':
+        """
+        :param contours: (n, 2) or (n, 1, 2) arrays of [x, y]
+        :param dtype: of the points, the smallest of int16 / int32 that fits if not given
+        :param circles: (N, 3) array of [x, y, radius], the enclosing circle of each contour
+        :return: a store of copies of the contours
+        """
+        lengths = np.array([len(c) for c in contours], dtype=np.int64)
+        offsets = np.zeros(shape=(len(contours) + 1,), dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if circles is not None:
+            circles = np.asarray(circles, dtype=np.float64).reshape(-1, 3)
+        if len(contours) == 0 or offsets[-1] == 0:
+            return cls(np.zeros(shape=(0, 2), dtype=dtype or np.int16), offsets, circles)
+
+        points = np.concatenate([np.reshape(c, (-1, 2)) for c in contours])
+        if dtype is None:
+            fits = np.max(np.abs(points)) <= INT16_MAX
+            dtype = np.int16 if fits else np.int32
+        return cls(points.astype(dtype, copy=False), offsets, circles)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        """
+        :return: a view of contour i, in the stored dtype
+        """
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def contour(self, start: int, end: int = None) -> np.ndarray:
+        """
+        :param start: first contour
+        :param end: one past the last contour, contours in between are joined, start + 1 if not given
+        :return: (n, 2) int32 points, a view when stored as int32
+        """
+        end = start + 1 if end is None else end
+        return self.points[self.offsets[start]:self.offsets[end]].astype(np.int32, copy=False)
+
+    def circle(self, i: int):
+        """
+        :return: ((x, y), radius) of contour i, None if the circles aren't kept
+        """
+        if self.circles is None:
+            return None
+        x, y, rad = self.circles[i].tolist()
+        return (x, y), rad
+
+    @property
+    def nbytes(self) -> int:
+        circle_bytes = self.circles.nbytes if self.circles is not None else 0
+        return self.points.nbytes + self.offsets.nbytes + circle_bytes
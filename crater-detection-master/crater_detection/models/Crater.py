@@ -1,23 +1,91 @@
-from typing import Tuple
+from typing import List, Tuple
 import cv2 as cv
 import numpy as np
 from ..util import angle_between_points, angle_between_with_origin
+from .ContourStore import ContourStore
+
+# ((x, y), radius), as returned by cv.minEnclosingCircle
+Circle = Tuple[Tuple[float, float], float]
 
 
 class Crater:
     """
+    A bright (high) contour paired with its shadow (low) contour.
+    The enclosing circles and area are computed on first use and cached, contours shouldn't be changed after.
+    Contours are either arrays of their own, or the high contour is contour i of a ContourStore
+    and the low one contour i + 1, so the full contour is a single slice of it.
+    A store's circles are read from it rather than cached on each crater.
     """
-    def __init__(self, high_c, low_c, combinded_c):
-        self.high_contour = high_c
-        self.low_contour = low_c
-        self.full_contour = combinded_c
+    __slots__ = ("_high", "_low", "_full", "_store", "_index", "_high_circle", "_low_circle", "_circle", "_area")
+
+    def __init__(self, high_c, low_c, combinded_c, high_circle: Circle = None, low_circle: Circle = None):
+        """
+        :param high_c: bright contour
+        :param low_c: shadow contour
+        :param combinded_c: both contours
+        :param high_circle: enclosing circle of the high contour, if already known
+        :param low_circle: enclosing circle of the low contour, if already known
+        """
+        self._high = high_c
+        self._low = low_c
+        self._full = combinded_c
+        self._store = None
+        self._index = None
+        self._high_circle = high_circle
+        self._low_circle = low_circle
+        self._circle = None
+        self._area = None
+
+    @classmethod
+    def from_store(cls, store: ContourStore, index: int) -> 'Crater':
+        """
+        :param store:
+        :param index: of the high contour, the low contour is the next one
+        """
+        crater = cls(None, None, None)
+        crater._store = store
+        crater._index = index
+        return crater
+
+    @property
+    def high_contour(self) -> np.ndarray:
+        if self._store is not None:
+            return self._store.contour(self._index)
+        return self._high
+
+    @property
+    def low_contour(self) -> np.ndarray:
+        if self._store is not None:
+            return self._store.contour(self._index + 1)
+        return self._low
+
+    @property
+    def full_contour(self) -> np.ndarray:
+        if self._store is not None:
+            return self._store.contour(self._index, self._index + 2)
+        return self._full
+
+    def high_enclosing_circle(self) -> Circle:
+        if self._high_circle is None and self._store is not None:
+            return self._store.circle(self._index) or cv.minEnclosingCircle(self.high_contour)
+        if self._high_circle is None:
+            self._high_circle = cv.minEnclosingCircle(self.high_contour)
+        return self._high_circle
+
+    def low_enclosing_circle(self) -> Circle:
+        if self._low_circle is None and self._store is not None:
+            return self._store.circle(self._index + 1) or cv.minEnclosingCircle(self.low_contour)
+        if self._low_circle is None:
+            self._low_circle = cv.minEnclosingCircle(self.low_contour)
+        return self._low_circle
 
     def sun_angle(self) -> np.real:
-        high_pos, high_rad = cv.minEnclosingCircle(self.high_contour)
-        low_pos, low_rad = cv.minEnclosingCircle(self.low_contour)
+        high_pos, high_rad = self.high_enclosing_circle()
+        low_pos, low_rad = self.low_enclosing_circle()
 
-        low_pos = np.uint(np.around(low_pos))
-        high_pos = np.uint(np.around(high_pos))
+        # Signed, the shadow can be on either side
+        low_pos = np.int64(np.around(low_pos))
+        high_pos = np.int64(np.around(high_pos))
 
         btw_circles = angle_between_points(high_pos, low_pos)
 
@@ -31,7 +99,9 @@ class Crater:
         return cv.arcLength(self.full_contour, True)
 
     def area(self):
-        return cv.contourArea(self.full_contour)
+        if self._area is None:
+            self._area = cv.contourArea(self.full_contour)
+        return self._area
 
     def hull(self):
         return cv.convexHull(self.full_contour)
@@ -39,5 +109,30 @@ class Crater:
     def bounding_rect(self):
         return cv.boundingRect(self.full_contour)
 
-    def min_enclosing_circle(self):
-        return cv.minEnclosingCircle(self.full_contour)
+    def min_enclosing_circle(self) -> Circle:
+        if self._circle is None:
+            self._circle = cv.minEnclosingCircle(self.full_contour)
+        return self._circle
+
+
+def pack_craters(craters: List[Crater], dtype=None) -> List[Crater]:
+    """
+    Moves the contours of craters into one ContourStore, e.g. after they've been offset or scaled one by one.
+    :param craters:
+    :param dtype: see ContourStore.pack
+    :return: craters with the same contours and cached values, backed by the store
+    """
+    contours, circles = [], []
+    for crater in craters:
+        contours.extend((crater.high_contour, crater.low_contour))
+        for (x, y), rad in (crater.high_enclosing_circle(), crater.low_enclosing_circle()):
+            circles.append((x, y, rad))
+    store = ContourStore.pack(contours, dtype, circles=circles)
+
+    packed = []
+    for i, crater in enumerate(craters):
+        packed_crater = Crater.from_store(store, 2 * i)
+        packed_crater._circle = crater._circle
+        packed_crater._area = crater._area
+        packed.append(packed_crater)
+    return packed
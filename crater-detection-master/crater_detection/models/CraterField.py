@@ -1,32 +1,202 @@
 import numpy as np
-from typing import List
+from typing import Dict, List, Tuple
+from scipy.spatial import cKDTree
 
-from ..util import logger
+from ..util import logger, angle_between_points
 from . import Crater
 
+# Per crater values, stored as one array each
+COLUMNS = (
+    "x",  # center of the enclosing circle
+    "y",
+    "radius",
+    "area",
+    "sun_angle",  # radians, from the bright contour to the shadow
+    "high_x",  # center of the bright contour
+    "high_y",
+    "low_x",  # center of the shadow contour
+    "low_y",
+)
+
 
 class CraterField:
-    def __init__(self, width: int, height: int, craters: List[Crater]):
+    """
+    Craters stored column-wise. Geometry is computed once in bulk when the field is built,
+    so stats and filters are array operations. The Crater objects (with their contours) are optional.
+    Spatial queries go through a KD-tree of the crater centers, built on the first query.
+    """
+    COLUMNS = COLUMNS
+
+    def __init__(self, width: int, height: int, craters: List[Crater] = None, columns: Dict[str, np.ndarray] = None):
+        """
+        :param width: in px
+        :param height: in px
+        :param craters: computed into columns if they aren't given
+        :param columns: name => array for every name in COLUMNS
+        """
         self.width = width
         self.height = height
-        self.craters = craters
+        self.craters = craters if craters is not None else []
+
+        if columns is None:
+            columns = compute_columns(self.craters)
+        self.columns = {name: np.asarray(columns[name], dtype=np.float64) for name in COLUMNS}
+        self._index = None
+
+    def __len__(self):
+        return len(self.columns["x"])
+
+    def __getattr__(self, name):
+        # field.x, field.radius, ...
+        columns = self.__dict__.get("columns")
+        if columns is None or name not in COLUMNS:
+            raise AttributeError(name)
+        return columns[name]
+
+    def filter(self, mask: np.ndarray) -> 'CraterField':
+        """
+        :param mask: boolean mask or indices into the craters
+        :return: a new field with the selected craters
+        """
+        columns = {name: values[mask] for name, values in self.columns.items()}
+        craters = None
+        if len(self.craters) > 0:
+            craters = [self.craters[i] for i in np.arange(len(self))[mask]]
+        return CraterField(self.width, self.height, craters, columns)
+
+    def filter_radius(self, min_rad: float = None, max_rad: float = None) -> 'CraterField':
+        mask = np.ones(shape=(len(self),), dtype=bool)
+        if min_rad is not None:
+            mask &= self.radius >= min_rad
+        if max_rad is not None:
+            mask &= self.radius <= max_rad
+        return self.filter(mask)
+
+    def scaled(self, factor: float) -> 'CraterField':
+        """
+        :param factor: e.g. 4 for craters found in an image decoded at 1/4 scale
+        :return: a new field in the coordinates of the scaled image, without Crater objects
+        """
+        columns = dict(self.columns)
+        for name in ("x", "y", "radius", "high_x", "high_y", "low_x", "low_y"):
+            columns[name] = self.columns[name] * factor
+        columns["area"] = self.columns["area"] * factor ** 2
+        return CraterField(int(round(self.width * factor)), int(round(self.height * factor)), columns=columns)
+
+    def centers(self) -> np.ndarray:
+        """
+        :return: (N, 2) array of [x, y]
+        """
+        return np.column_stack((self.x, self.y))
+
+    def spatial_index(self) -> cKDTree:
+        """
+        :return: KD-tree of the crater centers, built once
+        """
+        if self._index is None:
+            self._index = cKDTree(self.centers() if len(self) > 0 else np.zeros(shape=(0, 2)))
+        return self._index
+
+    def nearest(self, points, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param points: (N, 2) array of [x, y], or a single point
+        :param k: number of craters per point
+        :return: distances and indices as cKDTree.query, missing neighbours have index len(self)
+        """
+        return self.spatial_index().query(np.asarray(points, dtype=np.float64), k=k)
+
+    def within_radius(self, points, radius: float) -> List[np.ndarray]:
+        """
+        :param points: (N, 2) array of [x, y]
+        :param radius: in px, of every query
+        :return: per point, indices of the craters centered within the radius
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        if len(self) == 0:
+            return [np.zeros(shape=(0,), dtype=np.intp) for _ in points]
+        return [np.asarray(indices, dtype=np.intp)
+                for indices in self.spatial_index().query_ball_point(points, radius)]
+
+    def within_boxes(self, boxes) -> List[np.ndarray]:
+        """
+        Each box is found from a ball query around its center, then trimmed to the box.
+        Boxes of one size go through the tree in a single call.
+        :param boxes: (N, 4) array of [x_min, y_min, x_max, y_max]
+        :return: per box, indices of the craters centered in it (edges included)
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        if len(boxes) == 0:
+            return []
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        half_diagonals = np.hypot(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]) / 2
+
+        if len(self) == 0:
+            candidates = [[] for _ in boxes]
+        elif np.all(half_diagonals == half_diagonals[0]):
+            candidates = self.spatial_index().query_ball_point(centers, half_diagonals[0])
+        else:
+            candidates = [self.spatial_index().query_ball_point(center, r)
+                          for center, r in zip(centers, half_diagonals)]
+
+        results = []
+        for (x_min, y_min, x_max, y_max), indices in zip(boxes, candidates):
+            indices = np.asarray(indices, dtype=np.intp)
+            x, y = self.x[indices], self.y[indices]
+            results.append(indices[(x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)])
+        return results
+
+    def in_box(self, x_min: float, y_min: float, x_max: float, y_max: float) -> 'CraterField':
+        """
+        :return: a new field with the craters centered in the box
+        """
+        return self.filter(np.sort(self.within_boxes([[x_min, y_min, x_max, y_max]])[0]))
+
+    def neighbour_counts(self, radius: float) -> np.ndarray:
+        """
+        :param radius: in px
+        :return: per crater, the number of other craters centered within the radius
+        """
+        if len(self) == 0:
+            return np.zeros(shape=(0,), dtype=np.intp)
+        neighbours = self.spatial_index().query_ball_point(self.centers(), radius)
+        return np.array([len(n) for n in neighbours], dtype=np.intp) - 1
+
+    def density_map(self, cell_size: float, min_rad: float = None, max_rad: float = None) -> np.ndarray:
+        """
+        :param cell_size: in px
+        :param min_rad: only count craters at least this large
+        :param max_rad: only count craters at most this large
+        :return: (rows, cols) array of craters per square px in each cell, by crater center
+        """
+        field = self.filter_radius(min_rad, max_rad) if min_rad is not None or max_rad is not None else self
+        num_rows = int(np.ceil(self.height / cell_size))
+        num_cols = int(np.ceil(self.width / cell_size))
+        counts, _, _ = np.histogram2d(field.y, field.x,
+                                      bins=(num_rows, num_cols),
+                                      range=((0, num_rows * cell_size), (0, num_cols * cell_size)))
+        return counts / (cell_size ** 2)
 
     def stats(self):
         logger.info("Crater Field Stats:")
-        crater_rads = np.array(list(map(lambda c: c.radius(), self.craters)))
-        mean_rad = np.mean(crater_rads)
-        max_rad = np.max(crater_rads)
-        min_rad = np.min(crater_rads)
+        crater_rads = self.radius
+        crater_angles = self.sun_angle
 
-        crater_angles = np.array(list(map(lambda c: c.sun_angle(), self.craters)))
-        mean_sun_angle = np.mean(crater_angles)
-        max_sun_angle = np.max(crater_angles)
-        min_sun_angle = np.min(crater_angles)
+        if len(self) == 0:
+            mean_rad = max_rad = min_rad = np.nan
+            mean_sun_angle = max_sun_angle = min_sun_angle = np.nan
+        else:
+            mean_rad = np.mean(crater_rads)
+            max_rad = np.max(crater_rads)
+            min_rad = np.min(crater_rads)
+
+            mean_sun_angle = np.mean(crater_angles)
+            max_sun_angle = np.max(crater_angles)
+            min_sun_angle = np.min(crater_angles)
 
         stats = {
             "width": self.width,
             "height": self.height,
-            "num_craters": len(self.craters),
+            "num_craters": len(self),
             "mean_rad": mean_rad,
             "max_rad": max_rad,
             "min_rad": min_rad,
@@ -39,3 +209,35 @@ class CraterField:
         }
 
         return stats
+
+
+def compute_columns(craters: List[Crater]) -> Dict[str, np.ndarray]:
+    """
+    One pass over the craters, each enclosing circle / area is computed at most once.
+    """
+    num = len(craters)
+    circles = np.zeros(shape=(num, 3), dtype=np.float64)
+    high_pos = np.zeros(shape=(num, 2), dtype=np.float64)
+    low_pos = np.zeros(shape=(num, 2), dtype=np.float64)
+    areas = np.zeros(shape=(num,), dtype=np.float64)
+
+    for i, crater in enumerate(craters):
+        (x, y), rad = crater.min_enclosing_circle()
+        circles[i] = x, y, rad
+        high_pos[i], _ = crater.high_enclosing_circle()
+        low_pos[i], _ = crater.low_enclosing_circle()
+        areas[i] = crater.area()
+
+    sun_angles = angle_between_points(np.around(high_pos).T, np.around(low_pos).T)
+
+    return {
+        "x": circles[:, 0],
+        "y": circles[:, 1],
+        "radius": circles[:, 2],
+        "area": areas,
+        "sun_angle": sun_angles,
+        "high_x": high_pos[:, 0],
+        "high_y": high_pos[:, 1],
+        "low_x": low_pos[:, 0],
+        "low_y": low_pos[:, 1],
+    }
@@ -1,4 +1,5 @@
-from .Crater import Crater
+from .ContourStore import ContourStore
+from .Crater import Crater, pack_craters
 from .CraterField import CraterField
 
-__all__ = ["CraterField", "Crater"]
+__all__ = ["CraterField", "Crater", "ContourStore", "pack_craters"]
@@ -0,0 +1,342 @@
+"""
+Overlays drawn from a crater catalog rather than kept as one full size annotated image.
+
+Tiles follow the XYZ layout of web map viewers: <zoom>/<x>/<y>.png, zoom 0 being the whole image in one tile
+and the highest zoom full resolution. A tile is only rendered the first time it's asked for, from the image window
+under it (read with a stride at lower zooms, so a raster.Raster is only read where it's viewed)
+and the craters found there through the field's spatial index.
+The tiles.json of a tiles directory records a digest of the image and catalog they were drawn from,
+tiles left by another image or catalog are removed rather than served.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, Iterator, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from . import image_io
+from .models import CraterField
+from .util import logger, to_builtin
+
+__all__ = ["TilePyramid", "render_circles", "render_preview", "serve_tiles"]
+
+# Defaults
+TileSize = 256
+PreviewSize = 2048
+Host = '127.0.0.1'
+Port = 8643
+
+# RGB
+CRATER_COLOR = (0, 255, 0)
+SUN_COLOR = (255, 0, 0)
+# Craters smaller than this (px) at a zoom aren't drawn
+MIN_DRAW_RADIUS = 1.0
+# Fractional bits of the drawing coordinates
+DRAW_SHIFT = 4
+
+METADATA_FILENAME = 'tiles.json'
+
+
+def field_digest(crater_field: CraterField) -> str:
+    """
+    :return: SHA-256 of the field's size and columns
+    """
+    digest = hashlib.sha256(("%i %i" % (crater_field.width, crater_field.height)).encode('utf-8'))
+    for name in CraterField.COLUMNS:
+        digest.update(np.ascontiguousarray(crater_field.columns[name], dtype=np.float64))
+    return digest.hexdigest()
+
+
+def image_digest(input_image) -> str:
+    """
+    :param input_image: an image, or a raster.Raster (read band by band)
+    :return: SHA-256 of the image's pixels
+    """
+    digest = hashlib.sha256()
+    if hasattr(input_image, 'iter_bands'):
+        for _, band in input_image.iter_bands():
+            digest.update(np.ascontiguousarray(band))
+    else:
+        digest.update(np.ascontiguousarray(input_image))
+    return digest.hexdigest()
+
+
+def read_window(input_image, y0: int, y1: int, x0: int, x1: int, step: int) -> np.ndarray:
+    """
+    :param input_image: grayscale or RGB image, or a raster.Raster
+    :param step: px of the image per px read
+    :return: RGB uint8 window, every step-th px
+    """
+    window = input_image[y0:y1:step, x0:x1:step]
+    if len(window.shape) == 2:
+        return cv.cvtColor(window, cv.COLOR_GRAY2RGB)
+    return np.ascontiguousarray(window[:, :, :3])
+
+
+def draw_field(canvas: np.ndarray, crater_field: CraterField, indices: np.ndarray,
+               x0: float, y0: float, scale: float, thickness: int = 1):
+    """
+    Draws each crater's enclosing circle and a line from its bright side to its shadow.
+    :param canvas: RGB image, drawn on in place
+    :param crater_field:
+    :param indices: of the craters to draw
+    :param x0: image x of the canvas' left edge
+    :param y0: image y of the canvas' top edge
+    :param scale: image px per canvas px
+    :param thickness: in canvas px
+    """
+    unit = 1 << DRAW_SHIFT
+    rads = crater_field.radius[indices] / scale
+    indices = indices[rads >= MIN_DRAW_RADIUS]
+    rads = rads[rads >= MIN_DRAW_RADIUS]
+
+    def fixed(xs, ys):
+        return np.int64(np.around((xs - x0) / scale * unit)), np.int64(np.around((ys - y0) / scale * unit))
+
+    xs, ys = fixed(crater_field.x[indices], crater_field.y[indices])
+    high_xs, high_ys = fixed(crater_field.high_x[indices], crater_field.high_y[indices])
+    low_xs, low_ys = fixed(crater_field.low_x[indices], crater_field.low_y[indices])
+    for i in range(len(indices)):
+        cv.circle(canvas, (int(xs[i]), int(ys[i])), int(round(rads[i] * unit)), CRATER_COLOR, thickness,
+                  cv.LINE_AA, DRAW_SHIFT)
+        cv.line(canvas, (int(high_xs[i]), int(high_ys[i])), (int(low_xs[i]), int(low_ys[i])), SUN_COLOR, thickness,
+                cv.LINE_AA, DRAW_SHIFT)
+
+
+def render_circles(input_image, crater_field: CraterField, thickness: int = 2) -> np.ndarray:
+    """
+    Full size overlay drawn from the x, y and radius columns, rather than from the craters' contours,
+    which don't match the circles of hough and fused fields.
+    :param input_image: grayscale or RGB image
+    :param crater_field: in the image's coordinates
+    :param thickness: in px
+    :return: RGB overlay
+    """
+    height, width = input_image.shape[:2]
+    canvas = read_window(input_image, 0, height, 0, width, 1)
+    draw_field(canvas, crater_field, np.arange(len(crater_field)), 0, 0, 1, thickness=thickness)
+    return canvas
+
+
+def render_preview(input_image, crater_field: CraterField, max_size: int = PreviewSize) -> np.ndarray:
+    """
+    :param input_image: grayscale or RGB image, or a raster.Raster
+    :param crater_field: in the image's coordinates
+    :param max_size: of the preview's longer side, in px
+    :return: RGB overlay, the image read with a whole px stride so it fits in max_size
+    """
+    height, width = input_image.shape[:2]
+    step = max(int(np.ceil(max(height, width) / max_size)), 1)
+    canvas = read_window(input_image, 0, height, 0, width, step)
+    draw_field(canvas, crater_field, np.arange(len(crater_field)), 0, 0, step)
+    return canvas
+
+
+class TilePyramid:
+    """
+    XYZ tiles of an image's overlay, rendered on first request and kept in a directory.
+    """
+    def __init__(self, input_image, crater_field: CraterField, directory: str, tile_size: int = TileSize,
+                 source_digest: str = None):
+        """
+        :param input_image: grayscale or RGB image, or a raster.Raster
+        :param crater_field: in the image's coordinates
+        :param directory: where tiles are written, and found again if they're of the same image and catalog
+        :param tile_size: tile edge in px
+        :param source_digest: identifies the image, e.g. cache.file_signature of its file,
+            its pixels are hashed (see image_digest) if not given
+        """
+        self.image = input_image
+        self.crater_field = crater_field
+        self.directory = directory
+        self.tile_size = tile_size
+        self.height, self.width = input_image.shape[:2]
+        self.max_zoom = max(int(np.ceil(np.log2(max(self.width, self.height) / tile_size))), 0)
+        self.max_radius = float(np.max(crater_field.radius)) if len(crater_field) > 0 else 0.0
+        self.digest = self.pyramid_digest(source_digest if source_digest is not None else image_digest(input_image))
+
+        os.makedirs(directory, exist_ok=True)
+        if self.stored_digest() != self.digest:
+            self.clear_tiles()
+        self.write_metadata()
+
+    def pyramid_digest(self, source_digest: str) -> str:
+        """
+        :return: SHA-256 of everything the tiles depend on
+        """
+        source = {
+            "image": source_digest,
+            "shape": list(self.image.shape),
+            "dtype": str(self.image.dtype),
+            "value_range": to_builtin(getattr(self.image, 'value_range', None)),
+            "catalog": field_digest(self.crater_field),
+            "tile_size": self.tile_size,
+        }
+        return hashlib.sha256(json.dumps(source, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def stored_digest(self) -> str:
+        """
+        :return: digest in the directory's metadata, None if there's none
+        """
+        try:
+            with open(os.path.join(self.directory, METADATA_FILENAME)) as metadata_file:
+                return json.load(metadata_file).get("digest")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def clear_tiles(self) -> int:
+        """
+        Removes the zoom directories of tiles rendered before, and nothing else in the directory.
+        :return: number of zoom directories removed
+        """
+        zoom_dirs = [name for name in os.listdir(self.directory)
+                     if name.isdigit() and os.path.isdir(os.path.join(self.directory, name))]
+        if len(zoom_dirs) > 0:
+            logger.info("Removing the tiles in %s, they're of another image, catalog or tile size" % self.directory)
+        for name in zoom_dirs:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return len(zoom_dirs)
+
+    def scale(self, zoom: int) -> int:
+        """
+        :return: image px per tile px at the zoom
+        """
+        return 2 ** (self.max_zoom - zoom)
+
+    def num_tiles(self, zoom: int) -> Tuple[int, int]:
+        """
+        :return: (columns, rows) of tiles at the zoom
+        """
+        span = self.tile_size * self.scale(zoom)
+        return int(np.ceil(self.width / span)), int(np.ceil(self.height / span))
+
+    def iter_tiles(self, zoom: int) -> Iterator[Tuple[int, int]]:
+        num_cols, num_rows = self.num_tiles(zoom)
+        for y in range(num_rows):
+            for x in range(num_cols):
+                yield x, y
+
+    def tile_filename(self, zoom: int, x: int, y: int) -> str:
+        return os.path.join(self.directory, str(zoom), str(x), "%i.png" % y)
+
+    def render_tile(self, zoom: int, x: int, y: int) -> np.ndarray:
+        """
+        :return: RGB tile, black past the image's edges
+        """
+        if not 0 <= zoom <= self.max_zoom:
+            raise ValueError("Zoom must be in [0, %i], got %i" % (self.max_zoom, zoom))
+        num_cols, num_rows = self.num_tiles(zoom)
+        if not (0 <= x < num_cols and 0 <= y < num_rows):
+            raise ValueError("No tile %i/%i/%i, zoom %i has %ix%i tiles" % (zoom, x, y, zoom, num_cols, num_rows))
+
+        scale = self.scale(zoom)
+        span = self.tile_size * scale
+        x0, y0 = x * span, y * span
+        x1, y1 = min(x0 + span, self.width), min(y0 + span, self.height)
+
+        tile = np.zeros(shape=(self.tile_size, self.tile_size, 3), dtype=np.uint8)
+        window = read_window(self.image, y0, y1, x0, x1, scale)
+        tile[:window.shape[0], :window.shape[1]] = window
+
+        # Craters centered up to their radius outside the tile still cross into it
+        pad = self.max_radius
+        indices = self.crater_field.within_boxes([[x0 - pad, y0 - pad, x0 + span + pad, y0 + span + pad]])[0]
+        draw_field(tile, self.crater_field, indices, x0, y0, scale)
+        return tile
+
+    def tile(self, zoom: int, x: int, y: int) -> str:
+        """
+        :return: the tile's file, rendered and written if it isn't there yet
+        """
+        filename = self.tile_filename(zoom, x, y)
+        if not os.path.isfile(filename):
+            tile = self.render_tile(zoom, x, y)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            # Written aside and renamed, so a tile being written is never served
+            fd, tmp_filename = tempfile.mkstemp(suffix='.png', dir=os.path.dirname(filename))
+            os.close(fd)
+            image_io.write_image(tmp_filename, tile)
+            os.replace(tmp_filename, filename)
+        return filename
+
+    def render_zoom(self, zoom: int) -> int:
+        """
+        Renders every tile of a zoom that isn't there yet.
+        :return: number of tiles
+        """
+        tiles = list(self.iter_tiles(zoom))
+        for x, y in tiles:
+            self.tile(zoom, x, y)
+        return len(tiles)
+
+    def metadata(self) -> Dict:
+        return {
+            "layout": "xyz",
+            "width": self.width,
+            "height": self.height,
+            "tile_size": self.tile_size,
+            "min_zoom": 0,
+            "max_zoom": self.max_zoom,
+            "num_craters": len(self.crater_field),
+            "url": "{z}/{x}/{y}.png",
+            "digest": self.digest,
+        }
+
+    def write_metadata(self):
+        with open(os.path.join(self.directory, METADATA_FILENAME), 'w') as metadata_file:
+            json.dump(self.metadata(), metadata_file, indent=2)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_tile_handler(pyramid: TilePyramid):
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.split('?')[0].strip('/').split('/')
+            if parts == [METADATA_FILENAME] or parts == ['']:
+                self.send_body(200, 'application/json', json.dumps(pyramid.metadata()).encode('utf-8'))
+                return
+            try:
+                if len(parts) != 3 or not parts[2].endswith('.png'):
+                    raise ValueError("expected /<zoom>/<x>/<y>.png")
+                zoom, x, y = int(parts[0]), int(parts[1]), int(parts[2][:-len('.png')])
+                filename = pyramid.tile(zoom, x, y)
+            except (ValueError, IndexError) as ex:
+                self.send_body(404, 'text/plain', ("No tile %s: %s" % (self.path, ex)).encode('utf-8'))
+                return
+            with open(filename, 'rb') as tile_file:
+                self.send_body(200, 'image/png', tile_file.read())
+
+        def send_body(self, status: int, content_type: str, body: bytes):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return TileHandler
+
+
+def serve_tiles(pyramid: TilePyramid, host: str = Host, port: int = Port):
+    """
+    Serves GET /<zoom>/<x>/<y>.png until interrupted, rendering each tile the first time it's asked for,
+    and the metadata at / and /tiles.json.
+    """
+    httpd = _ThreadingHTTPServer((host, port), make_tile_handler(pyramid))
+    logger.info("Serving tiles on http://%s:%i/{z}/{x}/{y}.png (zoom 0 to %i)" % (host, port, pyramid.max_zoom),
+                color='green')
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
@@ -0,0 +1,116 @@
+"""
+Per stage timing and memory of the detection pipeline
+"""
+import json
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+__all__ = ["StageProfiler", "NullProfiler", "NULL_PROFILER"]
+
+
+def max_rss_bytes() -> int:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class StageProfiler:
+    """
+    Records wall time, CPU time and peak allocated memory of named stages.
+    Stages run more than once (e.g. once per tile) are summed, with the largest peak kept.
+
+    Peak memory comes from tracemalloc, which sees numpy arrays (including those OpenCV returns)
+    but not OpenCV's internal scratch buffers. The process' max RSS is recorded alongside.
+    Stages shouldn't be nested.
+    """
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.stages = OrderedDict()
+        self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.stop()
+                tracemalloc.start()
+            base_memory, _ = tracemalloc.get_traced_memory()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            peak = None
+            if self.trace_memory:
+                _, peak_memory = tracemalloc.get_traced_memory()
+                peak = max(peak_memory - base_memory, 0)
+            self._record(name, wall, cpu, peak)
+
+    def _record(self, name: str, wall: float, cpu: float, peak: int):
+        record = self.stages.setdefault(name, {
+            "name": name,
+            "calls": 0,
+            "wall_seconds": 0.0,
+            "cpu_seconds": 0.0,
+            "peak_bytes": None,
+        })
+        record["calls"] += 1
+        record["wall_seconds"] += wall
+        record["cpu_seconds"] += cpu
+        if peak is not None:
+            record["peak_bytes"] = max(record["peak_bytes"] or 0, peak)
+        record["max_rss_bytes"] = max_rss_bytes()
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def to_dict(self, **extra) -> Dict:
+        """
+        :param extra: added to the top level, e.g. the image name
+        """
+        stages = list(self.stages.values())
+        result = dict(extra)
+        result.update({
+            "stages": stages,
+            "total_wall_seconds": sum(s["wall_seconds"] for s in stages),
+            "total_cpu_seconds": sum(s["cpu_seconds"] for s in stages),
+            "max_rss_bytes": max_rss_bytes(),
+        })
+        return result
+
+    def to_json(self, **extra) -> str:
+        return json.dumps(self.to_dict(**extra), indent=2)
+
+
+class NullProfiler:
+    """
+    Stands in when nothing is being profiled.
+    """
+    @contextmanager
+    def stage(self, name: str):
+        yield
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,331 @@
+"""
+Memory-mapped raster input for images too large to decode into RAM.
+
+Supported:
+- NPY arrays
+- Raw binary with a fixed size header
+- PDS3 images with an attached label (e.g. LRO .IMG products)
+- Uncompressed, stripped TIFFs
+"""
+import os
+import re
+import struct
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+
+__all__ = ["Raster", "open_raster", "open_npy", "open_raw", "open_pds", "open_tiff", "RASTER_EXTENSIONS"]
+
+RASTER_EXTENSIONS = ('.npy', '.raw', '.bin', '.img', '.tif', '.tiff')
+
+# Rows read at a time when scanning a whole raster
+BandRows = 1024
+
+
+class Raster:
+    """
+    A lazily read image. Only the windows that are sliced out get read from disk,
+    and they come back as uint8, which is what the detector works on.
+    """
+    def __init__(self, data, value_range: Tuple[float, float] = None):
+        """
+        :param data: a memory-mapped array, or anything with shape, dtype and 2D slicing
+        :param value_range: (low, high) values mapped to 0 and 255 for non uint8 data,
+            found with a streaming pass if not given
+        """
+        self.data = data
+        self.shape = data.shape
+        self.dtype = np.dtype(data.dtype)
+        self.value_range = value_range
+
+    def __getitem__(self, key) -> np.ndarray:
+        return self.to_uint8(np.asarray(self.data[key]))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def iter_bands(self, rows: int = BandRows) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        :param rows: rows per band
+        :return: (first row, raw band data) for each band of full width rows
+        """
+        for y0 in range(0, self.shape[0], rows):
+            yield y0, np.asarray(self.data[y0:y0 + rows])
+
+    def get_value_range(self) -> Tuple[float, float]:
+        if self.value_range is None:
+            low, high = np.inf, -np.inf
+            for _, band in self.iter_bands():
+                low = min(low, float(np.min(band)))
+                high = max(high, float(np.max(band)))
+            self.value_range = (low, high)
+        return self.value_range
+
+    def to_uint8(self, window: np.ndarray) -> np.ndarray:
+        if window.dtype == np.uint8:
+            return np.ascontiguousarray(window)
+
+        low, high = self.get_value_range()
+        scaled = (window.astype(np.float32) - low) * (255.0 / max(high - low, 1e-12))
+        return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def open_npy(path: str) -> Raster:
+    return Raster(np.load(path, mmap_mode='r'))
+
+
+def open_raw(path: str, width: int, height: int, dtype='uint8', channels: int = 1, header_bytes: int = 0) -> Raster:
+    """
+    :param path:
+    :param width: in px
+    :param height: in px
+    :param dtype: numpy dtype of a sample, with byte order, e.g. '>u2'
+    :param channels: interleaved samples per pixel
+    :param header_bytes: bytes to skip at the start of the file
+    :return:
+    """
+    shape = (height, width) if channels == 1 else (height, width, channels)
+    return Raster(np.memmap(path, dtype=np.dtype(dtype), mode='r', offset=header_bytes, shape=shape))
+
+
+PDS_SAMPLE_TYPES = {
+    'UNSIGNED_INTEGER': '>u',
+    'MSB_UNSIGNED_INTEGER': '>u',
+    'SUN_UNSIGNED_INTEGER': '>u',
+    'LSB_UNSIGNED_INTEGER': '<u',
+    'PC_UNSIGNED_INTEGER': '<u',
+    'VAX_UNSIGNED_INTEGER': '<u',
+    'INTEGER': '>i',
+    'MSB_INTEGER': '>i',
+    'SUN_INTEGER': '>i',
+    'LSB_INTEGER': '<i',
+    'PC_INTEGER': '<i',
+    'VAX_INTEGER': '<i',
+    'REAL': '>f',
+    'IEEE_REAL': '>f',
+    'FLOAT': '>f',
+    'PC_REAL': '<f',
+}
+
+
+def read_pds_label(path: str, max_bytes: int = 1 << 20) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Reads the keywords of an attached PDS3 label, stopping at END.
+    :return: (file level keywords, IMAGE object keywords)
+    """
+    file_keys, image_keys = {}, {}
+    with open(path, 'rb') as raster_file:
+        text = raster_file.read(max_bytes).decode('ascii', errors='replace')
+
+    if 'PDS_VERSION_ID' not in text[:1024]:
+        raise ValueError("Not a PDS3 labelled file: " + path)
+
+    depth, in_image = 0, False
+    for line in text.splitlines():
+        line = line.strip()
+        if line == 'END':
+            break
+        match = re.match(r'^(\^?[A-Z0-9_:]+)\s*=\s*(.*)$', line)
+        if match is None:
+            continue
+        key, value = match.group(1), match.group(2).strip().strip('"')
+        if key == 'OBJECT':
+            depth += 1
+            in_image = in_image or (depth == 1 and value == 'IMAGE')
+        elif key == 'END_OBJECT':
+            depth -= 1
+            if depth == 0:
+                in_image = False
+        elif in_image and depth == 1:
+            image_keys[key] = value
+        elif depth == 0:
+            file_keys[key] = value
+
+    return file_keys, image_keys
+
+
+def _pds_number(value: str) -> int:
+    return int(value.split('<')[0].strip())
+
+
+def open_pds(path: str) -> Raster:
+    file_keys, image_keys = read_pds_label(path)
+    if '^IMAGE' not in file_keys:
+        raise ValueError("PDS label has no ^IMAGE pointer: " + path)
+
+    pointer = file_keys['^IMAGE']
+    if pointer.startswith('('):
+        raise ValueError("Detached PDS image data is not supported: " + path)
+    if '<BYTES>' in pointer.upper():
+        offset = _pds_number(pointer) - 1
+    else:
+        offset = (_pds_number(pointer) - 1) * _pds_number(file_keys['RECORD_BYTES'])
+
+    if _pds_number(image_keys.get('BANDS', '1')) != 1:
+        raise ValueError("Multi-band PDS images are not supported: " + path)
+
+    sample_type = image_keys['SAMPLE_TYPE']
+    if sample_type not in PDS_SAMPLE_TYPES:
+        raise ValueError("Unknown PDS sample type: " + sample_type)
+    dtype = np.dtype(PDS_SAMPLE_TYPES[sample_type] + str(_pds_number(image_keys['SAMPLE_BITS']) // 8))
+
+    lines = _pds_number(image_keys['LINES'])
+    samples = _pds_number(image_keys['LINE_SAMPLES'])
+    prefix = _pds_number(image_keys.get('LINE_PREFIX_BYTES', '0'))
+    suffix = _pds_number(image_keys.get('LINE_SUFFIX_BYTES', '0'))
+
+    if prefix == 0 and suffix == 0:
+        data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(lines, samples))
+    else:
+        # Skip over the per line prefix / suffix bytes with a strided view
+        line_dtype = np.dtype([('prefix', 'V%i' % prefix), ('samples', dtype, (samples,)), ('suffix', 'V%i' % suffix)])
+        data = np.memmap(path, dtype=line_dtype, mode='r', offset=offset, shape=(lines,))['samples']
+    return Raster(data)
+
+
+# TIFF tags
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_ROWS_PER_STRIP = 278
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIG = 284
+TIFF_TILE_WIDTH = 322
+TIFF_SAMPLE_FORMAT = 339
+
+# type: (struct code, size)
+TIFF_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4), 6: ('b', 1), 8: ('h', 2), 9: ('i', 4)}
+TIFF_SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def read_tiff_tags(path: str) -> Tuple[str, Dict[int, tuple]]:
+    """
+    Reads the integer tags of the first IFD of a classic TIFF.
+    :return: (byte order, tag => values)
+    """
+    with open(path, 'rb') as tiff_file:
+        header = tiff_file.read(8)
+        if header[:2] == b'II':
+            order = '<'
+        elif header[:2] == b'MM':
+            order = '>'
+        else:
+            raise ValueError("Not a TIFF file: " + path)
+
+        magic, ifd_offset = struct.unpack(order + 'HI', header[2:8])
+        if magic != 42:
+            raise ValueError("Only classic TIFF is supported: " + path)
+
+        tiff_file.seek(ifd_offset)
+        num_entries, = struct.unpack(order + 'H', tiff_file.read(2))
+        entries = tiff_file.read(12 * num_entries)
+
+        tags = {}
+        for i in range(num_entries):
+            tag, tag_type, count, value = struct.unpack(order + 'HHI4s', entries[i * 12:(i + 1) * 12])
+            if tag_type not in TIFF_TYPES:
+                continue
+            code, size = TIFF_TYPES[tag_type]
+            if count * size <= 4:
+                raw = value[:count * size]
+            else:
+                tiff_file.seek(struct.unpack(order + 'I', value)[0])
+                raw = tiff_file.read(count * size)
+            tags[tag] = struct.unpack(order + code * count, raw)
+
+    return order, tags
+
+
+class TiffStrips:
+    """
+    Windowed reads from a TIFF whose strips aren't stored back to back.
+    Only the strips covering the requested rows are touched.
+    """
+    def __init__(self, path: str, dtype: np.dtype, shape: tuple, rows_per_strip: int, offsets, byte_counts):
+        self.file_data = np.memmap(path, dtype=np.uint8, mode='r')
+        self.dtype = dtype
+        self.shape = shape
+        self.rows_per_strip = rows_per_strip
+        self.offsets = offsets
+        self.byte_counts = byte_counts
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows = key[0]
+        if not isinstance(rows, slice):
+            raise TypeError("TIFF strips can only be read with row slices")
+
+        y0, y1, step = rows.indices(self.shape[0])
+        first, last = y0 // self.rows_per_strip, max(y1 - 1, y0) // self.rows_per_strip
+        row_shape = self.shape[1:]
+
+        strips = []
+        for strip in range(first, last + 1):
+            raw = self.file_data[self.offsets[strip]:self.offsets[strip] + self.byte_counts[strip]]
+            strips.append(np.frombuffer(raw, dtype=self.dtype).reshape((-1,) + row_shape))
+        block = np.concatenate(strips) if len(strips) > 0 else np.zeros((0,) + row_shape, dtype=self.dtype)
+
+        start = first * self.rows_per_strip
+        return block[(slice(y0 - start, y1 - start, step),) + key[1:]]
+
+
+def open_tiff(path: str) -> Raster:
+    order, tags = read_tiff_tags(path)
+
+    if tags.get(TIFF_COMPRESSION, (1,))[0] != 1:
+        raise ValueError("Compressed TIFFs can't be memory mapped: " + path)
+    if TIFF_TILE_WIDTH in tags:
+        raise ValueError("Tiled TIFFs are not supported: " + path)
+    if tags.get(TIFF_PLANAR_CONFIG, (1,))[0] != 1:
+        raise ValueError("Planar TIFFs are not supported: " + path)
+
+    width = tags[TIFF_IMAGE_WIDTH][0]
+    height = tags[TIFF_IMAGE_LENGTH][0]
+    channels = tags.get(TIFF_SAMPLES_PER_PIXEL, (1,))[0]
+    bits = tags.get(TIFF_BITS_PER_SAMPLE, (8,))[0]
+    sample_format = TIFF_SAMPLE_FORMATS.get(tags.get(TIFF_SAMPLE_FORMAT, (1,))[0])
+    if sample_format is None or bits % 8 != 0:
+        raise ValueError("Unsupported TIFF sample layout: " + path)
+
+    dtype = np.dtype(order + sample_format + str(bits // 8))
+    shape = (height, width) if channels == 1 else (height, width, channels)
+    offsets = tags[TIFF_STRIP_OFFSETS]
+    byte_counts = tags[TIFF_STRIP_BYTE_COUNTS]
+    rows_per_strip = min(tags.get(TIFF_ROWS_PER_STRIP, (height,))[0], height)
+
+    contiguous = all(offsets[i] + byte_counts[i] == offsets[i + 1] for i in range(len(offsets) - 1))
+    if contiguous:
+        return Raster(np.memmap(path, dtype=dtype, mode='r', offset=offsets[0], shape=shape))
+    return Raster(TiffStrips(path, dtype, shape, rows_per_strip, offsets, byte_counts))
+
+
+def open_raster(path: str, width: int = None, height: int = None, dtype='uint8', header_bytes: int = 0) -> Raster:
+    """
+    Opens a raster by its extension without reading it into memory.
+    :param path:
+    :param width: raw files only, in px
+    :param height: raw files only, in px
+    :param dtype: raw files only
+    :param header_bytes: raw files only
+    :return:
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(2, "No such file", path)
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return open_npy(path)
+    if ext in ('.tif', '.tiff'):
+        return open_tiff(path)
+    if ext == '.img':
+        return open_pds(path)
+    if ext in ('.raw', '.bin'):
+        if width is None or height is None:
+            raise ValueError("Raw rasters need a width and height")
+        return open_raw(path, width, height, dtype=dtype, header_bytes=header_bytes)
+
+    raise ValueError("Can't memory map %s files" % ext)
@@ -0,0 +1,269 @@
+"""
+A long running detection service, so imports and OpenCV setup are paid once rather than per image.
+
+Requests are JSON objects, one per line on stdin (responses are written one per line to stdout, as they finish)
+or POSTed to /detect over HTTP:
+    {"id": 1, "path": "tile.png"}
+    {"id": 2, "image": "<base64 encoded png / jpeg>", "thresholds": [20, 230], "tile_size": 512}
+    {"id": 3, "path": "preview.jpg", "gray_decode": true, "decode_scale": 4}
+Responses carry the request's id, the field size, the catalog columns and stats, or an error.
+"""
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Pool
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict
+
+import numpy as np
+
+from . import detector, image_io
+from .detector import tiling
+from .util import logger, to_builtin
+
+__all__ = ["DetectionServer", "serve_stdio", "serve_http"]
+
+# Defaults
+# Requests in flight per worker, more are held back (stdio) or refused (HTTP)
+PendingPerWorker = 4
+Host = '127.0.0.1'
+Port = 8642
+
+
+# Set in each worker by _init_worker, images of the same size reuse its buffers
+_workspace: detector.DetectorWorkspace = None
+
+
+def _init_worker(verbose: bool):
+    global _workspace
+    logger.set_enabled(verbose)
+    logger.set_stream(sys.stderr)
+    _workspace = detector.DetectorWorkspace()
+    # First call sets up OpenCV's internals, so the first request doesn't pay for it
+    noise = np.random.RandomState(0).randint(0, 256, size=(64, 64)).astype(np.uint8)
+    try:
+        detector.detect(noise, render=False)
+    except Exception as ex:
+        # The pool would start a new worker for every one that fails here, never running a request,
+        # so failures are logged and left to show up in the responses
+        logger.error("Worker warm-up failed:", repr(ex))
+
+
+def decode_image(request: Dict) -> np.ndarray:
+    """
+    :param request: with a "path" to read, or base64 encoded file bytes as "image",
+        and optionally "gray_decode" and "decode_scale", see image_io.read_image
+    :return: the image
+    """
+    gray = bool(request.get("gray_decode", False))
+    scale = int(request.get("decode_scale", 1))
+    if request.get("path") is not None:
+        return image_io.read_image(request["path"], gray=gray, scale=scale)
+    if request.get("image") is not None:
+        return image_io.decode_image(base64.b64decode(request["image"]), gray=gray, scale=scale)
+    raise ValueError("A request needs a 'path' or 'image'")
+
+
+def handle_request(request: Dict) -> Dict:
+    """
+    Runs in a worker, so failures are returned rather than raised.
+    :param request: see the module doc, "thresholds", "tile_size" and "tile_overlap" are optional
+    :return: the response
+    """
+    start = time.perf_counter()
+    response = {"id": request.get("id")}
+    try:
+        input_image = decode_image(request)
+        thresholds = request.get("thresholds")
+        if thresholds is not None:
+            thresholds = tuple(thresholds)
+
+        if request.get("tile_size") is not None:
+            crater_field = tiling.detect_tiled(input_image,
+                                               tile_size=request["tile_size"],
+                                               overlap=request.get("tile_overlap", tiling.TileOverlap),
+                                               thresholds=thresholds)
+        else:
+            _, crater_field = detector.detect(input_image, thresholds=thresholds, render=False, workspace=_workspace)
+
+        decode_scale = int(request.get("decode_scale", 1))
+        if decode_scale > 1:
+            crater_field = crater_field.scaled(decode_scale)
+
+        response.update({
+            "width": crater_field.width,
+            "height": crater_field.height,
+            "num_craters": len(crater_field),
+            "columns": {name: values.tolist() for name, values in crater_field.columns.items()},
+            "stats": to_builtin(crater_field.stats()),
+        })
+    except Exception as ex:
+        response["error"] = "%s: %s" % (type(ex).__name__, ex)
+
+    response["seconds"] = time.perf_counter() - start
+    return response
+
+
+class DetectionServer:
+    """
+    A pool of warm worker processes, with a cap on the requests in flight.
+    """
+    def __init__(self, workers: int = None, max_pending: int = None, verbose: bool = False):
+        """
+        :param workers: number of processes, defaults to the number of cores
+        :param max_pending: requests in flight, defaults to PendingPerWorker per worker
+        :param verbose: whether workers should log (to stderr)
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * PendingPerWorker
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        self._pool = Pool(processes=self.workers, initializer=_init_worker, initargs=(verbose,))
+
+    def submit(self, request: Dict, callback: Callable[[Dict], None], block: bool = True) -> bool:
+        """
+        :param request:
+        :param callback: called with the response, from the pool's result thread
+        :param block: whether to wait for a free slot when max_pending are in flight
+        :return: whether the request was accepted
+        """
+        # Read up front, failed runs in the pool's result thread, which dies if a callback raises
+        request_id = request.get("id") if isinstance(request, dict) else None
+        if not self._pending.acquire(blocking=block):
+            return False
+
+        def respond(response):
+            try:
+                callback(response)
+            except Exception as ex:
+                logger.error("Can't send the response to request %s: %s" % (request_id, ex))
+            finally:
+                self._pending.release()
+
+        def done(response):
+            respond(response)
+
+        def failed(ex):
+            respond({"id": request_id, "error": "%s: %s" % (type(ex).__name__, ex)})
+
+        self._pool.apply_async(handle_request, (request,), callback=done, error_callback=failed)
+        return True
+
+    def detect(self, request: Dict, block: bool = True) -> Dict:
+        """
+        Submits a request and waits for its response.
+        :return: the response, None if not accepted
+        """
+        finished = threading.Event()
+        responses = []
+
+        def callback(response):
+            responses.append(response)
+            finished.set()
+
+        if not self.submit(request, callback, block=block):
+            return None
+        finished.wait()
+        return responses[0]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_request(text: str) -> Dict:
+    """
+    :return: the request, a JSON object
+    :raises ValueError: if it isn't one
+    """
+    request = json.loads(text)
+    if not isinstance(request, dict):
+        raise ValueError("a request is a JSON object, got %s" % type(request).__name__)
+    return request
+
+
+def serve_stdio(server: DetectionServer, input_stream=None, output_stream=None):
+    """
+    Reads requests line by line until EOF, writing each response as it finishes, not in request order.
+    Reading pauses while max_pending requests are in flight.
+    """
+    input_stream = input_stream or sys.stdin
+    output_stream = output_stream or sys.stdout
+    write_lock = threading.Lock()
+
+    def write(response):
+        with write_lock:
+            output_stream.write(json.dumps(response) + '\n')
+            output_stream.flush()
+
+    for line in input_stream:
+        if not line.strip():
+            continue
+        try:
+            request = parse_request(line)
+        except ValueError as ex:
+            write({"id": None, "error": "Bad request: %s" % ex})
+            continue
+        server.submit(request, write)
+
+    server.close()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(server: DetectionServer):
+    class DetectionHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/detect':
+                self.send_json(404, {"error": "Unknown path: " + self.path})
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                request = parse_request(body.decode('utf-8'))
+            except ValueError as ex:
+                self.send_json(400, {"error": "Bad request: %s" % ex})
+                return
+
+            response = server.detect(request, block=False)
+            if response is None:
+                self.send_json(503, {"id": request.get("id"), "error": "Too many requests in flight"})
+            else:
+                self.send_json(400 if "error" in response else 200, response)
+
+        def send_json(self, status: int, response: Dict):
+            body = json.dumps(response).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return DetectionHandler
+
+
+def serve_http(server: DetectionServer, host: str = Host, port: int = Port):
+    """
+    Serves POST /detect until interrupted, each request answered once its detection finishes.
+    Requests past max_pending get a 503.
+    """
+    httpd = _ThreadingHTTPServer((host, port), make_handler(server))
+    logger.info("Serving on http://%s:%i/detect with %i workers" % (host, port, server.workers), color='green')
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        server.close()
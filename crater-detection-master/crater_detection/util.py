@@ -37,9 +37,25 @@ def angle_between_with_origin(p0, p1, p2):
     return angle
 
 
+def to_builtin(value):
+    """
+    Converts numpy scalars / arrays in a stats dict so it can be written as JSON.
+    """
+    if isinstance(value, dict):
+        return {k: to_builtin(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_builtin(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
 class Logger:
     def __init__(self):
         self.enabled = True
+        self.stream = None
 
     def set_enabled(self, e) -> None:
         self.enabled = e
@@ -47,12 +63,17 @@ class Logger:
     def set_level(self, level: str) -> None:
         self.level = level
 
-    @staticmethod
-    def _print(*args, color='white', level=None):
+    def set_stream(self, stream) -> None:
+        """
+        :param stream: where to print, stdout if None
+        """
+        self.stream = stream
+
+    def _print(self, *args, color='white', level=None):
         if level is not None:
             args = list(args)
             args.insert(0, str(level).upper() + ":")
-        cprint(" ".join(map(str, args)), color=color)
+        cprint(" ".join(map(str, args)), color=color, file=self.stream)
 
     def error(self, *args, color='red'):
         self._print(*args, color=color, level='error')
@@ -0,0 +1,35 @@
+import os
+
+import cv2 as cv
+
+from crater_detection import batch, generator
+
+
+def write_field(path, rand_seed):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    input_image, _ = generator.generate(num_craters=10, width=128, height=128, rand_seed=rand_seed)
+    cv.imwrite(path, input_image)
+
+
+def test_output_subdir(tmp_path):
+    paths = [str(tmp_path / "a" / "x.png"), str(tmp_path / "b" / "c" / "x.png")]
+    root = batch.input_root(paths)
+    assert root == str(tmp_path)
+    assert batch.output_subdir(paths[0], root) == "a"
+    assert batch.output_subdir(paths[1], root) == os.path.join("b", "c")
+    assert batch.output_subdir(str(tmp_path / "y.png"), root) == ""
+
+
+def test_same_named_images_dont_collide(tmp_path):
+    inputs = [tmp_path / "in" / "a" / "field.png", tmp_path / "in" / "b" / "field.png"]
+    for seed, path in enumerate(inputs):
+        write_field(str(path), seed)
+    paths = batch.find_images(str(tmp_path / "in" / "*" / "*.png"))
+    output_dir = tmp_path / "out"
+
+    summary = batch.detect_batch(paths, str(output_dir), workers=1, catalog_format="csv")
+
+    assert summary["num_failed"] == 0
+    outputs = sorted(result["output"] for result in summary["images"])
+    assert outputs == [str(output_dir / "a" / "output-field.png"), str(output_dir / "b" / "output-field.png")]
+    assert all(os.path.isfile(result["catalog"]) for result in summary["images"])
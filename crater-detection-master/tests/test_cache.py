@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import pytest
+
+from crater_detection import cache, image_io
+from crater_detection.detector.fused import circle_field
+
+
+def make_field(num_craters=20, rand_seed=0):
+    rng = np.random.RandomState(rand_seed)
+    return circle_field(rng.uniform(1, 100, size=(num_craters, 3)), 128, 128)
+
+
+@pytest.fixture
+def detection_cache(tmp_path):
+    return cache.DetectionCache(str(tmp_path / "cache"))
+
+
+def test_key_depends_on_params(detection_cache):
+    params = cache.detection_params(tile_size=512, overlap=64)
+    assert detection_cache.key("abc", params) == detection_cache.key("abc", dict(params))
+    assert detection_cache.key("abc", params) != detection_cache.key("abd", params)
+    assert detection_cache.key("abc", params) != detection_cache.key("abc", cache.detection_params(tile_size=256))
+
+
+def test_key_depends_on_detection_code(detection_cache, monkeypatch):
+    params = cache.detection_params()
+    key = detection_cache.key("abc", params)
+    assert cache.code_digest() == cache.code_digest()
+    monkeypatch.setattr(cache, "code_digest", lambda: "changed")
+    assert detection_cache.key("abc", params) != key
+
+
+def test_file_signature_changes_with_the_file(tmp_path):
+    path = tmp_path / "image.raw"
+    path.write_bytes(b"\0" * 100)
+    signature = cache.file_signature(str(path))
+    assert cache.file_signature(str(path)) == signature
+    path.write_bytes(b"\0" * 101)
+    assert cache.file_signature(str(path)) != signature
+    os.utime(str(path), ns=(0, 0))
+    resized = cache.file_signature(str(path))
+    path.write_bytes(b"\1" * 101)
+    os.utime(str(path), ns=(1, 10 ** 9))
+    assert cache.file_signature(str(path)) != resized
+
+
+def test_miss_then_hit(detection_cache):
+    field = make_field()
+    assert detection_cache.get("image-params") is None
+    detection_cache.put("image-params", field)
+
+    crater_field, overlay_filename = detection_cache.get("image-params")
+    assert overlay_filename is None
+    assert np.array_equal(crater_field.x, field.x) and np.array_equal(crater_field.radius, field.radius)
+    # Asked with the overlay, an entry without one is a miss
+    assert detection_cache.get("image-params", overlay=True) is None
+
+
+def test_overlay_is_re_encoded_for_another_format(detection_cache, tmp_path):
+    overlay = np.zeros(shape=(32, 48, 3), dtype=np.uint8)
+    overlay[8:24, 8:40] = (0, 255, 0)
+    overlay_filename = str(tmp_path / "overlay.jpg")
+    image_io.write_image(overlay_filename, overlay)
+    detection_cache.put("image-params", make_field(), overlay_filename)
+    _, cached_overlay = detection_cache.get("image-params", overlay=True)
+
+    same_format = str(tmp_path / "out.jpeg")
+    cache.write_overlay(cached_overlay, same_format)
+    with open(same_format, 'rb') as copied, open(cached_overlay, 'rb') as original:
+        assert copied.read() == original.read()
+
+    other_format = str(tmp_path / "out.png")
+    cache.write_overlay(cached_overlay, other_format)
+    with open(other_format, 'rb') as png_file:
+        assert png_file.read(8) == b'\x89PNG\r\n\x1a\n'
+    assert image_io.read_image(other_format).shape == overlay.shape
+
+
+def test_evicts_least_recently_used(tmp_path):
+    detection_cache = cache.DetectionCache(str(tmp_path / "cache"))
+    detection_cache.put("a-1", make_field(rand_seed=1))
+    entry_bytes = detection_cache.size()
+    detection_cache.max_bytes = int(2.5 * entry_bytes)
+
+    detection_cache.put("b-1", make_field(rand_seed=2))
+    os.utime(os.path.join(detection_cache.directory, "a-1"), (0, 0))
+    detection_cache.put("c-1", make_field(rand_seed=3))
+    assert sorted(e["key"] for e in detection_cache.entries()) == ["b-1", "c-1"]
+    assert detection_cache.get("a-1") is None
+    assert detection_cache.get("b-1") is not None and detection_cache.get("c-1") is not None
+    assert detection_cache.size() <= detection_cache.max_bytes
+
+
+def test_put_only_lists_entries_past_the_limit(tmp_path, monkeypatch):
+    detection_cache = cache.DetectionCache(str(tmp_path / "cache"), max_bytes=10 ** 9)
+    calls = []
+    entries = detection_cache.entries
+    monkeypatch.setattr(detection_cache, "entries", lambda: calls.append(1) or entries())
+
+    for i in range(20):
+        detection_cache.put("image%i-params" % i, make_field(rand_seed=i))
+    # Once to measure the cache on the first put
+    assert len(calls) == 1
+
+    detection_cache.max_bytes = detection_cache.size() // 2
+    detection_cache.put("last-params", make_field(rand_seed=99))
+    assert detection_cache.size() <= detection_cache.max_bytes * detection_cache.evict_fraction
+
+
+def test_invalidate_and_clear(detection_cache):
+    detection_cache.put("aaa-1", make_field())
+    detection_cache.put("aaa-2", make_field())
+    detection_cache.put("bbb-1", make_field())
+    assert detection_cache.invalidate("aaa") == 2
+    assert [e["key"] for e in detection_cache.entries()] == ["bbb-1"]
+    assert detection_cache.clear() == 1
+    assert detection_cache.entries() == []
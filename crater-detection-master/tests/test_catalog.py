@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from crater_detection import catalog
+from crater_detection.models import CraterField
+
+
+def make_field(num_craters=50, rand_seed=0):
+    rng = np.random.RandomState(rand_seed)
+    columns = {name: rng.uniform(0, 100, size=num_craters) for name in CraterField.COLUMNS}
+    columns["sun_angle"] = rng.uniform(-np.pi, np.pi, size=num_craters)
+    return CraterField(320, 240, columns=columns)
+
+
+def assert_same_columns(field, other, dtype=np.float64):
+    assert len(field) == len(other)
+    for name in CraterField.COLUMNS:
+        assert np.allclose(field.columns[name].astype(dtype), other.columns[name], rtol=1e-6)
+
+
+@pytest.mark.parametrize("fmt", catalog.CATALOG_FORMATS)
+def test_round_trip(tmp_path, fmt):
+    field = make_field()
+    filename = str(tmp_path / ("catalog." + fmt))
+    catalog.write_catalog(field, filename)
+    read = catalog.read_catalog(filename, width=field.width, height=field.height)
+    assert (read.width, read.height) == (field.width, field.height)
+    assert_same_columns(field, read, np.float32 if fmt == 'npz' else np.float64)
+
+
+@pytest.mark.parametrize("fmt", catalog.CATALOG_FORMATS)
+def test_sink_streams_chunks(tmp_path, fmt):
+    field = make_field(120)
+    filename = str(tmp_path / ("catalog." + fmt))
+    with catalog.open_sink(filename, field.width, field.height, dtype=np.float64) as sink:
+        for start in range(0, len(field), 25):
+            sink.write(field.filter(np.arange(start, min(start + 25, len(field)))))
+        # Empty chunks, e.g. tiles without craters, add nothing
+        sink.write(field.filter(np.zeros(shape=(0,), dtype=np.intp)))
+        stats = sink.stats()
+
+    assert_same_columns(field, catalog.read_catalog(filename, width=field.width, height=field.height))
+    expected = field.stats()
+    for key in ("num_craters", "mean_rad", "max_rad", "min_rad", "sun_angle", "min_sun_angle", "max_sun_angle"):
+        assert np.isclose(stats[key], expected[key])
+
+
+def test_empty_sink_stats(tmp_path):
+    with catalog.open_sink(str(tmp_path / "catalog.csv"), 10, 10) as sink:
+        stats = sink.stats()
+    assert stats["num_craters"] == 0 and np.isnan(stats["mean_rad"])
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        catalog.write_catalog(make_field(), str(tmp_path / "catalog.xml"))
@@ -0,0 +1,31 @@
+import numpy as np
+
+from crater_detection.detector.fused import circle_field
+
+
+def make_field():
+    circles = np.array([[10, 10, 2], [20, 10, 3], [50, 50, 4], [90, 80, 5]], dtype=np.float64)
+    return circle_field(circles, 100, 100)
+
+
+def test_within_boxes():
+    field = make_field()
+    found = field.within_boxes([[0, 0, 20, 20], [40, 40, 100, 100], [0, 0, 5, 5]])
+    assert sorted(found[0]) == [0, 1]
+    assert sorted(found[1]) == [2, 3]
+    assert len(found[2]) == 0
+
+
+def test_within_boxes_single_box():
+    assert sorted(make_field().within_boxes([45, 45, 55, 55])[0]) == [2]
+
+
+def test_within_boxes_no_boxes():
+    assert make_field().within_boxes([]) == []
+    assert make_field().within_boxes(np.zeros(shape=(0, 4))) == []
+
+
+def test_in_box():
+    field = make_field().in_box(0, 0, 60, 60)
+    assert len(field) == 3
+    assert np.all(field.x <= 60)
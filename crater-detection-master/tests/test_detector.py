@@ -0,0 +1,32 @@
+import cv2 as cv
+import numpy as np
+
+from crater_detection import generator
+from crater_detection.detector import crater_circles, detect, find_crater_contours, pair_contours, threshold_masks
+
+
+def test_pair_contours_matches_brute_force():
+    rng = np.random.RandomState(0)
+    high = rng.uniform(0, 500, size=(300, 3))
+    low = rng.uniform(0, 500, size=(250, 3))
+    dists = np.linalg.norm(high[:, np.newaxis, :] - low[np.newaxis, :, :], axis=2)
+    assert np.array_equal(pair_contours(high, low), np.argmin(dists, axis=1))
+
+
+def test_pair_contours_empty():
+    circles = np.ones(shape=(3, 3))
+    assert len(pair_contours(np.zeros(shape=(0, 3)), circles)) == 0
+    assert len(pair_contours(circles, np.zeros(shape=(0, 3)))) == 0
+
+
+def test_crater_circles_match_detect():
+    input_image, _ = generator.generate(num_craters=80, width=400, height=400, rand_seed=4)
+    bw_img = cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+    thresholds = (60, 200)
+    _, crater_field = detect(bw_img, thresholds=thresholds, render=False)
+
+    low_contours, high_contours, _, _, h_matches = find_crater_contours(*threshold_masks(bw_img, *thresholds))
+    circles = crater_circles(high_contours, low_contours, h_matches)
+    assert len(circles) == len(crater_field) > 0
+    expected = np.array([(x, y, rad) for (x, y), rad in (c.min_enclosing_circle() for c in crater_field.craters)])
+    assert np.allclose(circles, expected)
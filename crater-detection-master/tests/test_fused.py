@@ -0,0 +1,32 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from crater_detection import generator, overlay
+from crater_detection.detector import fused
+
+
+@pytest.fixture(scope="module")
+def field_image():
+    input_image, _ = generator.generate(num_craters=30, width=384, height=384, rand_seed=5)
+    return cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+
+
+def test_confirmed_area_matches_refined_circle(field_image):
+    crater_field = fused.detect_fused(field_image, confirmed_only=True)
+    assert len(crater_field) > 0
+    assert np.allclose(crater_field.area, np.pi * crater_field.radius ** 2)
+
+
+def test_circle_overlay_differs_by_method(field_image):
+    contour_field = fused.detect_method(field_image, method="contour")
+    fused_field = fused.detect_method(field_image, method="fused")
+    contour_overlay = overlay.render_circles(field_image, contour_field)
+    fused_overlay = overlay.render_circles(field_image, fused_field)
+    assert fused_overlay.shape == field_image.shape + (3,)
+    assert not np.array_equal(contour_overlay, fused_overlay)
+
+
+def test_unknown_method(field_image):
+    with pytest.raises(ValueError):
+        fused.detect_method(field_image, method="sobel")
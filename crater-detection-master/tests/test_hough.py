@@ -0,0 +1,65 @@
+import numpy as np
+
+from crater_detection.detector import hough
+
+
+def brute_force_dedup(circles, min_dist):
+    # The greedy merge of dedup_circles, checking every pair
+    points = np.asarray(circles, dtype=np.float64)
+    labels = np.full(shape=(len(points),), fill_value=-1)
+    clusters = []
+    for i in range(len(points)):
+        if labels[i] != -1:
+            continue
+        members = [i]
+        for j in range(len(points)):
+            if j == i or labels[j] != -1:
+                continue
+            scaled_min_dist = min_dist * (1.01 ** ((points[i, 2] + points[j, 2]) / 2))
+            if np.linalg.norm(points[i] - points[j]) < scaled_min_dist:
+                members.append(j)
+        labels[members] = len(clusters)
+        clusters.append(points[members].mean(axis=0))
+    return np.uint16(np.around(np.array(clusters).reshape(-1, 3)))
+
+
+def random_circles(rng, num_circles, size=300, max_radius=40):
+    return np.column_stack((rng.randint(0, size, num_circles),
+                            rng.randint(0, size, num_circles),
+                            rng.randint(1, max_radius, num_circles)))
+
+
+def test_dedup_matches_brute_force():
+    rng = np.random.RandomState(0)
+    for _ in range(5):
+        circles = random_circles(rng, 400)
+        assert np.array_equal(hough.dedup_circles(circles, 8), brute_force_dedup(circles, 8))
+
+
+def test_dedup_equal_radii():
+    circles = [[10, 10, 5], [12, 10, 5], [40, 40, 5], [10, 11, 5]]
+    assert np.array_equal(hough.dedup_circles(circles, 5), brute_force_dedup(circles, 5))
+
+
+def test_dedup_is_deterministic():
+    circles = random_circles(np.random.RandomState(1), 2000)
+    first = hough.dedup_circles(circles, 8)
+    for _ in range(3):
+        assert np.array_equal(hough.dedup_circles(circles.copy(), 8), first)
+
+
+def test_dedup_one_large_circle_among_many_small():
+    # A radius 900 circle used to widen the query of every circle to ~100000 px, pairing all of them
+    rng = np.random.RandomState(2)
+    small = np.column_stack((rng.randint(0, 4000, 20000), rng.randint(0, 4000, 20000), rng.randint(1, 20, 20000)))
+    circles = np.vstack((small, [[2000, 2000, 900]]))
+    deduped = hough.dedup_circles(circles, 5)
+    assert [2000, 2000, 900] in deduped.tolist()
+    assert np.array_equal(hough.dedup_circles(small, 5), deduped[:-1])
+
+    subset = np.vstack((small[:300], [[150, 150, 900]]))
+    assert np.array_equal(hough.dedup_circles(subset, 5), brute_force_dedup(subset, 5))
+
+
+def test_dedup_empty():
+    assert hough.dedup_circles([], 5).shape == (0, 3)
@@ -0,0 +1,49 @@
+import cv2 as cv
+import numpy as np
+
+from crater_detection import generator
+from crater_detection.detector import detect, get_peak_values, multiscale
+
+
+def field_circles(crater_field):
+    circles = np.column_stack((crater_field.x, crater_field.y, crater_field.radius))
+    return circles[np.lexsort(circles.T)]
+
+
+def sparse_field():
+    input_image, _ = generator.generate(num_craters=20, width=2048, height=2048, rand_seed=6)
+    return cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+
+
+def test_extremes_level_matches_blocks():
+    bw_img = np.random.RandomState(0).randint(0, 256, size=(203, 150)).astype(np.uint8)
+    thresholds, factor = (20, 230), 4
+    extremes = multiscale.extremes_level(bw_img, thresholds, factor)
+    assert extremes.shape == (51, 38)
+    for row in range(extremes.shape[0]):
+        for col in range(extremes.shape[1]):
+            block = bw_img[row * factor:(row + 1) * factor, col * factor:(col + 1) * factor]
+            expected = np.any(block <= thresholds[0]) or np.any(block >= thresholds[1])
+            assert (extremes[row, col] > 0) == expected
+
+
+def test_regions_find_the_craters_of_a_plain_detect():
+    bw_img = sparse_field()
+    thresholds = get_peak_values(bw_img)
+    factor = 2 ** multiscale.Levels
+    rois = multiscale.regions_of_interest(multiscale.extremes_level(bw_img, thresholds, factor), factor)
+    _, boxes = multiscale.group_regions(rois, factor)
+    # Detected in regions, not whole
+    assert multiscale.region_work(boxes, factor, 2048, 2048) < multiscale.MaxWork
+
+    _, plain = detect(bw_img, thresholds=thresholds, render=False)
+    coarse_to_fine = multiscale.detect_multiscale(bw_img, thresholds=thresholds)
+    assert len(coarse_to_fine) == len(plain) > 0
+    assert np.allclose(field_circles(coarse_to_fine), field_circles(plain))
+
+
+def test_past_max_work_the_image_is_detected_whole():
+    bw_img = sparse_field()
+    _, plain = detect(bw_img, render=False)
+    coarse_to_fine = multiscale.detect_multiscale(bw_img, max_work=0)
+    assert np.array_equal(field_circles(coarse_to_fine), field_circles(plain))
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+
+from crater_detection import overlay
+from crater_detection.detector.fused import circle_field
+
+
+def make_image():
+    return np.random.RandomState(0).randint(0, 255, size=(600, 500), dtype=np.uint8)
+
+
+def make_field(radius=10):
+    return circle_field([[100, 100, radius], [400, 300, radius]], 500, 600)
+
+
+def test_pyramid_layout(tmp_path):
+    pyramid = overlay.TilePyramid(make_image(), make_field(), str(tmp_path), tile_size=128)
+    assert pyramid.max_zoom == 3
+    assert pyramid.num_tiles(0) == (1, 1)
+    assert pyramid.num_tiles(3) == (4, 5)
+    assert pyramid.render_tile(3, 0, 0).shape == (128, 128, 3)
+    with pytest.raises(ValueError):
+        pyramid.render_tile(3, 4, 0)
+    with pytest.raises(ValueError):
+        pyramid.render_tile(4, 0, 0)
+
+
+def test_tiles_kept_for_the_same_image_and_catalog(tmp_path):
+    pyramid = overlay.TilePyramid(make_image(), make_field(), str(tmp_path), tile_size=128)
+    filename = pyramid.tile(1, 0, 0)
+    mtime = os.path.getmtime(filename)
+
+    pyramid = overlay.TilePyramid(make_image(), make_field(), str(tmp_path), tile_size=128)
+    assert pyramid.tile(1, 0, 0) == filename
+    assert os.path.getmtime(filename) == mtime
+
+
+@pytest.mark.parametrize("changed", ["catalog", "image", "tile_size"])
+def test_stale_tiles_are_removed(tmp_path, changed):
+    pyramid = overlay.TilePyramid(make_image(), make_field(), str(tmp_path), tile_size=128)
+    pyramid.render_zoom(1)
+    unrelated = tmp_path / "notes.txt"
+    unrelated.write_text("kept")
+
+    input_image, crater_field, tile_size = make_image(), make_field(), 128
+    if changed == "catalog":
+        crater_field = make_field(radius=20)
+    elif changed == "image":
+        input_image = 255 - input_image
+    else:
+        tile_size = 256
+    pyramid = overlay.TilePyramid(input_image, crater_field, str(tmp_path), tile_size=tile_size)
+
+    assert not os.path.exists(pyramid.tile_filename(1, 0, 0))
+    assert unrelated.read_text() == "kept"
+    assert pyramid.stored_digest() == pyramid.digest
+
+
+def test_source_digest_replaces_image_hash(tmp_path):
+    first = overlay.TilePyramid(make_image(), make_field(), str(tmp_path / "a"), source_digest="abc")
+    second = overlay.TilePyramid(255 - make_image(), make_field(), str(tmp_path / "b"), source_digest="abc")
+    assert first.digest == second.digest
@@ -0,0 +1,66 @@
+import io
+import json
+
+import cv2 as cv
+import pytest
+
+from crater_detection import generator, serve
+
+
+@pytest.fixture
+def server():
+    with serve.DetectionServer(workers=1) as detection_server:
+        yield detection_server
+
+
+@pytest.fixture(scope="module")
+def image_path(tmp_path_factory):
+    input_image, _ = generator.generate(num_craters=20, width=256, height=256, rand_seed=3)
+    filename = str(tmp_path_factory.mktemp("serve") / "field.png")
+    cv.imwrite(filename, input_image)
+    return filename
+
+
+def run_stdio(server, lines):
+    output = io.StringIO()
+    serve.serve_stdio(server, io.StringIO("".join(line + "\n" for line in lines)), output)
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_parse_request_rejects_non_objects():
+    assert serve.parse_request('{"id": 1}') == {"id": 1}
+    for text in ('5', '[1, 2]', '"path"', 'null', '{'):
+        with pytest.raises(ValueError):
+            serve.parse_request(text)
+
+
+def test_failed_warm_up_still_starts_the_worker(monkeypatch):
+    def broken_detect(*args, **kwargs):
+        raise RuntimeError("no OpenCV")
+
+    monkeypatch.setattr(serve.detector, "detect", broken_detect)
+    monkeypatch.setattr(serve, "_workspace", None)
+    monkeypatch.setattr(serve.logger, "enabled", serve.logger.enabled)
+    monkeypatch.setattr(serve.logger, "stream", serve.logger.stream)
+    serve._init_worker(False)
+    assert serve._workspace is not None
+
+
+def test_stdio_survives_bad_requests(server, image_path):
+    responses = run_stdio(server, ['5', 'not json', '[]',
+                                   json.dumps({"id": 1, "path": "/no/such/image.png"}),
+                                   json.dumps({"id": 2, "path": image_path})])
+    assert len(responses) == 5
+    assert all("error" in response and response["id"] is None for response in responses[:3])
+    by_id = {response["id"]: response for response in responses[3:]}
+    assert "error" in by_id[1]
+    assert "error" not in by_id[2] and by_id[2]["width"] == 256
+
+
+def test_pending_slots_are_released(server, image_path):
+    # More requests than pending slots, each failed or raising callback has to give its slot back
+    num_requests = 3 * server.max_pending
+    for i in range(num_requests):
+        assert server.submit({"id": i, "path": "/no/such/image.png"}, lambda response: 1 / 0)
+    response = server.detect({"id": "last", "path": image_path})
+    assert response["id"] == "last" and "error" not in response
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from scipy.signal import argrelmax
+
+from crater_detection.detector import get_peak_values
+from crater_detection.detector.thresholds import PeakHistogram, local_maxima
+from crater_detection.detector.tiling import estimate_thresholds
+
+
+def sorted_peak_values(img, low_percentile=0.001, high_percentile=0.95):
+    # The thresholds as they were computed before PeakHistogram, from every peak sorted
+    flattened = img.flatten()
+    sorted_peaks = sorted(flattened[argrelmax(flattened)[0]])
+    return (int(sorted_peaks[int(np.floor(len(sorted_peaks) * low_percentile))]),
+            int(sorted_peaks[int(np.floor(len(sorted_peaks) * high_percentile))]))
+
+
+def random_images():
+    rng = np.random.RandomState(0)
+    yield rng.randint(0, 256, size=(64, 64), dtype=np.uint8)
+    yield np.clip(rng.normal(120, 30, size=(200, 150)), 0, 255).astype(np.uint8)
+    yield np.uint8(rng.beta(0.5, 3, size=(97, 101)) * 255)
+
+
+def test_local_maxima_matches_argrelmax():
+    values = np.random.RandomState(1).randint(0, 20, size=1000)
+    assert np.array_equal(local_maxima(values), argrelmax(values)[0])
+
+
+@pytest.mark.parametrize("percentiles", [(0.001, 0.95), (0.0, 0.5), (0.1, 0.999)])
+def test_thresholds_match_sorted_peaks(percentiles):
+    for img in random_images():
+        assert PeakHistogram().add(img).thresholds(*percentiles) == sorted_peak_values(img, *percentiles)
+
+
+def test_get_peak_values_matches_sorted_peaks():
+    for img in random_images():
+        assert get_peak_values(img) == sorted_peak_values(img)
+
+
+def test_merged_bands_count_every_band():
+    img = next(random_images())
+    top, bottom = PeakHistogram().add(img[:32]), PeakHistogram().add(img[32:])
+    merged = top + bottom
+    assert merged.num_peaks() == top.num_peaks() + bottom.num_peaks()
+    assert np.array_equal(merged.counts, top.counts + bottom.counts)
+    # Counting in bands only misses the peaks at the band seams
+    assert abs(merged.num_peaks() - PeakHistogram().add(img).num_peaks()) <= 1
+    assert PeakHistogram(merged.to_list()).thresholds() == merged.thresholds()
+
+
+def test_estimated_thresholds_close_to_whole_image():
+    img = np.clip(np.random.RandomState(2).normal(120, 30, size=(1024, 256)), 0, 255).astype(np.uint8)
+    low, high = estimate_thresholds(img, band_rows=128)
+    whole_low, whole_high = get_peak_values(img)
+    assert abs(low - whole_low) <= 1 and abs(high - whole_high) <= 1
+
+
+def test_no_peaks():
+    with pytest.raises(ValueError):
+        PeakHistogram().add(np.zeros(shape=(8, 8), dtype=np.uint8)).thresholds()
@@ -0,0 +1,44 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from crater_detection import generator
+from crater_detection.detector import detect, tiling
+
+
+@pytest.mark.parametrize("shape,tile_size,overlap", [((100, 100), 32, 8), ((257, 130), 64, 20), ((50, 70), 128, 16)])
+def test_cores_partition_the_image(shape, tile_size, overlap):
+    height, width = shape
+    owners = np.zeros(shape=shape, dtype=np.int64)
+    for core, window in tiling.iter_windows(height, width, tile_size, overlap):
+        y0, y1, x0, x1 = core
+        wy0, wy1, wx0, wx1 = window
+        owners[y0:y1, x0:x1] += 1
+        assert wy0 == max(y0 - overlap, 0) and wy1 == min(y1 + overlap, height)
+        assert wx0 == max(x0 - overlap, 0) and wx1 == min(x1 + overlap, width)
+    assert np.all(owners == 1)
+
+
+def test_bad_windows():
+    with pytest.raises(ValueError):
+        list(tiling.iter_windows(100, 100, 0, 8))
+    with pytest.raises(ValueError):
+        list(tiling.iter_windows(100, 100, 32, -1))
+
+
+def test_seam_craters_reported_once():
+    input_image, _ = generator.generate(num_craters=80, width=640, height=640, max_radius=20, rand_seed=11)
+    bw_img = cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+    thresholds = (20, 230)
+    tile_size = 128
+
+    tiled = tiling.detect_tiled(bw_img, tile_size=tile_size, overlap=64, thresholds=thresholds)
+    _, whole = detect(bw_img, thresholds=thresholds, render=False)
+
+    centers = np.round(tiled.centers(), 3)
+    assert len(np.unique(centers, axis=0)) == len(tiled)
+    # Each tile owns the craters centered in its core, which together are the whole image
+    for (y0, y1, x0, x1), _ in tiling.iter_windows(640, 640, tile_size, 64):
+        in_core = (tiled.x >= x0) & (tiled.x < x1) & (tiled.y >= y0) & (tiled.y < y1)
+        whole_in_core = (whole.x >= x0) & (whole.x < x1) & (whole.y >= y0) & (whole.y < y1)
+        assert np.sum(in_core) == np.sum(whole_in_core)
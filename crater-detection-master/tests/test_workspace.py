@@ -0,0 +1,40 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from crater_detection import generator
+from crater_detection.detector import DetectorWorkspace, detect
+
+
+@pytest.fixture(scope="module")
+def field_image():
+    input_image, _ = generator.generate(num_craters=60, width=512, height=512, rand_seed=7)
+    return cv.cvtColor(input_image, cv.COLOR_BGR2GRAY)
+
+
+def test_workspace_matches_plain_detect(field_image):
+    plain_image, plain_field = detect(field_image)
+    workspace_image, workspace_field = detect(field_image, workspace=DetectorWorkspace())
+    assert np.array_equal(plain_image, workspace_image)
+    for name in plain_field.COLUMNS:
+        assert np.array_equal(plain_field.columns[name], workspace_field.columns[name], equal_nan=True)
+
+
+def test_workspace_allocates_once(field_image):
+    workspace = DetectorWorkspace(field_image.shape, render=True)
+    num_allocations = workspace.num_allocations
+    nbytes = workspace.nbytes
+    for window in (field_image, field_image[:256, :300], field_image[100:, 50:], field_image):
+        detect(window, thresholds=(20, 230), workspace=workspace)
+        assert workspace.num_allocations == num_allocations
+    assert workspace.nbytes == nbytes
+
+
+def test_workspace_grows_for_larger_images(field_image):
+    workspace = DetectorWorkspace()
+    detect(field_image[:128, :128], thresholds=(20, 230), render=False, workspace=workspace)
+    small_allocations = workspace.num_allocations
+    detect(field_image[:100, :100], thresholds=(20, 230), render=False, workspace=workspace)
+    assert workspace.num_allocations == small_allocations
+    detect(field_image, thresholds=(20, 230), render=False, workspace=workspace)
+    assert workspace.num_allocations == 2 * small_allocations